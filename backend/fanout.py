@@ -0,0 +1,505 @@
+"""
+Serves rooms with more clients than one event loop can send to: an owner process runs the
+games, and edge processes hold the client sockets.
+
+    python backend/server.py --edges 4
+
+Every edge listens on the server port itself, with SO_REUSEPORT so that the kernel spreads
+new connections across the edges, and serves static files, /ws, /admin/rooms and /metrics.
+What its clients send goes to the owner over a Unix socket, untouched apart from the rate
+limit. The owner handles it exactly as server.py does for a local client, and answers with:
+
+* PUBLISH - a broadcast of a room, encoded once per protocol and written once to every edge
+  with clients of that room and protocol. The edge queues it for each of them.
+* SEND - a message for one client: its welcome, an ack, a hint, the full state on joining.
+* SUBSCRIBE - a client joined, so the room's broadcasts in its protocol now reach it.
+* VIEW - a client joined with a View of its own (see interest.py). Its state updates come
+  with SEND, and its full state for a resync from its View.
+
+So the work that grows with the audience (a queue per client, WebSocket framing, the socket
+writes) is spread over the edges, and a broadcast costs the owner one frame per edge. An
+edge renders nothing itself: a client that falls behind is resynced with a full state it
+asks the owner for (FULL_STATE).
+
+Frames are pickled tuples behind their length; both ends are the same program on one box.
+Linux only: it relies on SO_REUSEPORT and on fork.
+"""
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import socket
+import struct
+
+from aiohttp import web
+
+from metrics import REGISTRY, merge_families, render
+from protocol import PROTOCOLS
+from rate_limit import TokenBucket
+from server import (DEFAULT_ROOM, FRONTEND_DIR, ROOM_ID_PATTERN, THROTTLED, ClientConnection, client_left,
+                    client_message, log_client_error)
+from sharding import REPORT_INTERVAL
+
+FRAME_HEADER = struct.Struct('<I')  # Size of the pickled frame that follows
+EDGE_STOP_TIMEOUT = 5  # Seconds edges get to close their clients once the owner is gone
+
+# Edge -> owner
+OPEN = 'open'  # conn id, room id: a client connected
+MESSAGE = 'message'  # conn id, text: a client sent a message
+CLOSE = 'close'  # conn id: a client disconnected
+REPORT = 'report'  # pid, connections, metric families: sent every REPORT_INTERVAL
+REQUEST = 'request'  # request id, path: /admin/rooms or /metrics, answered with REPLY
+# Owner -> edge
+SEND = 'send'  # conn id, kind, message
+PUBLISH = 'publish'  # room id, protocol, kind, message
+SUBSCRIBE = 'subscribe'  # conn id, room id, protocol
+VIEW = 'view'  # conn id, protocol: the client's full state comes from its View
+DISCONNECT = 'disconnect'  # conn id: the owner failed to handle a client's message
+REPLY = 'reply'  # request id, text
+# Both ways
+# room id, protocol, conn id of a client with a View or None (edge -> owner); plus the message (owner -> edge)
+FULL_STATE = 'full_state'
+
+logger = logging.getLogger('fanout')
+
+
+class Channel:
+    """Frames over a Unix socket stream. Sending only buffers; the transport writes in the background."""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def send(self, frame):
+        self.write(encode_frame(frame))
+
+    def write(self, encoded):
+        """Sends a frame encoded with encode_frame, so one encoding can go to several channels."""
+        if not self.writer.is_closing():
+            self.writer.writelines(encoded)
+
+    async def receive(self):
+        """The next frame, or None once the other end is gone."""
+        try:
+            size, = FRAME_HEADER.unpack(await self.reader.readexactly(FRAME_HEADER.size))
+            return pickle.loads(await self.reader.readexactly(size))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    def close(self):
+        self.writer.close()
+
+
+def encode_frame(frame):
+    data = pickle.dumps(frame, pickle.HIGHEST_PROTOCOL)
+    return (FRAME_HEADER.pack(len(data)), data)
+
+
+# --- Owner side ---
+class Owner:
+    """
+    Runs the rooms of `app` (see server.make_app) for the clients of the edges. It is the
+    relay of every room: broadcasts go to the edges with subscribed clients.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.runner = None
+        self.links = []
+        # (room id, protocol) -> EdgeLink -> clients of that edge receiving those broadcasts
+        self.subscribers = collections.defaultdict(collections.Counter)
+        self.closing = False
+        app['rooms'].relay = self
+
+    async def start(self, edges):
+        """Starts the app, without a listening socket of its own, and serves `edges` (see spawn_edges)."""
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup() # Runs the startup hooks: maze pool, restored rooms, snapshots
+        for index, (process, sock) in enumerate(edges):
+            reader, writer = await asyncio.open_unix_connection(sock=sock)
+            link = EdgeLink(self, index, process, Channel(reader, writer))
+            self.links.append(link)
+            link.task = asyncio.create_task(link.read())
+
+    async def close(self):
+        self.closing = True
+        await self.runner.cleanup() # Snapshots and closes the rooms
+        for link in self.links:
+            link.channel.close()
+            link.task.cancel()
+        for link in self.links:
+            # Edges stop by themselves once their channel is closed
+            await asyncio.get_running_loop().run_in_executor(None, link.process.join, EDGE_STOP_TIMEOUT)
+            if link.process.is_alive():
+                link.process.terminate()
+
+    # Room.relay
+    def protocols(self, room_id):
+        return [protocol for protocol in PROTOCOLS if self.subscribers.get((room_id, protocol))]
+
+    def connections(self, room_id):
+        return sum(sum(self.subscribers.get((room_id, protocol), {}).values()) for protocol in PROTOCOLS)
+
+    def publish(self, room_id, protocol, message, kind):
+        frame = encode_frame((PUBLISH, room_id, protocol, kind, message))
+        for link in self.subscribers.get((room_id, protocol), ()):
+            link.channel.write(frame)
+
+    def subscribe(self, link, room_id, protocol, change):
+        """Counts a client of `link` in (change=1) or out of (change=-1) a room's broadcasts."""
+        links = self.subscribers[(room_id, protocol)]
+        links[link] += change
+        if links[link] <= 0:
+            del links[link]
+        if not links:
+            del self.subscribers[(room_id, protocol)]
+
+    def admin(self, path):
+        """The body of /admin/rooms or /metrics, covering the owner and every edge."""
+        if path == '/metrics':
+            groups = [({"process": "owner"}, REGISTRY.families())]
+            groups += [({"process": f"edge{link.index}"}, link.metrics) for link in self.links]
+            return render(merge_families(groups))
+        return json.dumps({
+            "workers": [{"worker": 0, "pid": os.getpid(), "rooms": self.app['rooms'].stats(),
+                         "maze_pool": self.app['maze_pool'].stats()}],
+            "edges": [link.stats() for link in self.links],
+        })
+
+
+class EdgeLink:
+    """The owner's end of the channel to one edge process, with the clients connected there."""
+    def __init__(self, owner, index, process, channel):
+        self.owner = owner
+        self.index = index
+        self.process = process
+        self.channel = channel
+        self.task = None
+        self.clients = {} # Conn id -> RemoteClient
+        self.metrics = [] # Metric families as of the last report
+        self.reported = {}
+
+    async def read(self):
+        registry = self.owner.app['rooms']
+        while (frame := await self.channel.receive()) is not None:
+            op = frame[0]
+            if op == MESSAGE:
+                client = self.clients.get(frame[1])
+                if client is not None:
+                    client.inbox.put_nowait(frame[2])
+            elif op == OPEN:
+                _, conn_id, room_id = frame
+                self.clients[conn_id] = RemoteClient(self, conn_id, registry.join(room_id))
+            elif op == CLOSE:
+                client = self.clients.pop(frame[1], None)
+                if client is not None:
+                    client.inbox.put_nowait(None)
+            elif op == FULL_STATE:
+                _, room_id, protocol, conn_id = frame
+                if conn_id is None:
+                    room = registry.rooms.get(room_id)
+                    source = room.game if room else None
+                else:
+                    client = self.clients.get(conn_id)
+                    source = client.view if client else None
+                message = source.full_state_message(protocol) if source else None
+                self.channel.send((FULL_STATE, room_id, protocol, conn_id, message))
+            elif op == REPORT:
+                _, pid, connections, self.metrics = frame
+                self.reported = {"pid": pid, "connections": connections}
+            elif op == REQUEST:
+                _, request_id, path = frame
+                self.channel.send((REPLY, request_id, self.owner.admin(path)))
+        if not self.owner.closing:
+            logger.error("Edge %d is gone, dropping its %d clients", self.index, len(self.clients))
+        for client in self.clients.values():
+            client.inbox.put_nowait(None)
+        self.clients.clear()
+
+    def stats(self):
+        return {"edge": self.index, "alive": self.process.is_alive(), **self.reported}
+
+
+class RemoteClient:
+    """
+    A client of an edge process, as the owner sees it: the outbound side that
+    server.client_message expects, and an inbox of its messages, handled in order by a
+    task of its own the way websocket_handler handles a local client.
+    """
+    def __init__(self, link, conn_id, room):
+        self.link = link
+        self.id = conn_id
+        self.room = room
+        self.player = None
+        self.spectator = False
+        self.protocol = 'json' # Negotiated on join
+        self.subscribed = False
+        self.view = None
+        self.inbox = asyncio.Queue() # Message texts, then None once the client is gone
+        self.task = asyncio.create_task(self.run())
+
+    def send(self, message, kind=ClientConnection.OTHER):
+        self.link.channel.send((SEND, self.id, kind, message))
+
+    def set_view(self, view):
+        self.view = view
+        self.link.channel.send((VIEW, self.id, self.protocol))
+
+    def subscribe(self):
+        self.subscribed = True
+        self.link.owner.subscribe(self.link, self.room.id, self.protocol, 1)
+        self.link.channel.send((SUBSCRIBE, self.id, self.room.id, self.protocol))
+
+    async def run(self):
+        owner = self.link.owner
+        try:
+            while (text := await self.inbox.get()) is not None:
+                await client_message(owner.app, self.room, self, json.loads(text), self.subscribe)
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            log_client_error(self, e)
+            self.link.channel.send((DISCONNECT, self.id))
+        if self.subscribed:
+            owner.subscribe(self.link, self.room.id, self.protocol, -1)
+        if not owner.closing:
+            await client_left(owner.app, self.room, self)
+
+
+# --- Edge side ---
+class Edge:
+    """An edge process: its clients, and the channel to the owner they are relayed over."""
+    def __init__(self, index, channel):
+        self.index = index
+        self.channel = channel
+        self.ids = itertools.count()
+        self.clients = {} # Conn id -> EdgeClient
+        self.subscribed = collections.defaultdict(set) # (room id, protocol) -> EdgeClients joined there
+        self.mirrors = {} # Room id -> RoomMirror
+        self.full_states = {} # (room id, protocol, conn id or None) -> future of the owner's full state message
+        self.requests = {} # Request id -> future of the owner's reply
+
+    def mirror(self, room_id):
+        mirror = self.mirrors.get(room_id)
+        if mirror is None:
+            mirror = self.mirrors[room_id] = RoomMirror(self, room_id)
+        return mirror
+
+    def connect(self, ws, room_id, limit, overflow):
+        client = EdgeClient(ws, self, next(self.ids), room_id, limit, overflow)
+        self.clients[client.id] = client
+        self.channel.send((OPEN, client.id, room_id))
+        return client
+
+    def disconnect(self, client):
+        client.close()
+        self.clients.pop(client.id, None)
+        subscribed = self.subscribed.get((client.room_id, client.protocol))
+        if subscribed is not None:
+            subscribed.discard(client)
+            if not subscribed:
+                del self.subscribed[(client.room_id, client.protocol)]
+        self.channel.send((CLOSE, client.id))
+
+    async def request(self, path):
+        request_id = next(self.ids)
+        reply = self.requests[request_id] = asyncio.get_running_loop().create_future()
+        self.channel.send((REQUEST, request_id, path))
+        return await reply
+
+    async def read(self):
+        """Carries out the owner's frames until it is gone."""
+        while (frame := await self.channel.receive()) is not None:
+            op = frame[0]
+            if op == PUBLISH:
+                _, room_id, protocol, kind, message = frame
+                for client in self.subscribed.get((room_id, protocol), ()):
+                    client.send(message, kind)
+            elif op == SEND:
+                _, conn_id, kind, message = frame
+                client = self.clients.get(conn_id)
+                if client is not None:
+                    client.send(message, kind)
+            elif op == SUBSCRIBE:
+                _, conn_id, room_id, protocol = frame
+                client = self.clients.get(conn_id)
+                if client is not None:
+                    client.protocol = protocol
+                    self.subscribed[(room_id, protocol)].add(client)
+            elif op == VIEW:
+                _, conn_id, protocol = frame
+                client = self.clients.get(conn_id)
+                if client is not None:
+                    client.protocol = protocol
+                    client.game = RoomMirror(self, client.room_id, client.id)
+            elif op == FULL_STATE:
+                _, room_id, protocol, conn_id, message = frame
+                future = self.full_states.pop((room_id, protocol, conn_id), None)
+                if future is not None:
+                    future.set_result(message)
+                    # The resyncing clients take it before the updates that follow it are queued
+                    await asyncio.sleep(0)
+            elif op == REPLY:
+                _, request_id, text = frame
+                future = self.requests.pop(request_id, None)
+                if future is not None:
+                    future.set_result(text)
+            elif op == DISCONNECT:
+                client = self.clients.get(frame[1])
+                if client is not None:
+                    client.close()
+                    asyncio.create_task(client.ws.close(code=1011, message=b'Server error'))
+
+    async def report_periodically(self):
+        while True:
+            self.channel.send((REPORT, os.getpid(), len(self.clients), REGISTRY.families()))
+            await asyncio.sleep(REPORT_INTERVAL)
+
+    async def close(self):
+        for client in self.clients.values():
+            client.close()
+        await asyncio.gather(*(client.ws.close(code=1001, message=b'Server shutdown')
+                               for client in list(self.clients.values())))
+
+
+class EdgeClient(ClientConnection):
+    """A client socket on an edge process, known to the owner by `id`."""
+    def __init__(self, ws, edge, conn_id, room_id, limit, overflow):
+        super().__init__(ws, edge.mirror(room_id), limit, overflow)
+        self.id = conn_id
+        self.room_id = room_id
+
+
+class RoomMirror:
+    """
+    Stands in for a room's game on an edge: full states for resyncs come from the owner. With
+    a `conn_id`, it stands in for the View of that client instead.
+    """
+    def __init__(self, edge, room_id, conn_id=None):
+        self.edge = edge
+        self.room_id = room_id
+        self.conn_id = conn_id
+
+    def full_state_message(self, protocol):
+        """A future of the full state message; clients resyncing at the same time share one request."""
+        key = (self.room_id, protocol, self.conn_id)
+        future = self.edge.full_states.get(key)
+        if future is None:
+            future = self.edge.full_states[key] = asyncio.get_running_loop().create_future()
+            self.edge.channel.send((FULL_STATE, *key))
+        return future
+
+
+async def edge_websocket_handler(request):
+    room_id = request.query.get('room', DEFAULT_ROOM)
+    if not ROOM_ID_PATTERN.match(room_id):
+        raise web.HTTPBadRequest(text="Invalid room id")
+
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+
+    app = request.app
+    edge = app['edge']
+    client = edge.connect(ws, room_id, app['outbox_limit'], app['outbox_overflow'])
+    limiter = TokenBucket(app['rate_limit_burst'], app['rate_limit']) if app['rate_limit'] else None
+    try:
+        async for msg in ws:
+            if msg.type == web.WSMsgType.TEXT:
+                if limiter and not limiter.take():
+                    THROTTLED.inc()
+                    continue
+                edge.channel.send((MESSAGE, client.id, msg.data))
+            elif msg.type == web.WSMsgType.ERROR:
+                logger.warning("WebSocket connection closed with exception %s", ws.exception())
+    finally:
+        edge.disconnect(client)
+    return ws
+
+async def edge_admin_rooms_handler(request):
+    return web.Response(text=await request.app['edge'].request('/admin/rooms'), content_type='application/json')
+
+async def edge_metrics_handler(request):
+    text = await request.app['edge'].request('/metrics')
+    return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+def make_edge_app(args, edge):
+    app = web.Application()
+    app['edge'] = edge
+    app['outbox_limit'] = args.outbox_limit
+    app['outbox_overflow'] = args.outbox_overflow
+    app['rate_limit'] = args.rate_limit
+    app['rate_limit_burst'] = args.rate_limit_burst
+    app.router.add_get('/ws', edge_websocket_handler)
+    app.router.add_get('/admin/rooms', edge_admin_rooms_handler)
+    app.router.add_get('/metrics', edge_metrics_handler)
+    app.router.add_static('/', FRONTEND_DIR, show_index=True, follow_symlinks=True)
+    return app
+
+
+def _edge_main(index, args, host, owner_sock, inherited_socks):
+    # Forked from the owner: drop its ends of the other edges' channels
+    for sock in inherited_socks:
+        sock.close()
+    try:
+        asyncio.run(_serve_edge(index, args, host, owner_sock))
+    except KeyboardInterrupt:
+        pass
+
+async def _serve_edge(index, args, host, owner_sock):
+    reader, writer = await asyncio.open_unix_connection(sock=owner_sock)
+    edge = Edge(index, Channel(reader, writer))
+    runner = web.AppRunner(make_edge_app(args, edge))
+    await runner.setup()
+    # Every edge binds the port itself; the kernel balances new connections between them
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, args.port))
+    await web.SockSite(runner, sock, backlog=1024).start()
+    reporter = asyncio.create_task(edge.report_periodically())
+    logger.info("Edge %d (pid %d) ready", index, os.getpid())
+    try:
+        await edge.read()
+    finally:
+        reporter.cancel()
+        await edge.close()
+        await runner.cleanup()
+
+
+def spawn_edges(args, host='0.0.0.0'):
+    """
+    Forks `args.edges` edge processes serving `host`:`args.port`. Returns (process, owner end
+    of its channel) pairs, for Owner.start. Call it before starting threads or an event loop.
+    """
+    context = multiprocessing.get_context('fork')
+    edges = []
+    for index in range(args.edges):
+        owner_end, edge_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        inherited = [sock for _, sock in edges] + [owner_end]
+        process = context.Process(target=_edge_main, args=(index, args, host, edge_end, inherited), daemon=True)
+        process.start()
+        edge_end.close()
+        edges.append((process, owner_end))
+    return edges
+
+
+def run_fanout(app_factory, args):
+    """Runs the owner in this process, with the app built by `app_factory()`, and `args.edges` edges."""
+    edges = spawn_edges(args)
+
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        owner = Owner(app_factory())
+        await owner.start(edges)
+        try:
+            await stop.wait()
+        finally:
+            await owner.close()
+
+    asyncio.run(serve())
@@ -0,0 +1,1042 @@
+"""
+The game rules, independent of any transport: mazes, traps, moves, the three game modes and
+the loops that drive slots, ticks and turn-based rounds. A Game reports what its players
+should see to a GameSink. The web server's rooms broadcast it to their clients (server.py);
+a headless game counts it or ignores it (simulate.py).
+"""
+import asyncio
+import collections
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import random
+import time
+import uuid
+
+import numpy as np
+
+from maze import CHUNK_SIZE, PATH, UNREACHABLE, WALL, generate_maze, maze_layout, new_seed
+from metrics import Counter, Histogram
+from protocol import StateUpdate, encode_update, with_seq
+
+# --- Game Configuration ---
+WIDTH, HEIGHT = 25, 25  # Default maze size, both must be odd
+MAX_MAZE_SIDE = 8001
+TRAP_COUNT = 5  # Traps per maze unless a trap density is configured
+TRAP_TYPES = ('return_to_start', 'swap_positions')  # Stored in the trap layer as index + 1
+TRAP_CODES = {kind: i + 1 for i, kind in enumerate(TRAP_TYPES)}
+SLOT_COUNT = 5  # Move slots of a player in slots mode
+SLOT_REFILL_MS = 1000  # One slot comes back per second
+WIN_PAUSE = 2  # Seconds a win is shown before the new maze in real-time modes
+LEADERBOARD_SIZE = 10  # Players closest to the goal that every area state includes
+SMALL_COLLISION_CHECK = 32  # Up to this many players, move collisions are counted without NumPy
+PLAYER_COLORS = ["#FF0000", "#0000FF", "#00FF00", "#FFFF00", "#FF00FF", "#00FFFF"]
+GAME_MODES = {
+    '1': 'unlimited',
+    '2': 'slots',
+    '3': 'turn_based'
+}
+DIRECTION_MAP = {
+    '⬆️': 'up',
+    '⬇️': 'down',
+    '⬅️': 'left',
+    '➡️': 'right'
+}
+# Pacing of turn-based rounds, in seconds: the pause before the first command, the time each
+# command takes (highlighted for half of it, then run) and how long a win is shown before
+# the next maze
+TurnPacing = collections.namedtuple('TurnPacing', ['start', 'step', 'winner'])
+TURN_PACING = TurnPacing(start=1.0, step=0.8, winner=3.0)
+TURN_EXECUTIONS = ('stepwise', 'timeline')
+
+logger = logging.getLogger('game')
+
+# --- Metrics ---
+MOVES = Counter('maze_moves_total', "Moves handled, by game mode", ['mode'])
+RESETS = Counter('maze_resets_total', "Games reset with a new maze")
+TRAPS_TRIGGERED = Counter('maze_traps_triggered_total', "Traps triggered, by kind", ['kind'])
+MOVES_PER_TICK = Histogram('maze_moves_per_tick', "Moves applied per tick in tick mode",
+                           buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+# --- Event Sinks ---
+class GameSink:
+    """
+    Receives what happens in a game. The `publish_*` coroutines are called when the players
+    should see a new state, an event or a turn-based round timeline; `trap_triggered` is
+    called as a trap goes off. This base class ignores everything.
+    """
+    async def publish_state(self):
+        pass
+
+    async def publish_event(self, event):
+        pass
+
+    async def publish_timeline(self, steps, pacing):
+        pass
+
+    def trap_triggered(self, player, kind):
+        pass
+
+
+# --- Game State Class ---
+def check_maze_size(width, height):
+    if not (width % 2 == 1 and height % 2 == 1 and 5 <= width <= MAX_MAZE_SIDE and 5 <= height <= MAX_MAZE_SIDE):
+        raise ValueError(f"Maze size must be odd and between 5 and {MAX_MAZE_SIDE}, got {width}x{height}")
+
+class Game:
+    def __init__(self, width=WIDTH, height=HEIGHT, trap_density=None, maze_pool=None, seed=None, log=None,
+                 realtime=True, tick_rate=0, turn_pacing=TURN_PACING, turn_execution='stepwise', clock=None):
+        check_maze_size(width, height)
+        self.width = width
+        self.height = height
+        self.trap_density = trap_density # Share of empty tiles holding a trap, None for TRAP_COUNT traps
+        # Every random choice of the game comes from its own seeded RNG, so a session log can be replayed
+        self.seed = seed if seed is not None else new_seed()
+        self.rng = random.Random(self.seed)
+        self.log = log # SessionLog recording everything that changes the game, None to record nothing
+        self.journal = None # SessionLog of the changes since the last snapshot, see snapshot.py
+        # Milliseconds since the game started. `now` is read from the clock whenever an action
+        # is recorded and time-based rules (slot refills) use it, so a replay only has to give
+        # the recorded times back
+        started = time.monotonic()
+        self.clock = clock or (lambda: int((time.monotonic() - started) * 1000))
+        self.now = 0
+        # Run ticks and turn-based rounds as asyncio tasks; a replay or a simulation drives the game itself
+        self.realtime = realtime
+        # Ticks per second in unlimited mode: moves are queued and applied together once per tick,
+        # followed by a single broadcast. 0 applies and broadcasts every move as it arrives.
+        self.tick_rate = tick_rate
+        self.move_queue = [] # (player_id, direction, callback once the move is broadcast)
+        self.restart_pending = False # A tick ended the game; the tick loop restarts it, see tick_loop
+        self.ticks = 0
+        self.ticked_moves = 0
+        self.last_tick_moves = 0
+        self.turn_pacing = turn_pacing
+        # 'stepwise' broadcasts every command of a turn-based round as it runs, 'timeline' runs
+        # the round at once and sends it as one message for the clients to animate
+        self.turn_execution = turn_execution
+        # Set whenever readiness may have changed (a toggle, a join, a leave), so the collecting
+        # phase sleeps until then instead of polling
+        self.readiness = asyncio.Event()
+        self.players = {}
+        self.positions = PlayerPositions()
+        self.maze = None
+        self.maze_pool = maze_pool # Pre-generated mazes of this size, None to always generate inline
+        self.spawn_points, self.goal_pos = maze_layout(width, height)
+        # Traps keyed by cell index (y * width + x), plus a byte layer over the grid for lookups
+        self.traps = {}
+        self.trap_cells = bytearray(width * height)
+        self.trap_grid = np.frombuffer(self.trap_cells, dtype=np.uint8).reshape(height, width)
+        self._client_traps = None
+        self._chunk_traps = None # Client traps grouped by chunk, rebuilt with _client_traps
+        self.game_mode = 'unlimited'
+        self.command_limit = 5 # Default command limit for turn-based
+        self.game_loop_task = None
+        self.used_colors = set()
+        self.turn_info = {}
+        self.round_order = [] # Players of the executing turn-based round, in execution order
+        self.round_steps = None
+        self.round_step = None # (player, direction) of the command about to execute
+        self.sink = GameSink() # Replaced by whatever should receive the game's broadcasts, e.g. its Room
+        # Bumped by everything that changes what get_state() returns, see changed()
+        self.version = 0
+        self._state = None
+        self._state_version = None
+        self._area_states = {} # Area -> area_state(), for the version in _area_version
+        self._area_version = None
+        self._area_patches = {} # (id(old), id(new)) -> (old, new, diff_states(old, new)), see area_patch
+        self._area_messages = {} # Encoded view updates, see area_message
+        self._chunk_players = None
+        self._leaders = None
+        # Delta broadcast bookkeeping: the maze is re-sent only when maze_version changes
+        self.maze_version = 0
+        self.state_seq = 0
+        self.last_sent_state = None
+        self.last_sent_maze = None
+        self.last_sent_maze_version = None
+        self._full_messages = {} # Protocol -> encoded last sent state, for joiners and resyncs
+        self.record('start', seed=self.seed, width=width, height=height, trap_density=trap_density)
+        self.reset_game()
+
+    def record(self, kind, **fields):
+        self.now = self.clock()
+        if self.log is not None:
+            self.log.record(kind, t=self.now / 1000, **fields)
+        if self.journal is not None:
+            self.journal.record(kind, t=self.now / 1000, **fields)
+
+    def changed(self):
+        """
+        Marks the state as changed, so the next get_state() builds a new one. Every method
+        that changes something get_state() returns calls this; code changing a game from the
+        outside must too.
+        """
+        self.version += 1
+
+    def close(self):
+        if self.game_loop_task:
+            self.game_loop_task.cancel()
+            self.game_loop_task = None
+        if self.log is not None:
+            self.record('end', digest=self.state_digest())
+            self.log.close()
+            self.log = None
+
+    def state_digest(self):
+        """A short hash of the full state, to check that a replay ended where the recording did."""
+        state = {**self.get_state(), "maze": self.maze.rows()}
+        return hashlib.sha256(json.dumps(state, sort_keys=True).encode()).hexdigest()[:16]
+
+    def reset_game(self):
+        logger.info("Resetting game (mode: %s)", self.game_mode)
+        RESETS.inc()
+        maze = self.maze_pool.take() if self.maze_pool else None
+        if maze is None:
+            maze = self.generate_maze(self.width, self.height) # Pool empty: generate on the event loop
+        self.maze = maze
+        self.maze.distance_field() # Ready-made for pooled mazes, computed here otherwise
+        self.record('maze', seed=maze.seed)
+        self.place_traps(self.trap_count())
+        self.maze_version += 1
+        self.changed()
+        
+        if self.game_loop_task:
+            self.game_loop_task.cancel()
+            self.game_loop_task = None # Ensure task is cleared
+        self.round_steps = None
+        self.restart_pending = False # Whatever reset the game started the new maze already
+
+        # Reset all existing players' states instead of rebuilding the dict
+        player_list = list(self.players.values())
+        for i, player in enumerate(player_list):
+            # Find a spawn point for the player
+            spawn_point = self.spawn_points[i % len(self.spawn_points)]
+            player.x, player.y = spawn_point
+            player.start_x, player.start_y = spawn_point
+            player.slots = SLOT_COUNT
+            self.reset_player_turn_state(player)
+        self.start_game_loop()
+
+    def start_game_loop(self, resume=False):
+        """
+        Starts the task that drives the current mode, if it needs one and the game runs in
+        real time. `resume` carries on with the turn-based phase in `turn_info` instead of
+        starting a new one, for a game restored from a snapshot.
+        """
+        if not self.realtime:
+            return
+        if self.game_mode == 'unlimited' and self.tick_rate:
+            self.game_loop_task = asyncio.create_task(self.tick_loop())
+        elif self.game_mode == 'turn_based':
+            self.game_loop_task = asyncio.create_task(self.turn_based_loop(resume))
+
+    def restart(self):
+        """Starts a new maze after a win."""
+        self.record('restart')
+        self.reset_game()
+
+    def reset_player_turn_state(self, player):
+        player.commands = ()
+        player.is_ready = False
+
+    def set_mode(self, mode_id, player_id):
+        self.record('set_mode', player_id=player_id, mode_id=mode_id)
+        player = self.players.get(player_id)
+        if not player or player.name.lower() != 'admin':
+            logger.warning("Unauthorized mode change attempt by %s", player.name if player else 'Unknown')
+            return False, "Только админ может менять режим игры."
+
+        new_mode = GAME_MODES.get(mode_id)
+        if new_mode and new_mode != self.game_mode:
+            self.game_mode = new_mode
+            self.reset_game()
+            return True, f"Режим изменен на '{new_mode}' админом."
+        return False, "Режим не изменен."
+
+    def set_command_limit(self, player_id, limit):
+        self.record('set_command_limit', player_id=player_id, limit=limit)
+        player = self.players.get(player_id)
+        if player and player.name.lower() == 'admin' and isinstance(limit, int) and 1 <= limit <= 10:
+            self.command_limit = limit
+            self.changed()
+            logger.info("Admin %s set command limit to %s", player_id, limit)
+            return True
+        return False
+
+    def generate_maze(self, width, height):
+        # Kruskal's algorithm over a flat array-backed grid, see maze.generate_maze
+        return generate_maze(width, height, self.spawn_points, self.goal_pos)
+
+    def trap_count(self):
+        if self.trap_density is None:
+            return TRAP_COUNT
+        return int(np.count_nonzero(self.maze.grid == PATH) * self.trap_density)
+
+    def place_traps(self, count):
+        empty = self.maze.grid == PATH
+        for x, y in self.spawn_points:
+            empty[y, x] = False
+        empty_tiles = np.flatnonzero(empty)
+        traps = {}
+        # One draw of distinct indices instead of repeatedly removing from a list of every tile
+        for i in self.rng.sample(range(len(empty_tiles)), min(count, len(empty_tiles))):
+            traps[int(empty_tiles[i])] = self.rng.choice(TRAP_TYPES)
+        self.set_traps(traps)
+
+    def set_traps(self, traps):
+        """Replaces all traps with `traps`, a dict of cell index -> trap type."""
+        self.traps = traps
+        self.trap_cells[:] = bytes(len(self.trap_cells))
+        cells = np.fromiter(traps, dtype=np.int64, count=len(traps))
+        kinds = np.fromiter(map(TRAP_CODES.__getitem__, traps.values()), dtype=np.uint8, count=len(traps))
+        self.trap_grid.reshape(-1)[cells] = kinds
+        self._client_traps = None
+        self._chunk_traps = None
+        self.changed()
+
+    def remove_trap(self, cell):
+        del self.traps[cell]
+        self.trap_cells[cell] = 0
+        self._client_traps = None
+        self._chunk_traps = None
+        self.changed()
+
+    def client_traps(self):
+        """Traps keyed by "x,y", the way the client expects them. Rebuilt only after a trap changes."""
+        if self._client_traps is None:
+            self._client_traps = {
+                f"{cell % self.width},{cell // self.width}": trap_type for cell, trap_type in self.traps.items()
+            }
+        return self._client_traps
+
+    def get_state(self):
+        """
+        The state the clients see, minus the maze (see Maze.rows). It is built once per
+        version: until the next change, every call returns the same dict, which must not be
+        modified. Unchanged players keep their dicts across versions as well.
+        """
+        if self.game_mode == 'slots':
+            for player in self.players.values():
+                self.refill_slots(player)
+        if self._state_version == self.version:
+            return self._state
+        # Positions and distances to the goal are read for all players at once, by slot
+        xs, ys = self.positions.xs, self.positions.ys
+        distances = self.maze.distance_field()[ys * self.width + xs].tolist()
+        xs, ys = xs.tolist(), ys.tolist()
+        state = {
+            "players": {pid: p.to_dict(xs[p.slot], ys[p.slot], distances[p.slot]) for pid, p in self.players.items()},
+            "goal": self.goal_pos,
+            "traps": self.client_traps(),
+            "mode": self.game_mode,
+            "command_limit": self.command_limit
+        }
+        if self.game_mode == 'turn_based':
+            state['turn_info'] = dict(self.turn_info)
+        self._state, self._state_version = state, self.version
+        return state
+
+    def area_state(self, area):
+        """
+        `get_state()` narrowed to the players and traps in the maze chunks of `area`, a
+        (cx0, cy0, cx1, cy1) rectangle of chunks with exclusive ends, which it includes as
+        "area". The LEADERBOARD_SIZE players closest to the goal are always included, and in
+        turn-based mode every player is: the command queues and the predicted paths take
+        them all. Built once per version and area, so clients seeing the same chunks share
+        it; like get_state() it must not be modified.
+        """
+        state = self.get_state()
+        if self._area_version != self.version:
+            self._area_states, self._area_version = {}, self.version
+            self._area_patches = {}
+            self._area_messages = {}
+            self._chunk_players = None
+        narrowed = self._area_states.get(area)
+        if narrowed is not None:
+            return narrowed
+
+        # Players and traps are grouped by chunk once, then every area picks its chunks
+        if self._chunk_players is None:
+            self._chunk_players = collections.defaultdict(dict)
+            for pid, player in state['players'].items():
+                self._chunk_players[player['x'] // CHUNK_SIZE, player['y'] // CHUNK_SIZE][pid] = player
+            self._leaders = dict(heapq.nsmallest(
+                LEADERBOARD_SIZE, state['players'].items(),
+                key=lambda item: item[1]['distance'] if item[1]['distance'] != UNREACHABLE else float('inf')))
+        if self._chunk_traps is None:
+            self._chunk_traps = collections.defaultdict(dict)
+            for cell, trap_type in self.traps.items():
+                x, y = cell % self.width, cell // self.width
+                self._chunk_traps[x // CHUNK_SIZE, y // CHUNK_SIZE][f"{x},{y}"] = trap_type
+        players, traps = {}, {}
+        cx0, cy0, cx1, cy1 = area
+        for chunk in itertools.product(range(cx0, cx1), range(cy0, cy1)):
+            players.update(self._chunk_players.get(chunk, ()))
+            traps.update(self._chunk_traps.get(chunk, ()))
+        if self.game_mode == 'turn_based':
+            players = state['players']
+        else:
+            players.update(self._leaders)
+        narrowed = self._area_states[area] = {**state, "players": players, "traps": traps, "area": list(area)}
+        return narrowed
+
+    def area_patch(self, old, new):
+        """`diff_states(old, new)` for area states, worked out once for all the views that move between the same two."""
+        cached = self._area_patches.get((id(old), id(new)))
+        if cached is not None and cached[0] is old and cached[1] is new:
+            return cached[2]
+        patch = diff_states(old, new)
+        self._area_patches[id(old), id(new)] = (old, new, patch)
+        return patch
+
+    def area_message(self, update, protocol='json'):
+        """
+        A view's update encoded for `protocol`. The encoding is shared by every view whose
+        update has the same data and chunks, such as the views in the same area, and only
+        the seq differs (see protocol.with_seq).
+        """
+        key = (update.kind, id(update.data), tuple(update.chunks), protocol)
+        cached = self._area_messages.get(key)
+        if cached is None or cached[0] is not update.data:
+            cached = self._area_messages[key] = (update.data, encode_update(update._replace(seq=0), protocol))
+        return with_seq(cached[1], update.seq)
+
+    def full_state_update(self):
+        """The last broadcast state in full, for late joiners and clients asking for a resync."""
+        if self.last_sent_state is None:
+            self.next_state_update()
+        return StateUpdate('gameState', self.state_seq, self.last_sent_state, self.last_sent_state, self.last_sent_maze)
+
+    def full_state_message(self, protocol='json'):
+        """The full state update encoded for `protocol`, encoded once per broadcast state."""
+        message = self._full_messages.get(protocol)
+        if message is None:
+            message = self._full_messages[protocol] = encode_update(self.full_state_update(), protocol)
+        return message
+
+    def next_state_update(self):
+        """
+        Advances the broadcast sequence and returns the update to send to every client:
+        the full state right after a reset, a patch with only the changed parts otherwise.
+        Returns None if nothing changed since the previous broadcast.
+        """
+        state = self.get_state()
+        previous = self.last_sent_state
+        if previous is None or self.maze_version != self.last_sent_maze_version:
+            self.state_seq += 1
+            self.last_sent_state = state
+            self.last_sent_maze = self.maze
+            self.last_sent_maze_version = self.maze_version
+            self._full_messages = {}
+            return StateUpdate('gameState', self.state_seq, state, state, self.maze)
+
+        if state is previous:
+            return None # No change since the last broadcast
+        patch = diff_states(previous, state)
+        if not patch:
+            return None
+        self.state_seq += 1
+        self.last_sent_state = state
+        self._full_messages = {}
+        return StateUpdate('statePatch', self.state_seq, patch, state, self.last_sent_maze)
+
+    async def register(self, name):
+        player_id = str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+        self.record('join', player_id=player_id, name=name)
+
+        available_colors = [c for c in PLAYER_COLORS if c not in self.used_colors]
+        if available_colors:
+            color = self.rng.choice(available_colors)
+        else:
+            color = f"#{self.rng.randint(0, 0xFFFFFF):06x}"
+        
+        # Cycle through spawn points for new players
+        spawn_point = self.spawn_points[len(self.players) % len(self.spawn_points)]
+        
+        player = Player(player_id, spawn_point[0], spawn_point[1], color, name, self.positions)
+        self.players[player_id] = player
+        self.used_colors.add(color)
+        self.changed()
+        self.readiness.set()
+        logger.info("Player %s (%s) created at %s with color %s. Total players: %d",
+                    player_id, name, spawn_point, color, len(self.players))
+        return player
+
+    async def unregister(self, player_id):
+        if player_id in self.players:
+            player = self.players.pop(player_id)
+            self.record('leave', player_id=player_id, x=player.x, y=player.y)
+            self.used_colors.discard(player.color)
+            self.positions.remove(player)
+            self.changed()
+            self.readiness.set()
+            logger.info("Player %s disconnected. Total players: %d", player_id, len(self.players))
+
+    def next_direction(self, player_id):
+        """The direction that takes a player one step closer to the goal, None at the goal."""
+        player = self.players.get(player_id)
+        if player is None:
+            return None
+        distances = self.maze.distance_field()
+        cell = player.y * self.width + player.x
+        if distances[cell] <= 0:
+            return None
+        for direction, offset in (('up', -self.width), ('down', self.width), ('left', -1), ('right', 1)):
+            if distances[cell + offset] == distances[cell] - 1:
+                return direction
+        return None
+
+    def is_wall(self, x, y):
+        return self.maze.is_wall(x, y)
+
+    def execute_global_move(self, direction):
+        """Moves all players in the specified direction."""
+        mapped_direction = DIRECTION_MAP.get(direction, direction)
+        dx, dy = 0, 0
+        if mapped_direction == 'up': dy = -1
+        elif mapped_direction == 'down': dy = 1
+        elif mapped_direction == 'left': dx = -1
+        elif mapped_direction == 'right': dx = 1
+
+        # --- Player Collision Logic ---
+        # All players are moved at once on the position arrays.
+        xs, ys = self.positions.xs, self.positions.ys
+        if not len(xs):
+            return
+
+        # 1. Propose move for each player; a player facing a wall intends to stay in place
+        target_x, target_y = xs + dx, ys + dy
+        blocked = self.maze.grid[target_y, target_x] == WALL
+        target_x[blocked] = xs[blocked]
+        target_y[blocked] = ys[blocked]
+
+        # 2. Find colliding moves (multiple players aiming for the same tile)
+        targets = target_y * self.width + target_x
+        if len(targets) <= SMALL_COLLISION_CHECK:
+            # Counting a handful of targets in Python is cheaper than np.unique's sort
+            target_list = targets.tolist()
+            target_counts = collections.Counter(target_list)
+            moving = np.fromiter((target_counts[t] == 1 for t in target_list), dtype=bool, count=len(target_list))
+        else:
+            _, target_ids, target_counts = np.unique(targets, return_inverse=True, return_counts=True)
+            moving = target_counts[target_ids] == 1
+
+        # 3. Execute non-colliding moves
+        xs[moving] = target_x[moving]
+        ys[moving] = target_y[moving]
+        if (moving & ~blocked).any(): # Players facing a wall "move" in place
+            self.changed()
+        # --- End Collision Logic ---
+
+
+    async def handle_move(self, player_id, direction):
+        player = self.players.get(player_id)
+        if not player: return
+        self.record('move', player_id=player_id, direction=direction)
+        MOVES.inc(self.game_mode)
+        logger.debug("Move attempt: player %s -> %s in '%s' mode", player_id, direction, self.game_mode)
+
+        # Game mode specific move validation
+        if self.game_mode == 'slots':
+            self.refill_slots(player)
+            if player.slots <= 0:
+                logger.debug("Move rejected: player %s has no slots", player_id)
+                return [] # Return empty list of events
+        if self.game_mode == 'turn_based':
+            if len(player.commands) < self.command_limit:
+                if direction in DIRECTION_MAP:
+                    player.commands += (direction,)
+                    self.changed()
+                    logger.debug("Command added: player %s added '%s'. Commands: %s", player_id, direction, player.commands)
+            else:
+                logger.debug("Command rejected: player %s command list is full", player_id)
+            return [] # Don't move immediately
+
+        if self.game_mode == 'slots':
+            if player.slots == SLOT_COUNT:
+                player.slots_refilled_at = self.now # A full bucket starts refilling with its first move
+            player.slots -= 1
+            self.changed()
+
+        # This is the core logic change: one move affects ALL players.
+        self.execute_global_move(direction)
+        
+        # After the global move, check events for all players.
+        events = []
+        if not self.players_on_event_tiles():
+            return events
+        # Iterate over a copy of player IDs in case a trap removes a player
+        for p_id in list(self.players.keys()):
+            p = self.players.get(p_id)
+            if p:
+                event = await self.check_game_events(p)
+                if event:
+                    events.append(event)
+                    # If a player wins, stop checking for other events
+                    if event.get('type') == 'game_over':
+                        break
+        return events
+
+    def players_on_event_tiles(self):
+        """Whether any player stands on a trap or the goal, checked for all players at once."""
+        xs, ys = self.positions.xs, self.positions.ys
+        goal_x, goal_y = self.goal_pos
+        return bool(self.trap_grid[ys, xs].any() or ((xs == goal_x) & (ys == goal_y)).any())
+
+    async def check_game_events(self, player):
+        x, y = player.x, player.y
+        
+        # Check for win
+        if (x, y) == self.goal_pos:
+            return {
+                'type': 'game_over',
+                'winner_id': player.id,
+                'winner_color': player.color
+            }
+        
+        # Check for traps
+        cell = y * self.width + x
+        if self.trap_cells[cell]:
+            trap_type = self.traps[cell]
+            self.remove_trap(cell) # Trap disappears after use
+            TRAPS_TRIGGERED.inc(trap_type)
+            self.sink.trap_triggered(player, trap_type)
+            if trap_type == 'return_to_start':
+                player.x, player.y = player.start_x, player.start_y
+            elif trap_type == 'swap_positions':
+                self.positions.shuffle(self.rng) # remove_trap already marked the state changed
+            return {
+                'type': 'notification',
+                'message': f'Player {player.id[:4]}... activated a "{trap_type.replace("_", " ")}" trap!'
+            }
+        return None
+
+    def remove_last_command(self, player_id):
+        self.record('remove_command', player_id=player_id)
+        player = self.players.get(player_id)
+        if player and self.game_mode == 'turn_based' and player.commands:
+            player.commands = player.commands[:-1]
+            self.changed()
+            logger.debug("Player %s removed last command. Commands: %s", player_id, player.commands)
+
+    def toggle_player_ready(self, player_id):
+        self.record('toggle_ready', player_id=player_id)
+        player = self.players.get(player_id)
+        if player and self.game_mode == 'turn_based':
+            player.is_ready = not player.is_ready
+            self.changed()
+            self.readiness.set()
+            logger.debug("Player %s readiness set to %s", player.id, player.is_ready)
+
+    # --- Tick Mode ---
+    def ticking(self):
+        """Whether moves are currently queued for the next tick instead of applied at once."""
+        return bool(self.tick_rate) and self.realtime and self.game_mode == 'unlimited'
+
+    def queue_move(self, player_id, direction, on_broadcast=None):
+        self.move_queue.append((player_id, direction, on_broadcast))
+
+    async def run_tick(self):
+        """
+        Applies the queued moves in arrival order, exactly as if each had been handled on
+        arrival, then broadcasts the resulting state once. A win ends the tick: the moves
+        queued behind it wait for the new maze, which the tick loop starts.
+        """
+        if self.restart_pending:
+            return
+        batch, self.move_queue = self.move_queue, []
+        if not batch:
+            return
+        won = []
+        for i, (player_id, direction, _) in enumerate(batch):
+            events = await self.handle_move(player_id, direction) or []
+            if any(event.get('type') == 'game_over' for event in events):
+                self.restart_pending = True
+                self.move_queue[:0] = batch[i + 1:]
+                batch = batch[:i + 1]
+                won = events
+                break
+            for event in events:
+                await self.sink.publish_event(event)
+        await self.sink.publish_state()
+        for event in won: # After the winning move's state, as without ticks
+            await self.sink.publish_event(event)
+        for _, _, on_broadcast in batch:
+            if on_broadcast:
+                on_broadcast()
+        self.ticks += 1
+        self.ticked_moves += len(batch)
+        self.last_tick_moves = len(batch)
+        MOVES_PER_TICK.observe(len(batch))
+
+    async def tick_loop(self):
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.tick_rate
+        next_tick = loop.time()
+        while True:
+            # Ticks are scheduled on a fixed grid; an overloaded loop skips ticks instead of bunching them
+            next_tick = max(next_tick + interval, loop.time())
+            await asyncio.sleep(next_tick - loop.time())
+            await self.run_tick()
+            if self.restart_pending:
+                # The win stays on screen for the same pause as without ticks; moves queued
+                # meanwhile wait for the new maze. restart() starts the next tick loop (and
+                # clears the flag), so this one ends here instead of cancelling itself.
+                await asyncio.sleep(WIN_PAUSE)
+                self.game_loop_task = None
+                self.restart()
+                await self.sink.publish_state()
+                return
+
+    def tick_stats(self):
+        return {
+            "rate": self.tick_rate,
+            "ticks": self.ticks,
+            "moves": self.ticked_moves,
+            "moves_per_tick": self.ticked_moves / self.ticks if self.ticks else 0,
+            "last_tick_moves": self.last_tick_moves,
+        }
+
+    def refill_slots(self, player):
+        """
+        Gives back the slots a player regained since the last refill. Slots are a token bucket
+        worked out from the game clock when they are read, so no task has to tick them up.
+        """
+        if player.slots >= SLOT_COUNT:
+            return
+        refills = (self.now - player.slots_refilled_at) // SLOT_REFILL_MS
+        if refills > 0:
+            player.slots = min(SLOT_COUNT, player.slots + refills)
+            player.slots_refilled_at += refills * SLOT_REFILL_MS
+            self.changed()
+
+    # --- Turn-Based Rounds ---
+    # Each step the turn-based loop takes is a method of its own, so a replay can take the
+    # same steps in the order the session log recorded them.
+    def all_ready(self):
+        return bool(self.players) and all(p.is_ready for p in self.players.values())
+
+    def start_collecting(self):
+        self.record('collect')
+        self.turn_info = {'phase': 'collecting', 'executing_command': None}
+        for p in self.players.values(): self.reset_player_turn_state(p)
+        self.changed()
+
+    def start_round(self):
+        self.record('round')
+        self.turn_info['phase'] = 'executing'
+        # Get a fixed order of players for this execution round
+        self.round_order = sorted(self.players.values(), key=lambda p: p.name.lower())
+        self.round_steps = self._round_steps()
+        self.changed()
+
+    def _round_steps(self):
+        for i in range(self.command_limit):
+            for player in self.round_order:
+                if i < len(player.commands):
+                    yield player, i
+
+    def next_round_step(self):
+        """Marks the next command of the round as executing. Returns False once the round is over."""
+        self.record('round_step')
+        step = next(self.round_steps, None) if self.round_steps else None
+        if step is None:
+            self.round_step = None
+            self.round_steps = None # The round is over
+            return False
+        player, i = step
+        self.round_step = (player, player.commands[i])
+        self.turn_info['executing_command'] = {'player_id': player.id, 'command_index': i}
+        self.changed()
+        return True
+
+    def resume_round(self, pending):
+        """
+        Rebuilds the rest of a round for a game restored mid-way through executing it: the
+        commands after the one in `turn_info` are still to come. `pending` says that command
+        was marked but has not run yet; it is then the `round_step` to run next.
+        """
+        self.round_order = sorted(self.players.values(), key=lambda p: p.name.lower())
+        self.round_steps = self._round_steps()
+        executing = self.turn_info.get('executing_command')
+        if not executing:
+            return
+        for player, i in self.round_steps:
+            if player.id == executing['player_id'] and i == executing['command_index']:
+                if pending:
+                    self.round_step = (player, player.commands[i])
+                return
+
+    async def run_round_step(self):
+        """Executes the marked command and returns its events. A win stops the checks; the caller restarts."""
+        self.record('round_move')
+        _, direction = self.round_step
+        self.round_step = None
+        self.execute_global_move(direction)
+
+        # Check events for all players
+        events = []
+        if self.players_on_event_tiles():
+            for p_check in self.round_order:
+                event = await self.check_game_events(p_check)
+                if event:
+                    events.append(event)
+                    if event.get('type') == 'game_over':
+                        break
+        return events
+
+    async def run_round_timeline(self):
+        """
+        Runs every remaining command of the round in one go, stopping at a win. Returns one
+        step per command: the executing command, the players it moved (id -> [x, y]) and its events.
+        """
+        steps = []
+        positions = self.positions
+        xs, ys = positions.xs.copy(), positions.ys.copy()
+        while self.next_round_step():
+            command = self.turn_info['executing_command']
+            events = await self.run_round_step()
+            moved = np.flatnonzero((positions.xs != xs) | (positions.ys != ys))
+            xs, ys = positions.xs.copy(), positions.ys.copy()
+            steps.append({
+                **command,
+                "positions": {positions.players[slot].id: [int(xs[slot]), int(ys[slot])] for slot in moved},
+                "events": events,
+            })
+            if is_game_over(events):
+                break
+        self.turn_info['executing_command'] = None
+        self.changed()
+        return steps
+
+    # --- Game Mode Coroutines ---
+    async def turn_based_loop(self, resume=False):
+        resumed_phase = self.turn_info.get('phase') if resume else None
+        while self.game_mode == 'turn_based':
+            if resumed_phase != 'executing':
+                # Phase 1: Collect commands
+                if resumed_phase != 'collecting':
+                    self.start_collecting()
+                await self.sink.publish_state()
+
+                # Wait for all players to be ready
+                while not self.all_ready():
+                    self.readiness.clear()
+                    await self.readiness.wait()
+
+                # Phase 2: Execute commands
+                self.start_round()
+            resumed_phase = None
+            if self.turn_execution == 'timeline':
+                game_over = await self.play_round_timeline()
+            else:
+                game_over = await self.play_round_stepwise()
+
+            if game_over:
+                await asyncio.sleep(self.turn_pacing.winner) # Show the winner on the finished maze
+                self.restart() # Starts a new loop for the new maze
+                return
+
+            # Loop back to collecting phase immediately
+
+    async def play_round_stepwise(self):
+        """Runs the round one command at a time, broadcasting each. Returns whether someone won."""
+        await self.sink.publish_state()
+        await asyncio.sleep(self.turn_pacing.start) # Brief pause before execution starts
+
+        while self.next_round_step():
+            # Show the executing command for UI feedback before it runs
+            await self.sink.publish_state()
+            await asyncio.sleep(self.turn_pacing.step / 2)
+
+            events = await self.run_round_step()
+            for event in events:
+                await self.sink.publish_event(event)
+            await self.sink.publish_state()
+            if is_game_over(events):
+                return True
+            await asyncio.sleep(self.turn_pacing.step / 2)
+        return False
+
+    async def play_round_timeline(self):
+        """
+        Runs the round at once and sends its timeline in a single message, followed by the
+        resulting state. Then waits while the clients animate it. Returns whether someone won.
+        """
+        steps = await self.run_round_timeline()
+        await self.sink.publish_timeline(steps, self.turn_pacing)
+        await self.sink.publish_state()
+        await asyncio.sleep(self.turn_pacing.start + len(steps) * self.turn_pacing.step)
+        return bool(steps) and is_game_over(steps[-1]['events'])
+
+
+def is_game_over(events):
+    return any(event.get('type') == 'game_over' for event in events)
+
+
+class PlayerPositions:
+    """
+    Coordinates of all players of a game, kept in contiguous arrays so moves and collisions
+    can be resolved for everyone at once. Each player owns one slot; `Player.x` and
+    `Player.y` read and write their slot.
+    """
+    def __init__(self, capacity=8):
+        self._xs = np.zeros(capacity, dtype=np.int64)
+        self._ys = np.zeros(capacity, dtype=np.int64)
+        self.players = [] # Slot -> Player
+
+    @property
+    def xs(self):
+        return self._xs[:len(self.players)]
+
+    @property
+    def ys(self):
+        return self._ys[:len(self.players)]
+
+    def add(self, player, x, y):
+        slot = len(self.players)
+        if slot == len(self._xs):
+            self._xs = np.concatenate([self._xs, np.zeros(slot, dtype=np.int64)])
+            self._ys = np.concatenate([self._ys, np.zeros(slot, dtype=np.int64)])
+        self._xs[slot], self._ys[slot] = x, y
+        self.players.append(player)
+        return slot
+
+    def shuffle(self, rng=random):
+        """Randomly redistributes the current positions among the players."""
+        order = list(range(len(self.players)))
+        rng.shuffle(order)
+        self.xs[:], self.ys[:] = self.xs[order], self.ys[order]
+
+    def remove(self, player):
+        x, y = player.x, player.y
+        # Move the last player into the freed slot to keep the arrays dense
+        slot, last = player.slot, len(self.players) - 1
+        if slot != last:
+            moved = self.players[last]
+            self._xs[slot], self._ys[slot] = self._xs[last], self._ys[last]
+            self.players[slot] = moved
+            moved.slot = slot
+        self.players.pop()
+        # The removed player keeps its last position in storage of its own
+        player.positions = PlayerPositions(1)
+        player.slot = player.positions.add(player, x, y)
+
+
+class Player:
+    """
+    One player of a game. The fields the clients see are tracked: setting `slots`,
+    `commands` or `is_ready` marks the player dirty, and to_dict() only builds a new dict
+    for a dirty or moved player. `commands` is a tuple, so it is replaced rather than
+    changed in place.
+    """
+    __slots__ = ('id', 'name', 'start_x', 'start_y', 'positions', 'slot', 'color', 'slots_refilled_at',
+                 '_slots', '_commands', '_is_ready', 'dirty', '_dict')
+
+    def __init__(self, id, x, y, color, name="Anonymous", positions=None):
+        self.id = id
+        self.name = name
+        self.start_x = x
+        self.start_y = y
+        self.positions = positions if positions is not None else PlayerPositions(1)
+        self.slot = self.positions.add(self, x, y)
+        self.color = color
+        self.slots_refilled_at = 0 # Game time (ms) the next slot refill counts from
+        self._slots = SLOT_COUNT
+        self._commands = ()
+        self._is_ready = False
+        self.dirty = True
+        self._dict = None
+
+    @property
+    def x(self):
+        return int(self.positions._xs[self.slot])
+
+    @x.setter
+    def x(self, value):
+        self.positions._xs[self.slot] = value
+
+    @property
+    def y(self):
+        return int(self.positions._ys[self.slot])
+
+    @y.setter
+    def y(self, value):
+        self.positions._ys[self.slot] = value
+
+    @property
+    def slots(self):
+        return self._slots
+
+    @slots.setter
+    def slots(self, value):
+        self._slots = value
+        self.dirty = True
+
+    @property
+    def commands(self):
+        return self._commands
+
+    @commands.setter
+    def commands(self, value):
+        self._commands = tuple(value)
+        self.dirty = True
+
+    @property
+    def is_ready(self):
+        return self._is_ready
+
+    @is_ready.setter
+    def is_ready(self, value):
+        self._is_ready = value
+        self.dirty = True
+
+    def to_dict(self, x, y, distance):
+        """The player as the clients see it. Returns the previous dict if nothing changed since."""
+        d = self._dict
+        if self.dirty or d is None or d['x'] != x or d['y'] != y or d['distance'] != distance:
+            d = self._dict = {
+                "name": self.name,
+                "id": self.id,
+                "x": x, "y": y, "distance": distance, "color": self.color,
+                "slots": self._slots, "commands": self._commands,
+                "is_ready": self._is_ready
+            }
+            self.dirty = False
+        return d
+
+def diff_states(old, new):
+    """Builds a patch that turns the `old` dynamic state into `new`. The maze is never diffed."""
+    patch = {}
+
+    players = {}
+    for pid, player in new['players'].items():
+        prev = old['players'].get(pid)
+        if prev is player:
+            continue # Player.to_dict kept the dict, so nothing changed
+        if prev is None:
+            players[pid] = player
+            continue
+        changed = {key: value for key, value in player.items() if prev.get(key) != value}
+        if changed:
+            players[pid] = changed
+    if players:
+        patch['players'] = players
+    removed_players = [pid for pid in old['players'] if pid not in new['players']]
+    if removed_players:
+        patch['removed_players'] = removed_players
+
+    if old['traps'] is not new['traps']: # Game.client_traps is only rebuilt after a trap changes
+        traps = {pos: kind for pos, kind in new['traps'].items() if old['traps'].get(pos) != kind}
+        if traps:
+            patch['traps'] = traps
+        removed_traps = [pos for pos in old['traps'] if pos not in new['traps']]
+        if removed_traps:
+            patch['removed_traps'] = removed_traps
+
+    for key in ('mode', 'command_limit', 'turn_info', 'area'):
+        if old.get(key) != new.get(key):
+            patch[key] = new.get(key)
+    return patch
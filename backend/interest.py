@@ -0,0 +1,135 @@
+"""
+Interest management: what one client sees of a big maze.
+
+A client that joins with `"chunks": true` in a room whose maze is wider or taller than a
+view (see needs_view) is left out of the room's broadcasts. It gets a View of its own
+instead: the maze chunks (see maze.CHUNK_SIZE) around its player, or those under a
+spectator's viewport, and only the players and traps standing in them, plus the leaders
+(every player in turn-based mode; see Game.area_state). Its updates
+are the usual gameState and statePatch messages, with a `seq` of their own and three more
+fields (see protocol.py for the binary frames):
+
+* `area` - the chunks the client holds, [cx0, cy0, cx1, cy1] with exclusive ends. When a
+  patch moves it, the client forgets the chunks that fell out of it.
+* `chunks` - the cells of the chunks that came into the area, keyed by "cx,cy". A full
+  state carries every chunk of the area.
+* `maze_size` and `chunk_size` - in full states only.
+
+So however big the maze is, a client holds at most (2 * radius + 1)² chunks, and its
+messages grow with the players and traps around it rather than with the maze. The price is
+work per client on every broadcast, where the room's broadcasts are built and encoded once
+for everyone; views that move between the same states share their diff and its encoded
+frame, with only the seq told apart. A maze that fits in a view costs no more sent whole, so its
+clients get the room's broadcasts like any other.
+"""
+import itertools
+
+from maze import CHUNK_SIZE
+from protocol import StateUpdate, encode_update
+
+VIEW_RADIUS = 1  # Chunks a player sees on every side of the chunk it stands in
+MAX_VIEWPORT = 64  # Longest side of a spectator's viewport, in cells
+
+
+class View:
+    """
+    The part of a game one client sees: the chunks within `radius` of `player`, or, without a
+    player, those under the spectator's viewport. It keeps the client's own broadcast
+    sequence, the way Game does for the whole room.
+    """
+    def __init__(self, game, player=None, radius=VIEW_RADIUS):
+        self.game = game
+        self.player = player
+        self.radius = radius
+        self.viewport = None # (x, y, width, height) of a spectator, around the goal until set
+        self.seq = 0
+        self.chunks = [] # The chunks of the last sent area, which the client holds
+        self.last_sent_state = None
+        self.last_sent_maze = None
+        self.last_sent_maze_version = None
+        self._full_messages = {}
+
+    def set_viewport(self, viewport):
+        """Moves a spectator's viewport to `viewport`, [x, y, width, height] in cells. Returns False if it is not one."""
+        if not (isinstance(viewport, list) and len(viewport) == 4 and all(type(v) is int for v in viewport)):
+            return False
+        x, y, width, height = viewport
+        if width < 1 or height < 1:
+            return False
+        self.viewport = (min(max(x, 0), self.game.width - 1), min(max(y, 0), self.game.height - 1),
+                         min(width, MAX_VIEWPORT), min(height, MAX_VIEWPORT))
+        return True
+
+    def area(self):
+        """The chunks the client sees now, as (cx0, cy0, cx1, cy1) with exclusive ends."""
+        columns, rows = self.game.maze.chunk_count()
+        if self.player is not None:
+            cx, cy = self.player.x // CHUNK_SIZE, self.player.y // CHUNK_SIZE
+            area = (cx - self.radius, cy - self.radius, cx + self.radius + 1, cy + self.radius + 1)
+        else:
+            x, y, width, height = self.viewport or self.default_viewport()
+            area = (x // CHUNK_SIZE, y // CHUNK_SIZE,
+                    (x + width - 1) // CHUNK_SIZE + 1, (y + height - 1) // CHUNK_SIZE + 1)
+        return (max(area[0], 0), max(area[1], 0), min(area[2], columns), min(area[3], rows))
+
+    def default_viewport(self):
+        goal_x, goal_y = self.game.goal_pos
+        return (max(goal_x - MAX_VIEWPORT // 2, 0), max(goal_y - MAX_VIEWPORT // 2, 0), MAX_VIEWPORT, MAX_VIEWPORT)
+
+    def next_update(self):
+        """
+        Advances the client's sequence and returns its next update: the full view right
+        after a new maze, a patch with the changes in and to its area otherwise. Returns
+        None if nothing it sees changed since the previous update.
+        """
+        game = self.game
+        state = game.area_state(self.area())
+        if self.last_sent_state is None or game.maze_version != self.last_sent_maze_version:
+            self.seq += 1
+            self.last_sent_state = state
+            self.last_sent_maze = game.maze
+            self.last_sent_maze_version = game.maze_version
+            self.chunks = area_chunks(state['area'])
+            self._full_messages = {}
+            return StateUpdate('gameState', self.seq, state, state, game.maze, self.chunks)
+
+        if state is self.last_sent_state:
+            return None
+        patch = game.area_patch(self.last_sent_state, state)
+        if not patch:
+            return None
+        new_chunks = []
+        if 'area' in patch:
+            held = set(self.chunks)
+            self.chunks = area_chunks(state['area'])
+            new_chunks = [chunk for chunk in self.chunks if chunk not in held]
+        self.seq += 1
+        self.last_sent_state = state
+        self._full_messages = {}
+        return StateUpdate('statePatch', self.seq, patch, state, self.last_sent_maze, new_chunks)
+
+    def full_state_update(self):
+        """The last sent view in full, with every chunk of its area, for joining and resyncs."""
+        if self.last_sent_state is None:
+            self.next_update()
+        state = self.last_sent_state
+        return StateUpdate('gameState', self.seq, state, state, self.last_sent_maze, self.chunks)
+
+    def full_state_message(self, protocol='json'):
+        """The full view encoded for `protocol`, encoded once per update."""
+        message = self._full_messages.get(protocol)
+        if message is None:
+            message = self._full_messages[protocol] = encode_update(self.full_state_update(), protocol)
+        return message
+
+
+def needs_view(game, radius=VIEW_RADIUS):
+    """Whether a view of `radius` shows less than the whole maze of `game`."""
+    columns, rows = game.maze.chunk_count()
+    return max(columns, rows) > 2 * radius + 1
+
+
+def area_chunks(area):
+    """The chunks of an area, row by row."""
+    cx0, cy0, cx1, cy1 = area
+    return [(cx, cy) for cy, cx in itertools.product(range(cy0, cy1), range(cx0, cx1))]
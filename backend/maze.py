@@ -0,0 +1,363 @@
+import heapq
+import json
+import random
+from collections import deque
+
+import numpy as np
+
+# Cell values of the maze grid (the same characters the client receives)
+WALL = ord('#')
+PATH = ord(' ')
+GOAL = ord('G')
+
+EXTRA_WALL_REMOVAL = 0.20  # Share of the remaining removable walls knocked out after generation
+UNREACHABLE = -1  # Distance field value of walls and cells cut off from the goal
+MAX_DISTANCE_REPAIR = 4096  # Cells `set_wall` repairs one by one before recomputing the whole distance field
+CHUNK_SIZE = 16  # Side of the square chunks the maze is sent in to clients that see only part of it
+
+
+class Maze:
+    """
+    A maze stored as one flat, row-major bytearray of cell characters.
+
+    `grid` is a (height, width) uint8 NumPy view over the same memory, for batched lookups.
+    `maze[y][x]` still returns '#', ' ' or 'G', exactly like the old list-of-lists grid.
+    The outer ring of cells is always wall. For clients that only see part of it, the maze is
+    cut into CHUNK_SIZE x CHUNK_SIZE chunks from the top left corner, encoded once per chunk.
+    """
+
+    def __init__(self, width, height, cells, seed=None):
+        self.width = width
+        self.height = height
+        self.cells = cells
+        self.seed = seed # The seed it was generated from, to reproduce it
+        self.grid = np.frombuffer(self.cells, dtype=np.uint8).reshape(height, width)
+        self._rows = None
+        self._rows_json = None
+        self._wall_bits = None
+        self._chunk_rows = {}
+        self._chunk_bits = {}
+        self._distances = None
+
+    @classmethod
+    def from_grid(cls, grid, seed=None):
+        height, width = grid.shape
+        return cls(width, height, bytearray(np.ascontiguousarray(grid, dtype=np.uint8).tobytes()), seed)
+
+    def __reduce__(self):
+        # Pickle the cells and the distance field, if computed; the grid view is rebuilt over the cells
+        return (Maze, (self.width, self.height, self.cells, self.seed), {'_distances': self._distances})
+
+    def index(self, x, y):
+        return y * self.width + x
+
+    def is_wall(self, x, y):
+        return self.cells[y * self.width + x] == WALL
+
+    def rows(self):
+        """The maze as a list of strings, the way it goes over the wire."""
+        if self._rows is None:
+            data = self.cells.decode('ascii')
+            self._rows = [data[y * self.width:(y + 1) * self.width] for y in range(self.height)]
+        return self._rows
+
+    def rows_json(self):
+        """`rows()` encoded as JSON. The bulk of a full state, so it is encoded once per maze."""
+        if self._rows_json is None:
+            self._rows_json = json.dumps(self.rows())
+        return self._rows_json
+
+    def wall_bits(self):
+        """The maze as a bitset: one bit per cell in row-major order, least significant bit first, set for walls."""
+        if self._wall_bits is None:
+            self._wall_bits = np.packbits(self.grid == WALL, bitorder='little').tobytes()
+        return self._wall_bits
+
+    def chunk_count(self):
+        """Chunks across and down; the ones on the right and bottom edges may be cut short."""
+        return -(-self.width // CHUNK_SIZE), -(-self.height // CHUNK_SIZE)
+
+    def chunk_rows(self, cx, cy):
+        """The rows of chunk (cx, cy) as strings, like `rows()`; cut short at the edges of the maze."""
+        rows = self._chunk_rows.get((cx, cy))
+        if rows is None:
+            x, width = cx * CHUNK_SIZE, min(CHUNK_SIZE, self.width - cx * CHUNK_SIZE)
+            rows = self._chunk_rows[cx, cy] = [
+                self.cells[y * self.width + x:y * self.width + x + width].decode('ascii')
+                for y in range(cy * CHUNK_SIZE, min(self.height, (cy + 1) * CHUNK_SIZE))
+            ]
+        return rows
+
+    def chunk_bits(self, cx, cy):
+        """
+        Chunk (cx, cy) as a bitset like `wall_bits()`, always CHUNK_SIZE x CHUNK_SIZE cells:
+        those past the edge of the maze count as walls.
+        """
+        bits = self._chunk_bits.get((cx, cy))
+        if bits is None:
+            x, y = cx * CHUNK_SIZE, cy * CHUNK_SIZE
+            part = self.grid[y:y + CHUNK_SIZE, x:x + CHUNK_SIZE]
+            walls = np.ones((CHUNK_SIZE, CHUNK_SIZE), dtype=bool)
+            walls[:part.shape[0], :part.shape[1]] = part == WALL
+            bits = self._chunk_bits[cx, cy] = np.packbits(walls, bitorder='little').tobytes()
+        return bits
+
+    def distance_field(self):
+        """
+        Steps from every cell to the nearest goal, as a flat row-major int32 array with
+        UNREACHABLE for walls. Computed on first use, then kept up to date by `set_wall`.
+        """
+        if self._distances is None:
+            self._distances = _goal_distances(self)
+        return self._distances
+
+    def set_wall(self, x, y, wall=True):
+        """
+        Turns the cell at (x, y) into a wall or a path. A computed distance field is repaired
+        around the change; the repair only falls back to recomputing the whole field when more
+        than MAX_DISTANCE_REPAIR cells depend on the change.
+        """
+        if not (0 < x < self.width - 1 and 0 < y < self.height - 1):
+            raise ValueError(f"({x}, {y}) is on the outer wall of the maze")
+        cell = y * self.width + x
+        if self.cells[cell] == GOAL:
+            raise ValueError("The goal cannot be turned into a wall")
+        if (self.cells[cell] == WALL) == wall:
+            return
+        self.cells[cell] = WALL if wall else PATH
+        self._rows = None
+        self._rows_json = None
+        self._wall_bits = None
+        self._chunk_rows.pop((x // CHUNK_SIZE, y // CHUNK_SIZE), None)
+        self._chunk_bits.pop((x // CHUNK_SIZE, y // CHUNK_SIZE), None)
+        if self._distances is not None:
+            if wall:
+                self._distances_after_closing(cell)
+            else:
+                self._distances_after_opening(cell)
+
+    def _neighbours(self, cell):
+        return (cell - 1, cell + 1, cell - self.width, cell + self.width)
+
+    def _distances_after_opening(self, cell):
+        # Opening a cell can only shorten distances: relax outwards from it, breadth first
+        distances = self._distances
+        reachable = [distances[n] for n in self._neighbours(cell) if distances[n] != UNREACHABLE]
+        if not reachable:
+            return
+        distances[cell] = min(reachable) + 1
+        queue = deque([cell])
+        while queue:
+            current = queue.popleft()
+            step = distances[current] + 1
+            for n in self._neighbours(current):
+                if self.cells[n] != WALL and (distances[n] == UNREACHABLE or distances[n] > step):
+                    distances[n] = step
+                    queue.append(n)
+
+    def _distances_after_closing(self, cell):
+        # Closing a cell can only lengthen the distances of the cells whose every shortest path
+        # ran through it. Find those, layer by layer: a cell is affected when all its neighbours
+        # one step closer to the goal are affected.
+        distances = self._distances
+        if distances[cell] == UNREACHABLE:
+            return
+        affected = {cell}
+        queue = deque([cell])
+        while queue:
+            current = queue.popleft()
+            step = distances[current] + 1
+            for n in self._neighbours(current):
+                if n in affected or distances[n] != step:
+                    continue
+                if any(distances[m] == step - 1 and m not in affected for m in self._neighbours(n)):
+                    continue
+                affected.add(n)
+                if len(affected) > MAX_DISTANCE_REPAIR:
+                    self._distances = None # Recomputed in one pass on the next read
+                    return
+                queue.append(n)
+
+        # Work the affected cells out again from their unaffected neighbours, nearest first
+        for n in affected:
+            distances[n] = UNREACHABLE
+        heap = []
+        for n in affected:
+            if self.cells[n] == WALL:
+                continue
+            reachable = [distances[m] for m in self._neighbours(n) if m not in affected and distances[m] != UNREACHABLE]
+            if reachable:
+                distances[n] = min(reachable) + 1
+                heap.append((int(distances[n]), n))
+        heapq.heapify(heap)
+        while heap:
+            distance, current = heapq.heappop(heap)
+            if distance != distances[current]:
+                continue
+            for n in self._neighbours(current):
+                if n in affected and self.cells[n] != WALL and (distances[n] == UNREACHABLE or distances[n] > distance + 1):
+                    distances[n] = distance + 1
+                    heapq.heappush(heap, (distance + 1, n))
+
+    def __getitem__(self, y):
+        return self.rows()[y]
+
+    def __len__(self):
+        return self.height
+
+    def __iter__(self):
+        return iter(self.rows())
+
+
+def _goal_distances(maze):
+    """
+    Breadth-first search from every goal cell at once. Each round expands the whole frontier
+    with array operations, so the number of Python-level steps is the largest distance in the
+    maze rather than the number of cells.
+    """
+    width = maze.width
+    grid = maze.grid
+    passable = grid != WALL
+    passable[[0, -1], :] = False
+    passable[:, [0, -1]] = False
+    passable = passable.ravel()
+
+    distances = np.full(grid.size, UNREACHABLE, dtype=np.int32)
+    frontier = np.flatnonzero(grid.ravel() == GOAL)
+    distances[frontier] = 0
+    offsets = np.array([-1, 1, -width, width])
+    first_seen = np.empty(grid.size, dtype=np.int64) # Scratch space for dropping duplicate cells
+    distance = 0
+    while len(frontier):
+        distance += 1
+        candidates = (frontier[:, None] + offsets).ravel()
+        candidates = candidates[passable[candidates]]
+        candidates = candidates[distances[candidates] == UNREACHABLE]
+        distances[candidates] = distance
+        # A cell reached from several frontier cells is kept once, without sorting
+        order = np.arange(len(candidates))
+        first_seen[candidates] = order
+        frontier = candidates[first_seen[candidates] == order]
+    return distances
+
+
+def maze_layout(width, height):
+    """The spawn points and the goal of a maze of the given size."""
+    spawn_points = [
+        (1, 1),
+        (width - 2, 1),
+        (1, height - 2),
+        (width - 2, height - 2)
+    ]
+    return spawn_points, (width // 2, height // 2)
+
+
+def new_seed():
+    return random.getrandbits(63)
+
+
+def generate_maze(width, height, spawn_points, goal_pos, seed=None):
+    """
+    Generates a maze with Kruskal's algorithm followed by removing 20% of the remaining
+    interior walls, then clears the spawn points and marks the goal. The same seed always
+    gives the same maze; without one a random seed is drawn.
+
+    Kruskal over a random wall order builds the minimum spanning tree of the cell grid
+    with random wall weights. The tree is built here with Borůvka rounds over the same
+    weights instead of one union per wall: each round every component picks its lightest
+    outgoing wall, and the component labels (an array-based disjoint set) are merged by
+    pointer jumping. With distinct weights the resulting tree is exactly the one Kruskal
+    would produce, but every step is a vectorized array operation, so a 2001x2001 maze
+    takes a fraction of a second.
+    """
+    if width % 2 == 0 or height % 2 == 0 or width < 5 or height < 5:
+        raise ValueError(f"Maze dimensions must be odd and at least 5, got {width}x{height}")
+    if seed is None:
+        seed = new_seed()
+    np_rng = np.random.default_rng(seed)
+
+    # Cells live at odd coordinates; (cx, cy) is the cell at (2 * cx + 1, 2 * cy + 1).
+    cols, rows = (width - 1) // 2, (height - 1) // 2
+    cell_ids = np.arange(cols * rows, dtype=np.int32).reshape(rows, cols)
+
+    # Every interior wall between two neighbouring cells is an edge of the cell grid.
+    u = np.concatenate([cell_ids[:, :-1].ravel(), cell_ids[:-1, :].ravel()])
+    v = np.concatenate([cell_ids[:, 1:].ravel(), cell_ids[1:, :].ravel()])
+
+    # Random wall weights; Kruskal would process the walls from the lightest to the heaviest.
+    weights = np_rng.integers(0, 1 << 32, size=len(u), dtype=np.int64)
+
+    in_tree = _spanning_tree(cols * rows, u, v, weights)
+    tree_u, tree_v = u[in_tree], v[in_tree]
+
+    grid = np.full((height, width), WALL, dtype=np.uint8)
+    grid[1::2, 1::2] = PATH
+    # The wall between two neighbouring cells sits halfway between their coordinates
+    grid[tree_u // cols + tree_v // cols + 1, tree_u % cols + tree_v % cols + 1] = PATH
+
+    # Make the maze more spacious by removing a share of the walls that separate two passages.
+    inner = grid[1:-1, 1:-1]
+    horizontal = (grid[1:-1, :-2] == PATH) & (grid[1:-1, 2:] == PATH)
+    vertical = (grid[:-2, 1:-1] == PATH) & (grid[2:, 1:-1] == PATH)
+    candidate_y, candidate_x = np.nonzero((inner == WALL) & (horizontal | vertical))
+    remove_count = int(len(candidate_x) * EXTRA_WALL_REMOVAL)
+    chosen = np_rng.permutation(len(candidate_x))[:remove_count]
+    grid[candidate_y[chosen] + 1, candidate_x[chosen] + 1] = PATH
+
+    # Ensure spawn points and goal are not walls
+    for x, y in spawn_points:
+        grid[y, x] = PATH
+    grid[goal_pos[1], goal_pos[0]] = GOAL
+
+    return Maze.from_grid(grid, seed)
+
+
+def _spanning_tree(cell_count, u, v, weights):
+    """
+    Returns a boolean mask of the edges in the minimum spanning tree of the graph with
+    `cell_count` vertices and edges (u[i], v[i]) of weight weights[i]. Equal weights are
+    broken by edge order, exactly as a stable sort in Kruskal's algorithm would.
+    """
+    in_tree = np.zeros(len(u), dtype=bool)
+    edge_ids = np.arange(len(u), dtype=np.int64)
+    cu, cv = u, v  # Component labels of each edge's endpoints, initially the cells themselves
+    index_bits = max(1, len(u).bit_length())
+    index_mask = (1 << index_bits) - 1
+    no_edge = np.iinfo(np.int64).max
+
+    while len(edge_ids):
+        # Lightest outgoing edge per component; the key packs (weight, position) so the
+        # minimum key identifies both the lightest edge and where it is in the arrays.
+        keys = (weights << index_bits) | np.arange(len(edge_ids), dtype=np.int64)
+        lightest = np.full(cell_count, no_edge, dtype=np.int64)
+        np.minimum.at(lightest, cu, keys)
+        np.minimum.at(lightest, cv, keys)
+        roots = np.flatnonzero(lightest != no_edge).astype(cu.dtype)
+        chosen = lightest[roots] & index_mask
+        in_tree[edge_ids[chosen]] = True
+
+        # Hook each component onto the one across its chosen edge. Two components that
+        # picked the same edge point at each other; the smaller label becomes the root.
+        other = np.where(cu[chosen] == roots, cv[chosen], cu[chosen])
+        parent = np.arange(cell_count, dtype=cu.dtype)
+        parent[roots] = other
+        mutual = (parent[other] == roots) & (roots < other)
+        parent[roots[mutual]] = roots[mutual]
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+        # Relabel the remaining edges and drop the ones that now lie inside one component
+        cu, cv = parent[cu], parent[cv]
+        crossing = cu != cv
+        edge_ids, weights, cu, cv = edge_ids[crossing], weights[crossing], cu[crossing], cv[crossing]
+
+        # Renumber the surviving components densely so the per-component arrays shrink too
+        is_root = parent == np.arange(cell_count)
+        dense = np.cumsum(is_root, dtype=cu.dtype) - 1
+        cell_count = int(dense[-1]) + 1
+        cu, cv = dense[cu], dense[cv]
+
+    return in_tree
@@ -0,0 +1,96 @@
+import asyncio
+import collections
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from maze import generate_maze, maze_layout, new_seed
+
+MAZE_POOL_DEPTH = 2  # Ready mazes kept per maze size
+MAZE_POOL_EXECUTORS = ('thread', 'process')
+
+logger = logging.getLogger('maze_pool')
+
+
+class MazePool:
+    """
+    Keeps `depth` ready-made mazes of one size, generated in the background on a thread or
+    process executor, so a reset takes a maze in O(1) instead of generating it on the event loop.
+
+    `take()` returns None when the pool is empty; the caller then generates inline.
+    Every taken maze triggers a refill. Each maze keeps the seed it was generated from.
+    """
+    def __init__(self, width, height, depth=MAZE_POOL_DEPTH, executor='thread'):
+        if executor not in MAZE_POOL_EXECUTORS:
+            raise ValueError(f"Unknown maze pool executor: {executor}")
+        self.width = width
+        self.height = height
+        self.depth = depth
+        self.executor_kind = executor
+        self.spawn_points, self.goal_pos = maze_layout(width, height)
+        self.ready = collections.deque()
+        self.pending = 0
+        self.hits = 0
+        self.misses = 0
+        self._executor = None
+
+    def take(self):
+        if self.ready:
+            self.hits += 1
+            maze = self.ready.popleft()
+        else:
+            self.misses += 1
+            maze = None
+        self.refill()
+        return maze
+
+    def refill(self):
+        """Schedules generation of the missing mazes. A no-op outside a running event loop."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        while len(self.ready) + self.pending < self.depth:
+            self.pending += 1
+            loop.create_task(self._generate(loop))
+
+    async def _generate(self, loop):
+        try:
+            maze = await loop.run_in_executor(
+                self.executor(), _generate_maze, self.width, self.height, self.spawn_points, self.goal_pos, new_seed()
+            )
+            self.ready.append(maze)
+        except Exception:
+            logger.exception("Maze pool failed to generate a maze")
+        finally:
+            self.pending -= 1
+
+    def executor(self):
+        if self._executor is None:
+            if self.executor_kind == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='maze-pool')
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self):
+        return {
+            "maze_size": [self.width, self.height],
+            "depth": self.depth,
+            "ready": len(self.ready),
+            "pending": self.pending,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _generate_maze(width, height, spawn_points, goal_pos, seed):
+    # The distance field is computed in the executor too, so a reset gets it ready-made
+    maze = generate_maze(width, height, spawn_points, goal_pos, seed)
+    maze.distance_field()
+    return maze
@@ -0,0 +1,142 @@
+"""
+In-process metrics, served at /metrics in the Prometheus text exposition format.
+
+Metrics register themselves in REGISTRY when they are created, normally at module level.
+Label values are passed positionally, in the order of the metric's label names:
+
+    MOVES = Counter('maze_moves_total', "Moves handled", ['mode'])
+    MOVES.inc('slots')
+
+Updating a metric is a dict lookup and an addition, cheap enough for every message.
+"""
+import bisect
+import math
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def families(self):
+        """Every metric's current samples as plain JSON-able data, see `render`."""
+        return [
+            {"name": metric.name, "type": metric.kind, "help": metric.help, "samples": metric.samples()}
+            for metric in self.metrics
+        ]
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {} # Tuple of label values -> value
+        registry.register(self)
+
+    def _labels(self, values):
+        return dict(zip(self.label_names, values))
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        if not self.label_names:
+            self.values[()] = 0
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        return [[self.name, self._labels(key), value] for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    """A value read when the metrics are collected, from `set` or from the function given to `set_function`."""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.function = None
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def set_function(self, function):
+        """`function()` returns a dict of label value tuples to values."""
+        self.function = function
+
+    def samples(self):
+        values = self.function() if self.function else self.values
+        return [[self.name, self._labels(key), value] for key, value in values.items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        counts = self.values.get(labels)
+        if counts is None:
+            # Per-bucket counts (the last one is +Inf), then the sum of all observations
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for key, counts in self.values.items():
+            labels = self._labels(key)
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                total += count
+                samples.append([f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, total])
+            samples.append([f"{self.name}_sum", labels, counts[-1]])
+            samples.append([f"{self.name}_count", labels, total])
+        return samples
+
+
+def merge_families(groups):
+    """Merges the families of several processes, given as (extra labels, families) pairs, into one list."""
+    merged = {}
+    for extra_labels, families in groups:
+        for family in families:
+            target = merged.setdefault(family['name'], {**family, "samples": []})
+            target['samples'].extend([name, {**extra_labels, **labels}, value] for name, labels, value in family['samples'])
+    return list(merged.values())
+
+
+def render(families):
+    lines = []
+    for family in families:
+        lines.append(f"# HELP {family['name']} {family['help']}")
+        lines.append(f"# TYPE {family['name']} {family['type']}")
+        for name, labels, value in family['samples']:
+            if labels:
+                label_text = ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+                lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+            else:
+                lines.append(f"{name} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,261 @@
+"""
+Wire encodings of the messages the server pushes to clients.
+
+Clients pick a protocol in their `join` message. 'json' (the default) sends every message as
+JSON text. 'binary' sends state and events as compact binary frames; everything a client
+sends, the `welcome` reply and the once-per-round `turnTimeline` stay JSON in both protocols.
+
+Binary frames are little-endian and start with a one-byte tag:
+
+* FRAME_STATE - full state: header, the maze as a bitset (1 bit per cell, set for walls,
+  row-major) plus the goal coordinate, then trap records and player records.
+* FRAME_PATCH - state patch: a flags byte saying which optional fields follow, then the
+  changed players (as full records), players that only moved (id and position), removed
+  player ids, added and removed traps.
+* FRAME_EVENT - a game event: an event kind byte and its payload.
+* FRAME_VIEW - full state of a client's view (see interest.py): laid out like FRAME_STATE,
+  but the maze bitset is replaced by the area, the chunk size, the chunk count and the
+  chunk records of the area.
+
+View patches are FRAME_PATCH frames that may carry two more optional parts: with
+PATCH_AREA the new area follows the turn info, with PATCH_CHUNKS a chunk count and the chunk
+records of the chunks that came into the area follow the removed traps. A chunk record is
+the chunk's coordinates and its cells as a bitset like the maze's, CHUNK_SIZE² bits with
+the cells past the edge of the maze set.
+
+A player record is PLAYER_RECORD.size bytes: uuid, x, y, distance to the goal, RGB colour,
+slots, readiness, command count, MAX_COMMANDS command codes and a zero-padded UTF-8 name.
+A moved record is uuid, x, y and distance.
+"""
+import json
+import struct
+import uuid
+from collections import namedtuple
+from functools import lru_cache
+
+from maze import CHUNK_SIZE
+
+PROTOCOLS = ('json', 'binary')
+
+FRAME_STATE = 1
+FRAME_PATCH = 2
+FRAME_EVENT = 3
+FRAME_VIEW = 4
+
+EVENT_GAME_OVER = 1
+EVENT_NOTIFICATION = 2
+
+MODES = ('unlimited', 'slots', 'turn_based')
+PHASES = (None, 'collecting', 'executing')
+TRAP_KINDS = ('return_to_start', 'swap_positions')
+COMMANDS = ('⬆️', '⬇️', '⬅️', '➡️')
+MAX_COMMANDS = 10
+NAME_BYTES = 32
+
+PATCH_MODE = 1
+PATCH_COMMAND_LIMIT = 2
+PATCH_TURN_INFO = 4
+PATCH_AREA = 8
+PATCH_CHUNKS = 16
+
+STATE_HEADER = struct.Struct('<BIHHHHBB')  # tag, seq, width, height, goal x, goal y, mode, command limit
+PATCH_HEADER = struct.Struct('<BIB')  # tag, seq, flags
+SEQ = struct.Struct('<I')  # The seq right after the tag of both headers
+TURN_INFO = struct.Struct('<B16sB')  # phase, executing player id, executing command index
+COUNTS = struct.Struct('<HHHII')  # players, moved players, removed players, traps, removed traps
+TRAP_RECORD = struct.Struct('<HHB')
+TRAP_POSITION = struct.Struct('<HH')
+MOVED_RECORD = struct.Struct('<16sHHi')
+PLAYER_RECORD = struct.Struct(f'<16sHHi3sBBB{MAX_COMMANDS}s{NAME_BYTES}s')
+AREA = struct.Struct('<HHHH')  # first chunk x, first chunk y, end chunk x, end chunk y
+CHUNKS_HEADER = struct.Struct('<BH')  # chunk size, chunks
+CHUNK_POSITION = struct.Struct('<HH')
+MOVED_FIELDS = {'x', 'y', 'distance'}  # Patched players with only these changes get a moved record
+EVENT_HEADER = struct.Struct('<BB')
+
+# A state broadcast before encoding: `data` is the full state for 'gameState' and the patch
+# for 'statePatch'; `state` is always the full state it brings the client to. States leave
+# the maze out: a full state message takes it from `maze`. An update of a client's view
+# sends `chunks`, the (cx, cy) chunks of `maze` it brings in, instead of the whole maze.
+StateUpdate = namedtuple('StateUpdate', ['kind', 'seq', 'data', 'state', 'maze', 'chunks'], defaults=(None,))
+
+
+def encode_update(update, protocol):
+    if protocol == 'binary':
+        if update.kind == 'gameState':
+            return _encode_binary_state(update) if update.chunks is None else _encode_binary_view(update)
+        return _encode_binary_patch(update)
+    if update.kind == 'gameState':
+        return _encode_json_state(update) if update.chunks is None else _encode_json_view(update)
+    data = update.data
+    if update.chunks:
+        data = {**data, "chunks": _json_chunks(update)}
+    return json.dumps({"type": update.kind, "seq": update.seq, "data": data})
+
+
+def with_seq(message, seq):
+    """
+    An update `message` that encode_update encoded with seq 0, carrying `seq` instead, so
+    clients at different points of their own sequences can share one encoding.
+    """
+    if isinstance(message, bytes):
+        return message[:1] + SEQ.pack(seq) + message[1 + SEQ.size:]
+    end = message.index('"seq": 0') + len('"seq": 0')
+    return f'{message[:end - 1]}{seq}{message[end:]}'
+
+
+def encode_event(event, protocol):
+    if protocol == 'binary':
+        if event.get('type') == 'game_over':
+            return (EVENT_HEADER.pack(FRAME_EVENT, EVENT_GAME_OVER)
+                    + _id_bytes(event['winner_id']) + _color_bytes(event['winner_color']))
+        message = event.get('message', '').encode('utf-8')
+        return EVENT_HEADER.pack(FRAME_EVENT, EVENT_NOTIFICATION) + struct.pack('<H', len(message)) + message
+    return json.dumps({"type": "gameEvent", "data": event})
+
+
+def encode_timeline(steps, start_seconds, step_seconds):
+    """
+    A turn-based round run at once: the clients wait `start_seconds`, then play one step of
+    `steps` (see Game.run_round_timeline) every `step_seconds`.
+    """
+    return json.dumps({
+        "type": "turnTimeline",
+        "data": {"start_seconds": start_seconds, "step_seconds": step_seconds, "steps": steps},
+    })
+
+
+def _encode_json_state(update):
+    # The maze rows are encoded once per maze and spliced in ahead of the rest of the state
+    data = json.dumps(update.data)
+    return f'{{"type": "gameState", "seq": {update.seq}, "data": {{"maze": {update.maze.rows_json()}, {data[1:]}}}'
+
+
+def _encode_json_view(update):
+    data = {"maze_size": [update.maze.width, update.maze.height], "chunk_size": CHUNK_SIZE,
+            "chunks": _json_chunks(update), **update.data}
+    return json.dumps({"type": "gameState", "seq": update.seq, "data": data})
+
+
+def _json_chunks(update):
+    return {f"{cx},{cy}": update.maze.chunk_rows(cx, cy) for cx, cy in update.chunks}
+
+
+def _encode_binary_state(update):
+    state, maze = update.state, update.maze
+    goal_x, goal_y = state['goal']
+    traps = state['traps']
+    players = state['players']
+    parts = [
+        STATE_HEADER.pack(FRAME_STATE, update.seq, maze.width, maze.height, goal_x, goal_y,
+                          MODES.index(state['mode']), state['command_limit']),
+        _turn_info_bytes(state.get('turn_info')),
+        COUNTS.pack(len(players), 0, 0, len(traps), 0),
+        maze.wall_bits(),
+    ]
+    parts.extend(_trap_record(pos, kind) for pos, kind in traps.items())
+    parts.extend(_player_record(player) for player in players.values())
+    return b''.join(parts)
+
+
+def _encode_binary_view(update):
+    state, maze = update.state, update.maze
+    goal_x, goal_y = state['goal']
+    traps = state['traps']
+    players = state['players']
+    parts = [
+        STATE_HEADER.pack(FRAME_VIEW, update.seq, maze.width, maze.height, goal_x, goal_y,
+                          MODES.index(state['mode']), state['command_limit']),
+        _turn_info_bytes(state.get('turn_info')),
+        COUNTS.pack(len(players), 0, 0, len(traps), 0),
+        AREA.pack(*state['area']),
+        CHUNKS_HEADER.pack(CHUNK_SIZE, len(update.chunks)),
+        *_chunk_records(update),
+    ]
+    parts.extend(_trap_record(pos, kind) for pos, kind in traps.items())
+    parts.extend(_player_record(player) for player in players.values())
+    return b''.join(parts)
+
+
+def _chunk_records(update):
+    return (CHUNK_POSITION.pack(cx, cy) + update.maze.chunk_bits(cx, cy) for cx, cy in update.chunks)
+
+
+def _encode_binary_patch(update):
+    patch, state = update.data, update.state
+    flags = 0
+    parts = []
+    if 'mode' in patch:
+        flags |= PATCH_MODE
+        parts.append(bytes([MODES.index(patch['mode'])]))
+    if 'command_limit' in patch:
+        flags |= PATCH_COMMAND_LIMIT
+        parts.append(bytes([patch['command_limit']]))
+    if 'turn_info' in patch:
+        flags |= PATCH_TURN_INFO
+        parts.append(_turn_info_bytes(patch['turn_info']))
+    if 'area' in patch:
+        flags |= PATCH_AREA
+        parts.append(AREA.pack(*patch['area']))
+
+    players = patch.get('players', {})
+    moved = [pid for pid, fields in players.items() if fields.keys() <= MOVED_FIELDS]
+    changed = [pid for pid, fields in players.items() if not fields.keys() <= MOVED_FIELDS]
+    removed = patch.get('removed_players', [])
+    traps = patch.get('traps', {})
+    removed_traps = patch.get('removed_traps', [])
+    parts.append(COUNTS.pack(len(changed), len(moved), len(removed), len(traps), len(removed_traps)))
+    # Changed players are sent as whole records, so take them from the full state
+    parts.extend(_player_record(state['players'][pid]) for pid in changed)
+    for pid in moved:
+        player = state['players'][pid]
+        parts.append(MOVED_RECORD.pack(_id_bytes(pid), player['x'], player['y'], player['distance']))
+    parts.extend(_id_bytes(pid) for pid in removed)
+    parts.extend(_trap_record(pos, kind) for pos, kind in traps.items())
+    parts.extend(TRAP_POSITION.pack(*map(int, pos.split(','))) for pos in removed_traps)
+    if update.chunks:
+        flags |= PATCH_CHUNKS
+        parts.append(struct.pack('<H', len(update.chunks)))
+        parts.extend(_chunk_records(update))
+    return PATCH_HEADER.pack(FRAME_PATCH, update.seq, flags) + b''.join(parts)
+
+
+def _turn_info_bytes(turn_info):
+    if not turn_info:
+        return TURN_INFO.pack(0, bytes(16), 0)
+    executing = turn_info.get('executing_command')
+    if executing:
+        return TURN_INFO.pack(PHASES.index(turn_info.get('phase')),
+                              _id_bytes(executing['player_id']), executing['command_index'])
+    return TURN_INFO.pack(PHASES.index(turn_info.get('phase')), bytes(16), 0)
+
+
+def _trap_record(pos, kind):
+    x, y = pos.split(',')
+    return TRAP_RECORD.pack(int(x), int(y), TRAP_KINDS.index(kind))
+
+
+def _player_record(player):
+    commands = bytes(COMMANDS.index(command) for command in player['commands'][:MAX_COMMANDS])
+    return PLAYER_RECORD.pack(
+        _id_bytes(player['id']), player['x'], player['y'], player['distance'], _color_bytes(player['color']),
+        player['slots'], player['is_ready'], len(commands), commands, _name_bytes(player['name']),
+    )
+
+
+@lru_cache(maxsize=4096)
+def _id_bytes(player_id):
+    return uuid.UUID(player_id).bytes
+
+
+@lru_cache(maxsize=4096)
+def _color_bytes(color):
+    return bytes.fromhex(color.lstrip('#')[:6].rjust(6, '0'))
+
+
+@lru_cache(maxsize=4096)
+def _name_bytes(name):
+    # Truncate on a character boundary so the client never sees half a character
+    encoded = name.encode('utf-8')[:NAME_BYTES]
+    return encoded.decode('utf-8', errors='ignore').encode('utf-8')
+
@@ -0,0 +1,27 @@
+"""
+Token buckets for limiting how fast each client may send messages.
+
+A bucket holds up to `burst` tokens and regains `rate` tokens per second. Each message
+takes one token, and a message that finds the bucket empty is dropped. Nothing runs in
+the background: the refill is worked out from the elapsed time whenever a token is taken.
+"""
+import time
+
+
+class TokenBucket:
+    def __init__(self, burst, rate, clock=time.monotonic):
+        self.burst = burst
+        self.rate = rate
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated_at = clock()
+
+    def take(self):
+        """Takes a token if one is available. Returns False if the caller should be throttled."""
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
@@ -0,0 +1,145 @@
+"""
+Replays a recorded session log (see session_log.py) through the game logic, as fast as the
+CPU allows: no sockets, no broadcasts and none of the live server's pacing sleeps.
+
+The game clock is fed the recorded times, so time-based rules (slot refills) see the same
+times as the live game did. The replayed game records a log of its own. It matches the recorded one entry for entry
+(player ids and the final state digest included) unless the game logic changed, so recorded
+sessions double as regression fixtures:
+
+    python backend/replay.py sessions/default-20260101-120000-42.jsonl
+    python backend/replay.py sessions/*.jsonl --repeat 20 --profile
+"""
+import argparse
+import asyncio
+import cProfile
+import logging
+import pstats
+import sys
+import time
+
+from game import Game
+from maze import generate_maze, maze_layout
+from session_log import SessionLog, load
+
+
+class LoggedMazes:
+    """
+    Stands in for a MazePool: hands out the mazes of a log in order, regenerated from their
+    seeds. `cache` keeps generated mazes across replays of the same log.
+    """
+    def __init__(self, width, height, seeds, cache=None):
+        self.width = width
+        self.height = height
+        self.spawn_points, self.goal_pos = maze_layout(width, height)
+        self.seeds = iter(seeds)
+        self.cache = cache if cache is not None else {}
+
+    def take(self):
+        seed = next(self.seeds, None)
+        if seed is None:
+            return None # More resets than the recording had; the game generates a maze and diverges
+        maze = self.cache.get(seed)
+        if maze is None:
+            maze = self.cache[seed] = generate_maze(self.width, self.height, self.spawn_points, self.goal_pos, seed)
+        return maze
+
+
+async def apply_entry(game, entry):
+    """Takes the step a session log entry recorded, the way the recorded game took it."""
+    kind = entry['type']
+    if kind == 'join':
+        await game.register(entry['name'])
+    elif kind == 'leave':
+        await game.unregister(entry['player_id'])
+    elif kind == 'move':
+        await game.handle_move(entry['player_id'], entry['direction'])
+    elif kind == 'set_mode':
+        game.set_mode(entry['mode_id'], entry['player_id'])
+    elif kind == 'set_command_limit':
+        game.set_command_limit(entry['player_id'], entry['limit'])
+    elif kind == 'remove_command':
+        game.remove_last_command(entry['player_id'])
+    elif kind == 'toggle_ready':
+        game.toggle_player_ready(entry['player_id'])
+    elif kind == 'restart':
+        game.restart()
+    elif kind == 'collect':
+        game.start_collecting()
+    elif kind == 'round':
+        game.start_round()
+    elif kind == 'round_step':
+        game.next_round_step()
+    elif kind == 'round_move':
+        await game.run_round_step()
+    elif kind == 'end':
+        game.close()
+    elif kind != 'maze': # Mazes are handed out by LoggedMazes as the game resets
+        raise ValueError(f"Unknown session log entry: {kind}")
+
+
+async def replay(entries, maze_cache=None):
+    """Re-runs a session log and returns the replayed game and the log it recorded."""
+    if not entries or entries[0]['type'] != 'start':
+        raise ValueError("A session log must start with a 'start' entry")
+    start = entries[0]
+    mazes = LoggedMazes(start['width'], start['height'],
+                        [entry['seed'] for entry in entries if entry['type'] == 'maze'], maze_cache)
+    log = SessionLog()
+    # The replayed game's clock reads the time of the entry it is about to record
+    clock = lambda: round(entries[min(len(log.entries), len(entries) - 1)]['t'] * 1000)
+    game = Game(start['width'], start['height'], start['trap_density'], mazes,
+                seed=start['seed'], log=log, realtime=False, clock=clock)
+    for entry in entries[1:]:
+        await apply_entry(game, entry)
+    return game, log
+
+
+def first_difference(recorded, replayed):
+    """Index of the first entry where two logs differ (ignoring timestamps), or None if they match."""
+    for i, (a, b) in enumerate(zip(recorded, replayed)):
+        if {k: v for k, v in a.items() if k != 't'} != {k: v for k, v in b.items() if k != 't'}:
+            return i
+    if len(recorded) != len(replayed):
+        return min(len(recorded), len(replayed))
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Random Maze sessions")
+    parser.add_argument('logs', nargs='+', help="Session log files written with --record-dir")
+    parser.add_argument('--repeat', type=int, default=1, help="Replay every log this many times")
+    parser.add_argument('--profile', action='store_true', help="Profile the replays and print the hottest functions")
+    parser.add_argument('--verbose', action='store_true', help="Log every replayed action")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    profiler = cProfile.Profile() if args.profile else None
+    failed = False
+    for path in args.logs:
+        entries = load(path)
+        moves = sum(1 for entry in entries if entry['type'] in ('move', 'round_move'))
+        maze_cache = {}
+        asyncio.run(replay(entries, maze_cache)) # Warm-up: fills the maze cache
+        started = time.perf_counter()
+        if profiler: profiler.enable()
+        for _ in range(args.repeat):
+            _, log = asyncio.run(replay(entries, maze_cache))
+        if profiler: profiler.disable()
+        elapsed = (time.perf_counter() - started) / args.repeat
+
+        difference = first_difference(entries, log.entries)
+        if difference is None:
+            verdict = "matches the recording"
+        else:
+            failed = True
+            verdict = f"DIVERGES at entry {difference}"
+        print(f"{path}: {len(entries)} entries, {moves} moves in {elapsed * 1000:.1f} ms "
+              f"({len(entries) / elapsed:,.0f} entries/s), {verdict}")
+
+    if profiler:
+        pstats.Stats(profiler).sort_stats('tottime').print_stats(15)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,537 +1,778 @@
+import argparse
 import asyncio
+import collections
+import functools
+import inspect
 import json
-import random
-from uuid import uuid4
+import logging
+import os
+import re
+import sys
+import time
 from aiohttp import web
 import pathlib
 
-# --- Game Configuration ---
-WIDTH, HEIGHT = 25, 25  # Должны быть нечетными
-PLAYER_COLORS = ["#FF0000", "#0000FF", "#00FF00", "#FFFF00", "#FF00FF", "#00FFFF"]
-GAME_MODES = {
-    '1': 'unlimited',
-    '2': 'slots',
-    '3': 'turn_based'
-}
-DIRECTION_MAP = {
-    '⬆️': 'up',
-    '⬇️': 'down',
-    '⬅️': 'left',
-    '➡️': 'right'
-}
-
-# --- Game State Class ---
-class Game:
-    def __init__(self):
-        self.players = {}
-        self.maze = []
-        self.spawn_points = [
-            (1, 1),
-            (WIDTH - 2, 1),
-            (1, HEIGHT - 2),
-            (WIDTH - 2, HEIGHT - 2)
-        ]
-        self.goal_pos = (WIDTH // 2, HEIGHT // 2)
-        self.traps = {}
-        self.game_mode = 'unlimited'
-        self.command_limit = 5 # Default command limit for turn-based
-        self.game_loop_task = None
-        self.used_colors = set()
-        self.turn_info = {}
-        self.app = None # Will hold a reference to the web app
-        self.reset_game()
-
-    def reset_game(self):
-        print(f"--- RESETTING GAME (mode: {self.game_mode}) ---")
-        self.maze = self.generate_maze(WIDTH, HEIGHT)
-        self.traps = self.place_traps(5)
-        
-        if self.game_loop_task:
-            self.game_loop_task.cancel()
-            self.game_loop_task = None # Ensure task is cleared
-
-        # Reset all existing players' states instead of rebuilding the dict
-        player_list = list(self.players.values())
-        for i, player in enumerate(player_list):
-            # Find a spawn point for the player
-            spawn_point = self.spawn_points[i % len(self.spawn_points)]
-            player.x, player.y = spawn_point
-            player.start_x, player.start_y = spawn_point
-            player.slots = 5
-            self.reset_player_turn_state(player)
-
-        if self.game_mode == 'slots':
-            self.game_loop_task = asyncio.create_task(self.slots_regenerator())
-        elif self.game_mode == 'turn_based':
-            self.game_loop_task = asyncio.create_task(self.turn_based_loop())
-
-    def reset_player_turn_state(self, player):
-        player.commands = []
-        player.is_ready = False
-
-    def set_mode(self, mode_id, player_id):
-        player = self.players.get(player_id)
-        if not player or player.name.lower() != 'admin':
-            print(f"--- Unauthorized mode change attempt by {player.name if player else 'Unknown'} ---")
-            return False, "Только админ может менять режим игры."
-
-        new_mode = GAME_MODES.get(mode_id)
-        if new_mode and new_mode != self.game_mode:
-            self.game_mode = new_mode
-            self.reset_game()
-            return True, f"Режим изменен на '{new_mode}' админом."
-        return False, "Режим не изменен."
-
-    def generate_maze(self, width, height):
-        # Kruskal's algorithm for maze generation with a Disjoint Set Union (DSU) data structure
-        
-        # DSU maps each cell to its parent, creating sets of connected cells.
-        # Cells are represented by (x, y) tuples.
-        parent = {(x, y): (x, y) for y in range(1, height, 2) for x in range(1, width, 2)}
-
-        def find(cell):
-            if parent[cell] == cell:
-                return cell
-            # Path compression for efficiency
-            parent[cell] = find(parent[cell])
-            return parent[cell]
-
-        def union(cell1, cell2):
-            root1 = find(cell1)
-            root2 = find(cell2)
-            if root1 != root2:
-                parent[root2] = root1
-                return True
+from game import (GAME_MODES, HEIGHT, TRAP_COUNT, TURN_EXECUTIONS, TURN_PACING, WIDTH, WIN_PAUSE, Game, GameSink,
+                  TurnPacing, check_maze_size)
+from interest import VIEW_RADIUS, View, needs_view
+from maze import new_seed
+from maze_pool import MAZE_POOL_DEPTH, MAZE_POOL_EXECUTORS, MazePool
+from metrics import REGISTRY, Counter, Gauge, Histogram, render
+from protocol import PROTOCOLS, encode_event, encode_timeline, encode_update
+from rate_limit import TokenBucket
+from session_log import SessionLog
+from snapshot import RESUME_GRACE, SNAPSHOT_INTERVAL, SnapshotStore
+
+# --- Server Configuration ---
+DEFAULT_ROOM = 'default'
+ROOM_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,32}$')
+OUTBOX_LIMIT = 64  # Max queued outbound messages per connection
+OUTBOX_OVERFLOW_POLICIES = ('coalesce', 'disconnect')
+MAX_TICK_RATE = 1000
+RATE_LIMIT = 20  # Messages per second a client may keep sending, 0 for no limit
+RATE_LIMIT_BURST = 40  # Messages a client may send at once before the rate applies
+MESSAGE_TYPES = ('join', 'move', 'resync', 'set_mode', 'remove_command', 'toggle_ready', 'set_command_limit', 'hint',
+                 'viewport')
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+FRONTEND_DIR = pathlib.Path(__file__).parent.parent / 'frontend'
+
+logger = logging.getLogger('server')
+
+# --- Metrics ---
+MESSAGES = Counter('maze_messages_received_total', "Messages received from clients, by type", ['type'])
+THROTTLED = Counter('maze_messages_throttled_total', "Messages dropped by the per-connection rate limit")
+HANDLER_SECONDS = Histogram('maze_handler_seconds', "Time to handle one client message, by type", ['type'])
+BROADCAST_BYTES = Histogram('maze_broadcast_bytes', "Size of one encoded broadcast message", ['kind', 'protocol'],
+                            buckets=(64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+VIEW_BYTES = Histogram('maze_view_update_bytes', "Size of one client's view update (see interest.py)",
+                       ['kind', 'protocol'], buckets=(64, 256, 1024, 4096, 16384, 65536, 262144))
+BROADCAST_SECONDS = Histogram('maze_broadcast_seconds', "Time to encode a broadcast and queue it for every client",
+                              ['kind'])
+CONNECTED_CLIENTS = Gauge('maze_connected_clients', "Connected WebSocket clients")
+PLAYERS = Gauge('maze_players', "Players, by the game mode of their room", ['mode'])
+ROOMS = Gauge('maze_rooms', "Open rooms")
+
+# --- Outbound Queues ---
+class ClientConnection:
+    """
+    Outbound side of a single WebSocket: a bounded queue drained by a dedicated sender task,
+    so a slow client only ever delays itself.
+
+    Overflow policies:
+    * 'coalesce'   - queued state messages are dropped and replaced by one full-state resync,
+                     which is rendered from the latest state when it is actually sent.
+    * 'disconnect' - the client is considered too far behind and its socket is closed.
+    """
+    STATE = 'state'
+    RESYNC = 'resync'
+    OTHER = 'other'
+
+    def __init__(self, ws, game, limit=OUTBOX_LIMIT, overflow='coalesce'):
+        if overflow not in OUTBOX_OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        self.ws = ws
+        self.game = game # Renders the full state of a resync: the room's game, or the client's View
+        self.player = None
+        self.spectator = False # Joined to watch: receives the broadcasts but has no player
+        self.protocol = 'json' # Negotiated on join
+        self.limit = limit
+        self.overflow = overflow
+        self.queue = collections.deque()
+        self.resync_queued = False
+        self.dropped = 0
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._sender_task = asyncio.create_task(self._sender())
+        self._close_tasks = set() # The event loop only keeps weak references to tasks
+
+    def send(self, message, kind=OTHER):
+        """Queues a message and returns immediately."""
+        if self.closed:
+            return
+        if kind != self.OTHER and self.resync_queued:
+            # The pending resync is rendered at send time and already covers this message
+            self.dropped += 1
+            return
+        if len(self.queue) >= self.limit and not self._handle_overflow(kind):
+            return
+        if kind == self.RESYNC:
+            self.resync_queued = True
+        self.queue.append((kind, message))
+        self._wakeup.set()
+
+    def _handle_overflow(self, kind):
+        """Makes room in the queue. Returns False if the incoming message should not be queued."""
+        if self.overflow == 'disconnect':
+            logger.warning("Client fell %d messages behind, disconnecting", len(self.queue))
+            self.close()
+            task = asyncio.create_task(self.ws.close(code=1008, message=b'Too far behind'))
+            self._close_tasks.add(task)
+            task.add_done_callback(self._socket_closed)
             return False
 
-        # 1. Start with a grid full of walls.
-        maze = [['#'] * width for _ in range(height)]
-        
-        # 2. Create a list of all interior walls that could be removed.
-        walls = []
-        for y in range(1, height - 1):
-            for x in range(1, width - 1):
-                if x % 2 == 1 and y % 2 == 0:  # Horizontal wall between (x, y-1) and (x, y+1)
-                    walls.append(((x, y), (x, y - 1), (x, y + 1)))
-                elif x % 2 == 0 and y % 2 == 1:  # Vertical wall between (x-1, y) and (x+1, y)
-                    walls.append(((x, y), (x - 1, y), (x + 1, y)))
-        
-        random.shuffle(walls)
-
-        # 3. Connect cells by removing walls.
-        for wall_pos, cell1, cell2 in walls:
-            # If the cells separated by this wall are not already connected...
-            if find(cell1) != find(cell2):
-                # ...connect them and remove the wall.
-                union(cell1, cell2)
-                maze[wall_pos[1]][wall_pos[0]] = ' '
-                # Also clear the cell spaces themselves (they start as unknown).
-                maze[cell1[1]][cell1[0]] = ' '
-                maze[cell2[1]][cell2[0]] = ' '
-
-        # Ensure all cell spaces are clear, as a final pass.
-        for cell in parent:
-            maze[cell[1]][cell[0]] = ' '
-
-        # 4. Make the maze more spacious by removing a percentage of the remaining walls.
-        possible_walls_to_remove = []
-        for y in range(1, height - 1):
-            for x in range(1, width - 1):
-                # A wall is a candidate for removal if it's an interior wall.
-                if maze[y][x] == '#':
-                    # Check for horizontal walls separating two passages
-                    if maze[y][x - 1] == ' ' and maze[y][x + 1] == ' ':
-                        possible_walls_to_remove.append((x, y))
-                    # Check for vertical walls separating two passages
-                    elif maze[y - 1][x] == ' ' and maze[y + 1][x] == ' ':
-                        possible_walls_to_remove.append((x, y))
-        
-        random.shuffle(possible_walls_to_remove)
-        walls_to_remove_count = int(len(possible_walls_to_remove) * 0.20)
-        
-        for i in range(walls_to_remove_count):
-            x, y = possible_walls_to_remove[i]
-            maze[y][x] = ' '
-            
-        # Ensure spawn points and goal are not walls
-        for x, y in self.spawn_points:
-            if maze[y][x] == '#':
-                maze[y][x] = ' '
-        maze[self.goal_pos[1]][self.goal_pos[0]] = 'G'
-
-        return maze
-
-    def place_traps(self, count):
-        traps = {}
-        empty_tiles = [
-            (x, y) for y in range(HEIGHT) for x in range(WIDTH) 
-            if self.maze[y][x] == ' ' and (x, y) not in self.spawn_points and (x, y) != self.goal_pos
-        ]
-        for _ in range(count):
-            if not empty_tiles: break
-            x, y = random.choice(empty_tiles)
-            empty_tiles.remove((x, y))
-            trap_type = random.choice(['return_to_start', 'swap_positions'])
-            traps[f"{x},{y}"] = trap_type
-        return traps
-
-    def get_state(self):
+        kept = collections.deque(item for item in self.queue if item[0] == self.OTHER)
+        self.dropped += len(self.queue) - len(kept)
+        if len(kept) >= self.limit:
+            kept.popleft()
+            self.dropped += 1
+        kept.append((self.RESYNC, None))
+        self.queue = kept
+        self.resync_queued = True
+        self._wakeup.set()
+        # A state message is covered by the resync, anything else still needs a free slot
+        return kind == self.OTHER and len(self.queue) < self.limit
+
+    async def _sender(self):
+        try:
+            while True:
+                while not self.queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                kind, message = self.queue.popleft()
+                if kind == self.RESYNC:
+                    message = self.game.full_state_message(self.protocol)
+                    if inspect.isawaitable(message):
+                        message = await message # On an edge process, the room's owner renders it
+                    # Cleared only now: state messages queued meanwhile are older than the resync
+                    self.resync_queued = False
+                    if message is None:
+                        continue
+                if isinstance(message, bytes):
+                    await self.ws.send_bytes(message)
+                else:
+                    await self.ws.send_str(message)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.warning("Failed to send to client: %s", e)
+            # The socket first: close() cancels this very task, which would cut the close short
+            try:
+                await self.ws.close()
+            finally:
+                self.close()
+
+    def _socket_closed(self, task):
+        self._close_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Failed to close a client that fell behind: %s", task.exception())
+
+    def set_view(self, view):
+        """The client sees only `view` of its room, so resyncs render that."""
+        self.game = view
+
+    def close(self):
+        """Stops the sender task. Closing the socket itself is up to the caller."""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self._sender_task.cancel()
+
+
+# --- Rooms ---
+class Room(GameSink):
+    """
+    A single game together with the connections playing in it. Broadcasts what the game publishes.
+    `relay` forwards the broadcasts to clients connected through edge processes (see fanout.py).
+    Clients with a View of their own (see interest.py) are kept apart, in `views`: they get
+    their own state updates, and the other broadcasts like everyone else.
+    """
+    def __init__(self, room_id, game, relay=None):
+        self.id = room_id
+        self.game = game
+        self.websockets = {} # Maps ws to its ClientConnection
+        self.views = {} # Maps a client's connection, local or remote, to its View
+        self.relay = relay
+        self.created_at = time.time()
+        self.awaiting = set() # Ids of restored players whose clients have not resumed them yet
+        game.sink = self
+
+    async def publish_state(self):
+        await broadcast_state(self)
+
+    async def publish_event(self, event):
+        await broadcast_event(self, event)
+
+    async def publish_timeline(self, steps, pacing):
+        await broadcast_timeline(self, steps, pacing)
+
+    def connections(self):
+        """Clients receiving the room's broadcasts, here or on edge processes."""
+        return len(self.websockets) + len(self.views) + (self.relay.connections(self.id) if self.relay else 0)
+
+    def stats(self):
         return {
-            "maze": self.maze,
-            "players": {pid: p.to_dict() for pid, p in self.players.items()},
-            "goal": self.goal_pos,
-            "traps": self.traps,
-            "mode": self.game_mode,
-            "command_limit": self.command_limit
+            "players": len(self.game.players),
+            "connections": self.connections(),
+            "mode": self.game.game_mode,
+            "maze_size": [self.game.width, self.game.height],
+            "created_at": self.created_at,
+            **({"tick": self.game.tick_stats()} if self.game.tick_rate else {}),
         }
 
-    async def register(self, name):
-        player_id = str(uuid4())
+    def close(self):
+        self.game.close()
+
+
+class RoomRegistry:
+    """
+    Creates a room on its first connection and tears it down when the last one leaves.
+    `on_change` is called with the registry after every room lifecycle change. With a
+    SnapshotStore, rooms survive a restart: `restore` brings them back, and their players
+    wait `resume_grace` seconds for their clients to resume them.
+    """
+    def __init__(self, width=WIDTH, height=HEIGHT, trap_density=None, on_change=None, maze_pool=None,
+                 record_dir=None, tick_rate=0, turn_pacing=TURN_PACING, turn_execution='stepwise',
+                 snapshots=None, resume_grace=RESUME_GRACE, relay=None):
+        self.width = width
+        self.height = height
+        self.trap_density = trap_density
+        self.maze_pool = maze_pool
+        self.record_dir = record_dir # Directory for session logs, None to record nothing
+        self.tick_rate = tick_rate
+        self.turn_pacing = turn_pacing
+        self.turn_execution = turn_execution
+        self.snapshots = snapshots
+        self.resume_grace = resume_grace
+        self.relay = relay # Set by the owner process of an edge fan-out, see fanout.py
+        self.closing = False # Set on shutdown, when rooms go away but their snapshots must stay
+        self.rooms = {}
+        self.on_change = on_change
+
+    def join(self, room_id):
+        room = self.rooms.get(room_id)
+        if room is None:
+            seed = new_seed()
+            log = SessionLog.in_directory(self.record_dir, room_id, seed) if self.record_dir else None
+            room = Room(room_id, Game(
+                self.width, self.height, self.trap_density, self.maze_pool, seed, log, tick_rate=self.tick_rate,
+                turn_pacing=self.turn_pacing, turn_execution=self.turn_execution
+            ), self.relay)
+            self.rooms[room_id] = room
+            if self.snapshots:
+                self.snapshots.attach(room_id, room.game)
+            logger.info("Room '%s' created. Total rooms: %d", room_id, len(self.rooms))
+        return room
+
+    def leave(self, room):
+        if not room.connections() and not room.awaiting and self.rooms.get(room.id) is room:
+            if self.snapshots and not self.closing:
+                self.snapshots.delete(room.id, room.game)
+            room.close()
+            del self.rooms[room.id]
+            logger.info("Room '%s' torn down. Total rooms: %d", room.id, len(self.rooms))
+        self.changed()
+
+    async def restore(self):
+        """Brings back the rooms of the snapshot directory, as they were when the server stopped."""
+        for room_id in self.snapshots.room_ids():
+            started = time.perf_counter()
+            try:
+                game = await self.snapshots.restore(room_id, self.maze_pool, tick_rate=self.tick_rate,
+                                                    turn_pacing=self.turn_pacing, turn_execution=self.turn_execution)
+            except Exception:
+                logger.exception("Could not restore room '%s', dropping its snapshot", room_id)
+                game = None
+            if game is None:
+                self.snapshots.delete(room_id)
+                continue
+            room = Room(room_id, game, self.relay)
+            room.awaiting = set(game.players)
+            self.rooms[room_id] = room
+            self.snapshots.attach(room_id, game)
+            game.start_game_loop(resume=True)
+            asyncio.create_task(self.release_unclaimed(room))
+            logger.info("Room '%s' restored with %d players in %.1f ms", room_id, len(game.players),
+                        (time.perf_counter() - started) * 1000)
+        self.changed()
+
+    def resume(self, room, resume):
+        """The restored player a join message's `resume` field ({id, token}) reclaims, or None."""
+        if not self.snapshots or not isinstance(resume, dict):
+            return None
+        player_id = resume.get('id')
+        if player_id not in room.awaiting or not self.snapshots.check_resume_token(room.id, player_id, resume.get('token')):
+            return None
+        room.awaiting.discard(player_id)
+        return room.game.players.get(player_id)
+
+    async def release_unclaimed(self, room):
+        """Removes the restored players that nobody resumed within the grace period."""
+        await asyncio.sleep(self.resume_grace)
+        if self.rooms.get(room.id) is not room:
+            return
+        if room.awaiting:
+            logger.info("Releasing %d unclaimed players of room '%s'", len(room.awaiting), room.id)
+            for player_id in list(room.awaiting):
+                room.awaiting.discard(player_id)
+                await room.game.unregister(player_id)
+            await broadcast_state(room)
+        self.leave(room) # Tears the room down if nobody came back at all
+
+    def changed(self):
+        if self.on_change:
+            self.on_change(self)
+
+    def stats(self):
+        return {room_id: room.stats() for room_id, room in self.rooms.items()}
 
-        available_colors = [c for c in PLAYER_COLORS if c not in self.used_colors]
-        if available_colors:
-            color = random.choice(available_colors)
-        else:
-            color = f"#{random.randint(0, 0xFFFFFF):06x}"
-        
-        # Cycle through spawn points for new players
-        spawn_point = self.spawn_points[len(self.players) % len(self.spawn_points)]
-        
-        player = Player(player_id, spawn_point[0], spawn_point[1], color, name)
-        self.players[player_id] = player
-        self.used_colors.add(color)
-        print(f"Player {player_id} ({name}) created at {spawn_point} with color {color}. Total players: {len(self.players)}")
-        return player
-
-    async def unregister(self, player_id):
-        if player_id in self.players:
-            player_color = self.players[player_id].color
-            self.used_colors.discard(player_color)
-            del self.players[player_id]
-            print(f"Player {player_id} disconnected. Total players: {len(self.players)}")
-
-    def is_wall(self, x, y):
-        return self.maze[y][x] == '#'
-
-    def execute_global_move(self, direction):
-        """Moves all players in the specified direction."""
-        mapped_direction = DIRECTION_MAP.get(direction, direction)
-        dx, dy = 0, 0
-        if mapped_direction == 'up': dy = -1
-        elif mapped_direction == 'down': dy = 1
-        elif mapped_direction == 'left': dx = -1
-        elif mapped_direction == 'right': dx = 1
-
-        # --- Player Collision Logic ---
-        # 1. Propose move for each player
-        proposed_moves = {}
-        for p in self.players.values():
-            new_x, new_y = p.x + dx, p.y + dy
-            if not self.is_wall(new_x, new_y):
-                proposed_moves[p.id] = (new_x, new_y)
-            else:
-                # If wall, they intend to stay in place
-                proposed_moves[p.id] = (p.x, p.y)
-
-        # 2. Find colliding moves (multiple players aiming for the same tile)
-        target_counts = {}
-        for pos in proposed_moves.values():
-            target_counts[pos] = target_counts.get(pos, 0) + 1
-        
-        colliding_targets = {pos for pos, count in target_counts.items() if count > 1}
-
-        # 3. Execute non-colliding moves
-        for p in self.players.values():
-            target_pos = proposed_moves[p.id]
-            if target_pos not in colliding_targets:
-                p.x, p.y = target_pos
-        # --- End Collision Logic ---
-
-
-    async def handle_move(self, player_id, direction):
-        player = self.players.get(player_id)
-        if not player: return
-        print(f"[Move Attempt] Player {player_id} -> {direction} in '{self.game_mode}' mode")
-
-        # Game mode specific move validation
-        if self.game_mode == 'slots' and player.slots <= 0:
-            print(f"[Move Rejected] Player {player_id} has no slots.")
-            return [] # Return empty list of events
-        if self.game_mode == 'turn_based':
-            if len(player.commands) < self.command_limit:
-                if direction in DIRECTION_MAP:
-                    player.commands.append(direction)
-                    print(f"[Command Added] Player {player_id} added '{direction}'. Commands: {player.commands}")
-            else:
-                print(f"[Command Rejected] Player {player_id} command list is full.")
-            return [] # Don't move immediately
-
-        if self.game_mode == 'slots':
-            player.slots -= 1
-
-        # This is the core logic change: one move affects ALL players.
-        self.execute_global_move(direction)
-        
-        # After the global move, check events for all players.
-        events = []
-        # Iterate over a copy of player IDs in case a trap removes a player
-        for p_id in list(self.players.keys()):
-            p = self.players.get(p_id)
-            if p:
-                event = await self.check_game_events(p)
-                if event:
-                    events.append(event)
-                    # If a player wins, stop checking for other events
-                    if event.get('type') == 'game_over':
-                        break
-        return events
-
-    async def check_game_events(self, player):
-        pos_key = f"{player.x},{player.y}"
-        
-        # Check for win
-        if (player.x, player.y) == self.goal_pos:
-            return {
-                'type': 'game_over',
-                'winner_id': player.id,
-                'winner_color': player.color
-            }
-        
-        # Check for traps
-        if pos_key in self.traps:
-            trap_type = self.traps[pos_key]
-            del self.traps[pos_key] # Trap disappears after use
-            if trap_type == 'return_to_start':
-                player.x, player.y = player.start_x, player.start_y
-            elif trap_type == 'swap_positions':
-                positions = [(p.x, p.y) for p in self.players.values()]
-                random.shuffle(positions)
-                for i, p in enumerate(self.players.values()):
-                    p.x, p.y = positions[i]
-            return {
-                'type': 'notification',
-                'message': f'Player {player.id[:4]}... activated a "{trap_type.replace("_", " ")}" trap!'
-            }
-        return None
-
-    def remove_last_command(self, player_id):
-        player = self.players.get(player_id)
-        if player and self.game_mode == 'turn_based' and player.commands:
-            player.commands.pop()
-            print(f"Player {player_id} removed last command. Commands: {player.commands}")
-
-    def toggle_player_ready(self, player_id):
-        player = self.players.get(player_id)
-        if player and self.game_mode == 'turn_based':
-            player.is_ready = not player.is_ready
-            print(f"Player {player.id} readiness set to {player.is_ready}")
-
-    # --- Game Mode Coroutines ---
-    async def slots_regenerator(self):
-        while True:
-            await asyncio.sleep(1)
-            for player in self.players.values():
-                if player.slots < 5:
-                    player.slots += 1
-
-    async def turn_based_loop(self):
-        while self.game_mode == 'turn_based':
-            # Phase 1: Collect commands
-            self.turn_info = {'phase': 'collecting', 'executing_command': None}
-            for p in self.players.values(): self.reset_player_turn_state(p)
-            await broadcast_state(self.app)
-
-            # Wait for all players to be ready
-            while not (self.players and all(p.is_ready for p in self.players.values())):
-                await asyncio.sleep(0.5)
-                if self.game_mode != 'turn_based': return
-
-            # Phase 2: Execute commands
-            self.turn_info['phase'] = 'executing'
-            await broadcast_state(self.app)
-            await asyncio.sleep(1) # Brief pause before execution starts
-
-            # Get a fixed order of players for this execution round
-            player_order = sorted(list(self.players.values()), key=lambda p: p.name.lower())
-            game_over = False
-
-            for i in range(self.command_limit):
-                for player in player_order:
-                    if i < len(player.commands):
-                        direction = player.commands[i]
-                        
-                        # Set current executing command for UI feedback
-                        self.turn_info['executing_command'] = {'player_id': player.id, 'command_index': i}
-                        await broadcast_state(self.app)
-                        await asyncio.sleep(0.4)
-
-                        self.execute_global_move(direction)
-                        
-                        # Check events for all players
-                        for p_check in player_order:
-                            event = await self.check_game_events(p_check)
-                            if event:
-                                await broadcast_event(self.app, event)
-                                if event.get('type') == 'game_over':
-                                    self.reset_game()
-                                    game_over = True
-                                    break
-                        
-                        await broadcast_state(self.app)
-                        if game_over: break
-                        await asyncio.sleep(0.4)
-                    if game_over: break
-                if game_over: break
-            
-            if game_over:
-                await asyncio.sleep(3) # Show winner
-            
-            if self.game_mode != 'turn_based': return
-            
-            # Loop back to collecting phase immediately
-
-
-class Player:
-    def __init__(self, id, x, y, color, name="Anonymous"):
-        self.id = id
-        self.name = name
-        self.start_x = x
-        self.start_y = y
-        self.x = x
-        self.y = y
-        self.color = color
-        self.slots = 5
-        self.commands = []
-        self.is_ready = False
-
-    def to_dict(self):
-        return {
-            "name": self.name,
-            "id": self.id,
-            "x": self.x, "y": self.y, "color": self.color, 
-            "slots": self.slots, "commands": self.commands,
-            "is_ready": self.is_ready
-        }
 
 # --- WebSocket Handling ---
-game = Game()
-
-async def broadcast_state(app):
-    if not app['websockets']: return
-    state = game.get_state()
-    if game.game_mode == 'turn_based':
-        state['turn_info'] = game.turn_info
-    message = json.dumps({"type": "gameState", "data": state})
-    print(f"📢 Broadcasting state ({len(message)} bytes) to {len(app['websockets'])} clients.")
-    for ws in app['websockets']:
-        await ws.send_str(message)
-
-async def broadcast_event(app, event):
-    if not app['websockets']: return
-    message = json.dumps({"type": "gameEvent", "data": event})
-    print(f"📢 Broadcasting event ({len(message)} bytes) to {len(app['websockets'])} clients.")
-    for ws in app['websockets']:
-        await ws.send_str(message)
+def fan_out(room, encode, kind=ClientConnection.OTHER):
+    """
+    Queues a broadcast for every client of a room, local or on an edge process. `encode`
+    turns a protocol into the message; it is called once per protocol in use. Returns the
+    messages by protocol.
+    """
+    messages = {}
+    def message(protocol):
+        encoded = messages.get(protocol)
+        if encoded is None:
+            encoded = messages[protocol] = encode(protocol)
+        return encoded
+    for conn in room.websockets.values():
+        conn.send(message(conn.protocol), kind)
+    if kind != ClientConnection.STATE:
+        for conn in room.views: # Their state updates are their own, see send_views
+            conn.send(message(conn.protocol), kind)
+    if room.relay:
+        for protocol in room.relay.protocols(room.id):
+            room.relay.publish(room.id, protocol, message(protocol), kind)
+    return messages
+
+async def broadcast_state(room):
+    update = room.game.next_state_update()
+    if update is None or not room.connections(): return
+    started = time.perf_counter()
+    # Each protocol's encoding is built once and shared by all its clients
+    messages = fan_out(room, functools.partial(encode_update, update), ClientConnection.STATE)
+    send_views(room)
+    record_broadcast(room, update.kind, messages, started)
+
+def send_views(room):
+    """Sends every client with a View its own update, if anything it sees changed."""
+    for conn, view in room.views.items():
+        send_view(conn, view)
+
+def send_view(conn, view):
+    update = view.next_update()
+    if update is not None:
+        message = view.game.area_message(update, conn.protocol)
+        VIEW_BYTES.observe(len(message), update.kind, conn.protocol)
+        conn.send(message, ClientConnection.STATE)
+
+async def broadcast_timeline(room, steps, pacing):
+    if not room.connections(): return
+    started = time.perf_counter()
+    message = encode_timeline(steps, pacing.start, pacing.step)
+    fan_out(room, lambda protocol: message) # JSON in both protocols
+    record_broadcast(room, 'turnTimeline', {'json': message}, started)
+
+async def broadcast_event(room, event):
+    if not room.connections(): return
+    started = time.perf_counter()
+    messages = fan_out(room, functools.partial(encode_event, event))
+    record_broadcast(room, 'gameEvent', messages, started)
+
+def record_broadcast(room, kind, messages, started):
+    BROADCAST_SECONDS.observe(time.perf_counter() - started, kind)
+    for protocol, message in messages.items():
+        BROADCAST_BYTES.observe(len(message), kind, protocol)
+    if logger.isEnabledFor(logging.DEBUG):
+        sizes = ', '.join(f"{protocol} {len(message)} bytes" for protocol, message in messages.items())
+        logger.debug("Broadcasting %s (%s) to %d clients in '%s'", kind, sizes, room.connections(), room.id)
 
 async def websocket_handler(request):
+    room_id = request.query.get('room', DEFAULT_ROOM)
+    if not ROOM_ID_PATTERN.match(room_id):
+        raise web.HTTPBadRequest(text="Invalid room id")
+
     ws = web.WebSocketResponse()
     await ws.prepare(request)
     
     app = request.app
-    player = None
+    room = app['rooms'].join(room_id)
+    conn = ClientConnection(ws, room.game, app['outbox_limit'], app['outbox_overflow'])
+    limiter = TokenBucket(app['rate_limit_burst'], app['rate_limit']) if app['rate_limit'] else None
     
     try:
         async for msg in ws:
             if msg.type == web.WSMsgType.TEXT:
-                data = json.loads(msg.data)
-                
-                if player is None:
-                    if data.get('type') == 'join':
-                        name = data.get('name', 'Anonymous')
-                        player = await game.register(name)
-                        app['websockets'][ws] = player
-                        
-                        print(f"🤝 Welcoming player {player.id} ({player.name})")
-                        await ws.send_str(json.dumps({"type": "welcome", "id": player.id}))
-                        await broadcast_state(app)
+                if limiter and not limiter.take():
+                    # Dropped before parsing, so a flooding client costs as little as possible
+                    THROTTLED.inc()
+                    logger.debug("Throttled a message from %s", conn.player.id if conn.player else "a connecting player")
                     continue
-
-                print(f"⬇️ Received message from {player.id}: {msg.data}")
-                
-                if data['type'] == 'move':
-                    # handle_move now returns a list of events
-                    events = await game.handle_move(player.id, data['direction'])
-                    await broadcast_state(app)
-                    for event in events:
-                        await broadcast_event(app, event)
-                        if event.get('type') == 'game_over':
-                            game.reset_game()
-                            await asyncio.sleep(2)
-                            await broadcast_state(app)
-
-                elif data['type'] == 'set_mode':
-                    print(f"🔄 Player {player.id} ({player.name}) requested mode change to {data['mode_id']}")
-                    success, message = game.set_mode(data['mode_id'], player.id)
-                    if success:
-                        await broadcast_state(app)
-                    # Optionally, send a notification back to the admin or all players
-                    await broadcast_event(app, {'type': 'notification', 'message': message})
-
-                elif data['type'] == 'remove_command':
-                    game.remove_last_command(player.id)
-                    await broadcast_state(app)
-                
-                elif data['type'] == 'toggle_ready':
-                    game.toggle_player_ready(player.id)
-                    await broadcast_state(app)
-
-                elif data['type'] == 'set_command_limit':
-                    new_limit = data.get('limit')
-                    if player.name.lower() == 'admin' and isinstance(new_limit, int) and 1 <= new_limit <= 10:
-                        game.command_limit = new_limit
-                        print(f"Admin {player.id} set command limit to {new_limit}")
-                        await broadcast_state(app)
+                await client_message(app, room, conn, json.loads(msg.data),
+                                     functools.partial(room.websockets.__setitem__, ws, conn))
 
             elif msg.type == web.WSMsgType.ERROR:
-                print(f'ws connection closed with exception {ws.exception()}')
+                logger.warning("WebSocket connection closed with exception %s", ws.exception())
 
     except Exception as e:
-        if player:
-            print(f"An error occurred with player {player.id} ({player.name}): {e}")
-        else:
-            print(f"An error occurred with a connecting player: {e}")
+        log_client_error(conn, e)
     finally:
-        if player:
-            print(f"🔌 Connection closed for player {player.id} ({player.name})")
-            if ws in app['websockets']:
-                del app['websockets'][ws]
-            await game.unregister(player.id)
-            await broadcast_state(app)
+        conn.close()
+        room.websockets.pop(ws, None)
+        await client_left(app, room, conn)
         
     return ws
 
-async def on_shutdown(app):
-    if game.game_loop_task:
-        game.game_loop_task.cancel()
-    for ws in list(app['websockets'].keys()):
-        await ws.close(code=1001, message='Server shutdown')
+def log_client_error(conn, error):
+    if conn.player:
+        logger.exception("An error occurred with player %s (%s): %s", conn.player.id, conn.player.name, error)
+    else:
+        logger.exception("An error occurred with a connecting player: %s", error)
+
+async def client_message(app, room, conn, data, subscribe):
+    """
+    Handles one message from a client of `room`, whichever process its socket is on. `conn`
+    is its outbound side: a ClientConnection, or an edge client in the owner process.
+    `subscribe` adds it to the room's broadcasts once it has joined.
+    """
+    game = room.game
+    msg_type = data.get('type') if data.get('type') in MESSAGE_TYPES else 'unknown'
+    MESSAGES.inc(msg_type)
+    started = time.perf_counter()
+    try:
+        if game.move_queue and msg_type != 'move':
+            # Anything else waits for the moves that arrived before it, as if they had been applied at once
+            await game.run_tick()
+
+        player = conn.player
+        if player is None:
+            if data.get('type') == 'join' and not conn.spectator:
+                await join_player(app, room, conn, data, subscribe)
+            elif data.get('type') == 'resync' and conn.spectator:
+                # A spectator's broadcasts have gaps too
+                conn.send(None, ClientConnection.RESYNC)
+            elif data.get('type') == 'viewport':
+                # A spectator with a View looks at another part of the maze
+                view = room.views.get(conn)
+                if view is not None and view.set_viewport(data.get('viewport')):
+                    send_view(conn, view)
+            return
+
+        logger.debug("Received message from %s: %s", player.id, data)
+
+        if data['type'] == 'move' and game.ticking():
+            ack = None
+            if 'ref' in data:
+                ack = functools.partial(conn.send, json.dumps({"type": "ack", "ref": data['ref']}))
+            game.queue_move(player.id, data['direction'], ack)
+
+        elif data['type'] == 'move':
+            # handle_move now returns a list of events
+            events = await game.handle_move(player.id, data['direction'])
+            await broadcast_state(room)
+            if 'ref' in data:
+                # Queued right behind this move's state update, so the sender can time the broadcast
+                conn.send(json.dumps({"type": "ack", "ref": data['ref']}))
+            for event in events:
+                await broadcast_event(room, event)
+                if event.get('type') == 'game_over':
+                    game.restart()
+                    await asyncio.sleep(WIN_PAUSE)
+                    await broadcast_state(room)
+
+        elif data['type'] == 'resync':
+            # The client detected a gap in the patch sequence
+            conn.send(None, ClientConnection.RESYNC)
+
+        elif data['type'] == 'set_mode':
+            logger.info("Player %s (%s) requested mode change to %s", player.id, player.name, data['mode_id'])
+            success, message = game.set_mode(data['mode_id'], player.id)
+            if success:
+                await broadcast_state(room)
+            # Optionally, send a notification back to the admin or all players
+            await broadcast_event(room, {'type': 'notification', 'message': message})
+
+        elif data['type'] == 'remove_command':
+            game.remove_last_command(player.id)
+            await broadcast_state(room)
+    
+        elif data['type'] == 'toggle_ready':
+            game.toggle_player_ready(player.id)
+            await broadcast_state(room)
 
-def main():
+        elif data['type'] == 'set_command_limit':
+            if game.set_command_limit(player.id, data.get('limit')):
+                await broadcast_state(room)
+
+        elif data['type'] == 'hint':
+            if app['hints']:
+                conn.send(json.dumps({"type": "hint", "direction": game.next_direction(player.id)}))
+    finally:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, msg_type)
+
+async def join_player(app, room, conn, data, subscribe):
+    game = room.game
+    name = data.get('name', 'Anonymous')
+    if data.get('protocol') in PROTOCOLS:
+        conn.protocol = data['protocol']
+    if data.get('spectate'):
+        logger.info("Welcoming a spectator to room '%s'", room.id)
+        conn.spectator = True
+        conn.send(json.dumps({"type": "welcome", "id": None, "room": room.id}))
+        if data.get('chunks') and needs_view(game, app['view_radius']):
+            view = View(game, radius=app['view_radius'])
+            view.set_viewport(data.get('viewport'))
+            watch(room, conn, view)
+        else:
+            subscribe()
+            conn.send(game.full_state_message(conn.protocol), ClientConnection.STATE)
+        app['rooms'].changed()
+        return
+    # A client whose player survived a restart takes it back; anyone else gets a new one
+    player = app['rooms'].resume(room, data.get('resume'))
+    if player is not None:
+        logger.info("Player %s (%s) resumed in room '%s'", player.id, player.name, room.id)
+    else:
+        player = await game.register(name)
+
+    logger.info("Welcoming player %s (%s) to room '%s'", player.id, player.name, room.id)
+    conn.player = player
+    welcome = {"type": "welcome", "id": player.id, "room": room.id}
+    if app['rooms'].snapshots:
+        welcome['resume_token'] = app['rooms'].snapshots.resume_token(room.id, player.id)
+    conn.send(json.dumps(welcome))
+    # Existing clients get a patch, the newcomer gets the full state at the same seq
+    await broadcast_state(room)
+    # "chunks" says the client can take a view; a maze that fits in one goes out whole anyway
+    if data.get('chunks') and needs_view(game, app['view_radius']):
+        watch(room, conn, View(game, player, app['view_radius']))
+    else:
+        subscribe()
+        conn.send(game.full_state_message(conn.protocol), ClientConnection.STATE)
+    app['rooms'].changed()
+
+def watch(room, conn, view):
+    """Gives a joining client `view` of the room instead of the room's state broadcasts."""
+    room.views[conn] = view
+    conn.set_view(view)
+    conn.send(view.full_state_message(conn.protocol), ClientConnection.STATE)
+
+async def client_left(app, room, conn):
+    """Removes a disconnected client's player, once the client is out of the room's broadcasts."""
+    room.views.pop(conn, None)
+    player = conn.player
+    if player:
+        logger.info("Connection closed for player %s (%s)", player.id, player.name)
+        await room.game.run_tick()
+        await room.game.unregister(player.id)
+        await broadcast_state(room)
+    app['rooms'].leave(room)
+
+async def admin_rooms_handler(request):
+    """Room lifecycle and load of this process; the sharded dispatcher serves an aggregated view."""
+    return web.json_response({
+        "workers": [{"worker": 0, "pid": os.getpid(), "rooms": request.app['rooms'].stats(),
+                     "maze_pool": request.app['maze_pool'].stats()}],
+    })
+
+async def metrics_handler(request):
+    return web.Response(text=render(REGISTRY.families()), content_type='text/plain', charset='utf-8')
+
+def players_by_mode(registry):
+    players = {(mode,): 0 for mode in GAME_MODES.values()}
+    for room in registry.rooms.values():
+        players[(room.game.game_mode,)] += len(room.game.players)
+    return players
+
+async def snapshot_loop(registry, interval):
+    """Snapshots every room that changed since its last snapshot, every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        for room in list(registry.rooms.values()):
+            await registry.snapshots.save(room.id, room.game)
+
+async def on_startup(app):
+    # Warm the maze pool up before the first room needs a maze
+    app['maze_pool'].refill()
+    rooms = app['rooms']
+    if rooms.snapshots:
+        await rooms.restore()
+        app['snapshot_task'] = asyncio.create_task(snapshot_loop(rooms, app['snapshot_interval']))
+
+async def on_shutdown(app):
+    rooms = app['rooms']
+    if rooms.snapshots:
+        app['snapshot_task'].cancel()
+        # The last snapshot is taken before the clients are disconnected, which must not reach it
+        rooms.closing = True
+        rooms.snapshots.close({room.id: room.game for room in rooms.rooms.values()})
+    for room in list(rooms.rooms.values()):
+        room.close()
+        # Clients of edge processes are closed by their edge
+        sockets = [*room.websockets, *(conn.ws for conn in room.views if isinstance(conn, ClientConnection))]
+        for ws in sockets:
+            await ws.close(code=1001, message='Server shutdown')
+    app['maze_pool'].close()
+
+def make_app(args, on_rooms_change=None):
     app = web.Application()
-    app['websockets'] = {} # Using a dict to map ws to player
-    game.app = app # Give game instance access to the app
-    
-    # Setup static file serving for the frontend
-    frontend_path = pathlib.Path(__file__).parent.parent / 'frontend'
-    app.router.add_static('/', frontend_path, show_index=True, follow_symlinks=True)
+    app['maze_pool'] = MazePool(args.width, args.height, args.maze_pool_depth, args.maze_pool_executor)
+    app['rooms'] = RoomRegistry(
+        args.width, args.height, args.trap_density, on_rooms_change, app['maze_pool'], args.record_dir,
+        args.tick_rate, TurnPacing(args.turn_start_delay, args.turn_step_delay, args.turn_winner_delay),
+        args.turn_execution, SnapshotStore(args.snapshot_dir) if args.snapshot_dir else None, args.resume_grace
+    )
+    app['snapshot_interval'] = args.snapshot_interval
+    app['outbox_limit'] = args.outbox_limit
+    app['outbox_overflow'] = args.outbox_overflow
+    app['rate_limit'] = args.rate_limit
+    app['rate_limit_burst'] = args.rate_limit_burst
+    app['hints'] = args.hints
+    app['view_radius'] = args.view_radius
+
+    rooms = app['rooms']
+    CONNECTED_CLIENTS.set_function(lambda: {(): sum(room.connections() for room in rooms.rooms.values())})
+    PLAYERS.set_function(lambda: players_by_mode(rooms))
+    ROOMS.set_function(lambda: {(): len(rooms.rooms)})
     
-    # Setup WebSocket route
+    # Setup WebSocket, admin and metrics routes
     app.router.add_get('/ws', websocket_handler)
+    app.router.add_get('/admin/rooms', admin_rooms_handler)
+    app.router.add_get('/metrics', metrics_handler)
+
+    # Setup static file serving for the frontend
+    app.router.add_static('/', FRONTEND_DIR, show_index=True, follow_symlinks=True)
     
+    app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
-    
-    print("Server starting on http://0.0.0.0:8080")
-    web.run_app(app, host="0.0.0.0", port=8080)
+    return app
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Random Maze game server")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--outbox-limit', type=int, default=OUTBOX_LIMIT,
+                        help="Max queued outbound messages per client")
+    parser.add_argument('--outbox-overflow', choices=OUTBOX_OVERFLOW_POLICIES, default='coalesce',
+                        help="What to do with a client whose outbound queue is full")
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT,
+                        help="Messages per second each client may send, 0 for no limit; the rest are dropped")
+    parser.add_argument('--rate-limit-burst', type=int, default=RATE_LIMIT_BURST,
+                        help="Messages a client may send in a burst before --rate-limit applies")
+    parser.add_argument('--width', type=int, default=WIDTH, help="Maze width, must be odd")
+    parser.add_argument('--height', type=int, default=HEIGHT, help="Maze height, must be odd")
+    parser.add_argument('--trap-density', type=float, default=None,
+                        help=f"Share of empty tiles holding a trap (default: {TRAP_COUNT} traps per maze)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of worker processes to spread rooms across")
+    parser.add_argument('--edges', type=int, default=0,
+                        help="Serve the clients from this many edge processes, with the games in this one "
+                             "(Linux only); 0 serves them here")
+    parser.add_argument('--maze-pool-depth', type=int, default=MAZE_POOL_DEPTH,
+                        help="Mazes generated ahead of time per process, 0 to generate on every reset")
+    parser.add_argument('--maze-pool-executor', choices=MAZE_POOL_EXECUTORS, default='thread',
+                        help="Where pooled mazes are generated")
+    parser.add_argument('--record-dir', default=None,
+                        help="Write a session log of every room to this directory, for replay.py")
+    parser.add_argument('--snapshot-dir', default=None,
+                        help="Snapshot every room to this directory and restore them on startup")
+    parser.add_argument('--snapshot-interval', type=float, default=SNAPSHOT_INTERVAL,
+                        help="Seconds between snapshots of a changed room; moves in between are journaled")
+    parser.add_argument('--resume-grace', type=float, default=RESUME_GRACE,
+                        help="Seconds restored players wait for their clients to resume them")
+    parser.add_argument('--tick-rate', type=float, default=0,
+                        help="Apply moves in unlimited mode in ticks of this rate (Hz), one broadcast per tick; "
+                             "0 broadcasts after every move")
+    parser.add_argument('--view-radius', type=int, default=VIEW_RADIUS,
+                        help="Maze chunks a player joined with \"chunks\" sees on every side of its own chunk")
+    parser.add_argument('--hints', action='store_true',
+                        help="Answer 'hint' messages with the direction towards the goal")
+    parser.add_argument('--turn-execution', choices=TURN_EXECUTIONS, default='stepwise',
+                        help="How turn-based rounds reach clients: a broadcast per command, or one timeline "
+                             "message per round that the clients animate")
+    parser.add_argument('--turn-start-delay', type=float, default=TURN_PACING.start,
+                        help="Seconds between the start of a turn-based round and its first command")
+    parser.add_argument('--turn-step-delay', type=float, default=TURN_PACING.step,
+                        help="Seconds each command of a turn-based round takes")
+    parser.add_argument('--turn-winner-delay', type=float, default=TURN_PACING.winner,
+                        help="Seconds a turn-based win is shown before the next maze")
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='INFO',
+                        help="DEBUG also logs every message, move and broadcast")
+    parser.add_argument('--log-format', choices=('text', 'json'), default='text')
+    args = parser.parse_args(argv)
+
+    try:
+        check_maze_size(args.width, args.height)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.trap_density is not None and not 0 <= args.trap_density <= 1:
+        parser.error("--trap-density must be between 0 and 1")
+    if not 0 <= args.tick_rate <= MAX_TICK_RATE:
+        parser.error(f"--tick-rate must be between 0 and {MAX_TICK_RATE}")
+    if min(args.turn_start_delay, args.turn_step_delay, args.turn_winner_delay) < 0:
+        parser.error("turn-based delays must not be negative")
+    if args.rate_limit < 0:
+        parser.error("--rate-limit must not be negative")
+    if args.rate_limit_burst < 1:
+        parser.error("--rate-limit-burst must be at least 1")
+    if args.maze_pool_depth < 0:
+        parser.error("--maze-pool-depth must not be negative")
+    if args.maze_pool_executor == 'process' and args.workers > 1:
+        parser.error("--maze-pool-executor process cannot be combined with --workers (workers are daemon processes)")
+    if args.edges < 0:
+        parser.error("--edges must not be negative")
+    if args.view_radius < 0:
+        parser.error("--view-radius must not be negative")
+    if args.edges and args.workers > 1:
+        parser.error("--edges cannot be combined with --workers")
+    if args.snapshot_dir and args.workers > 1:
+        parser.error("--snapshot-dir cannot be combined with --workers")
+    if args.snapshot_interval <= 0:
+        parser.error("--snapshot-interval must be positive")
+    if args.resume_grace < 0:
+        parser.error("--resume-grace must not be negative")
+    return args
+
+# --- Logging ---
+# Attributes every LogRecord has; anything else on a record came from `extra`
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line, including any `extra` fields given to the logging call."""
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in LOG_RECORD_FIELDS)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure_logging(level, log_format):
+    handler = logging.StreamHandler()
+    if log_format == 'json':
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logging.basicConfig(level=level, handlers=[handler])
+
+def main():
+    args = parse_args()
+    configure_logging(args.log_level, args.log_format)
+
+    if args.workers > 1:
+        import sharding
+        logger.info("Server starting on http://0.0.0.0:%d with %d workers", args.port, args.workers)
+        sharding.run_sharded(lambda on_change: make_app(args, on_change), args.port, args.workers, DEFAULT_ROOM)
+        return
+
+    if args.edges:
+        # fanout.py imports this module as `server`: give it the running one, not a second copy
+        sys.modules.setdefault('server', sys.modules[__name__])
+        import fanout
+        logger.info("Server starting on http://0.0.0.0:%d with %d edge processes", args.port, args.edges)
+        fanout.run_fanout(lambda: make_app(args), args)
+        return
+
+    logger.info("Server starting on http://0.0.0.0:%d", args.port)
+    web.run_app(make_app(args), host="0.0.0.0", port=args.port)
 
 if __name__ == "__main__":
     main()
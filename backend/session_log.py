@@ -0,0 +1,55 @@
+"""
+Append-only session logs: everything that changed a game, in the order it happened.
+
+A log is a list of JSON objects, one per line when written to a file. It starts with a
+`start` entry holding the game's seed and settings. After that it has:
+
+* one entry per player action: `join`, `leave`, `move`, `set_mode`, `set_command_limit`,
+  `remove_command`, `toggle_ready`;
+* one entry per step the server takes on its own: `restart` after a win, and `collect`,
+  `round`, `round_step`, `round_move` for the turn-based rounds;
+* a `maze` entry with the seed of every maze the game installs.
+
+Every entry also carries `t`, the game clock in seconds (millisecond resolution) when it was
+recorded. A replay applies the entries in order and hands the game the recorded `t` values as
+its clock, so time-based rules such as slot refills come out the same (see replay.py).
+"""
+import json
+import os
+import time
+
+
+class SessionLog:
+    """Records entries into a file if `path` is given, into the in-memory `entries` list otherwise."""
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = [] if path is None else None
+        # Line buffered, so a crashed server still leaves everything up to its last action on disk
+        self._file = open(path, 'a', encoding='utf-8', buffering=1) if path else None
+        self._opened_at = time.monotonic()
+
+    @classmethod
+    def in_directory(cls, directory, room_id, seed):
+        os.makedirs(directory, exist_ok=True)
+        name = f"{room_id}-{time.strftime('%Y%m%d-%H%M%S')}-{seed}.jsonl"
+        return cls(os.path.join(directory, name))
+
+    def record(self, kind, t=None, **fields):
+        """Appends an entry. `t` defaults to the seconds since the log was opened."""
+        if t is None:
+            t = round(time.monotonic() - self._opened_at, 3)
+        entry = {"type": kind, "t": t, **fields}
+        if self._file is not None:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        elif self.entries is not None:
+            self.entries.append(entry)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,338 @@
+"""
+Spreads rooms across a pool of worker processes.
+
+The dispatcher (the parent process) owns the listening socket. For every accepted connection
+it peeks at the HTTP request line without consuming it, picks a worker and hands the socket
+itself to that worker over a Unix socket (SCM_RIGHTS). The worker serves the connection with
+its own aiohttp app, so after the handoff the dispatcher never touches the connection again
+and a busy room only ever loads the worker that owns it.
+
+* `/ws?room=<id>` goes to the worker the room is placed on; new rooms go to the least loaded worker.
+* `/admin/...` and `/metrics` are served by the dispatcher itself, from what every worker reports.
+* Anything else (static files) goes to the workers round robin, one request per connection.
+
+Linux/Unix only: it relies on fork and on passing file descriptors between processes.
+"""
+import array
+import asyncio
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from aiohttp import web
+
+from metrics import REGISTRY, merge_families, render
+
+MAX_REQUEST_LINE = 8192
+PEEK_TIMEOUT = 10  # Seconds a client has to send its request line
+REPORT_INTERVAL = 2  # Seconds between worker load reports
+ROOM_LINGER = 5  # Seconds a placement survives its room disappearing, for connections in flight
+
+logger = logging.getLogger('sharding')
+
+
+# --- Worker side ---
+def _worker_main(index, app_factory, handoff_sock, report_sock, inherited_socks):
+    # Forked from the dispatcher: drop its ends of the other workers' channels
+    for sock in inherited_socks:
+        sock.close()
+    try:
+        asyncio.run(_serve_worker(index, app_factory, handoff_sock, report_sock))
+    except KeyboardInterrupt:
+        pass
+
+async def _serve_worker(index, app_factory, handoff_sock, report_sock):
+    loop = asyncio.get_running_loop()
+    _, report_writer = await asyncio.open_unix_connection(sock=report_sock)
+
+    def report(registry):
+        line = json.dumps({"pid": os.getpid(), "rooms": registry.stats(), "metrics": REGISTRY.families()})
+        report_writer.write(line.encode() + b'\n')
+
+    app = app_factory(report)
+    app.on_response_prepare.append(_close_after_response)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    heartbeat = asyncio.create_task(_report_periodically(app, report))
+    logger.info("Worker %d (pid %d) ready", index, os.getpid())
+
+    handoff_sock.setblocking(False)
+    try:
+        while True:
+            fd = await _receive_socket(loop, handoff_sock)
+            if fd is None:
+                break # The dispatcher is gone
+            sock = socket.socket(fileno=fd)
+            sock.setblocking(False)
+            await loop.connect_accepted_socket(runner.server, sock)
+    finally:
+        heartbeat.cancel()
+        await runner.cleanup()
+
+async def _report_periodically(app, report):
+    while True:
+        report(app['rooms'])
+        await asyncio.sleep(REPORT_INTERVAL)
+
+async def _close_after_response(request, response):
+    # A kept-alive connection would stay where it was handed, even for a later /ws to another room
+    if not isinstance(response, web.WebSocketResponse):
+        response.force_close()
+
+async def _receive_socket(loop, handoff_sock):
+    """Receives one file descriptor sent with `_send_socket`, or None on EOF."""
+    while True:
+        fds = array.array('i')
+        try:
+            data, ancdata, _, _ = handoff_sock.recvmsg(1, socket.CMSG_SPACE(fds.itemsize))
+        except BlockingIOError:
+            await _wait_readable(loop, handoff_sock)
+            continue
+        if not data:
+            return None
+        for level, kind, payload in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+        if fds:
+            return fds[0]
+
+def _send_socket(handoff_sock, sock):
+    handoff_sock.sendmsg([b'F'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [sock.fileno()]))])
+
+async def _wait_readable(loop, sock):
+    readable = loop.create_future()
+    loop.add_reader(sock.fileno(), readable.set_result, None)
+    try:
+        await readable
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+# --- Dispatcher side ---
+class WorkerHandle:
+    def __init__(self, index, process, handoff_sock, report_sock):
+        self.index = index
+        self.process = process
+        self.handoff_sock = handoff_sock
+        self.report_sock = report_sock
+        self.rooms = {}
+        self.metrics = [] # Metric families as of the last report
+        self.reported_at = None
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def connections(self):
+        return sum(room['connections'] for room in self.rooms.values())
+
+    def stats(self):
+        return {
+            "worker": self.index,
+            "pid": self.process.pid,
+            "alive": self.alive,
+            "reported_at": self.reported_at,
+            "rooms": self.rooms,
+        }
+
+
+class Dispatcher:
+    def __init__(self, workers, default_room):
+        self.workers = workers
+        self.default_room = default_room
+        self.placement = {} # Maps room id to the index of its worker
+        self.last_handoff = {} # Maps room id to the time a connection was last sent to it
+        self.next_static_worker = 0
+        self.admin_runner = None
+        self.tasks = set() # The event loop only keeps weak references to tasks
+
+    async def serve(self, listen_sock):
+        loop = asyncio.get_running_loop()
+        admin_app = web.Application()
+        admin_app['dispatcher'] = self
+        admin_app.router.add_get('/admin/rooms', admin_rooms_handler)
+        admin_app.router.add_get('/metrics', metrics_handler)
+        admin_app.on_response_prepare.append(_close_after_response)
+        self.admin_runner = web.AppRunner(admin_app)
+        await self.admin_runner.setup()
+
+        for worker in self.workers:
+            self.spawn(self.read_reports(worker))
+
+        listen_sock.setblocking(False)
+        while True:
+            sock, _ = await loop.sock_accept(listen_sock)
+            self.spawn(self.route(sock))
+
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def route(self, sock):
+        loop = asyncio.get_running_loop()
+        request_line = await _peek_request_line(loop, sock)
+        if request_line is None:
+            sock.close()
+            return
+        try:
+            _, target, _ = request_line.split(' ', 2)
+            url = urlsplit(target)
+        except ValueError:
+            sock.close()
+            return
+
+        if url.path.startswith('/admin/') or url.path == '/metrics':
+            await loop.connect_accepted_socket(self.admin_runner.server, sock)
+            return
+
+        if url.path == '/ws':
+            room_id = parse_qs(url.query).get('room', [self.default_room])[0]
+            worker = self.place(room_id)
+        else:
+            worker = self.next_static()
+        if worker is None:
+            sock.close()
+            return
+        try:
+            _send_socket(worker.handoff_sock, sock)
+        except OSError as e:
+            logger.warning("Failed to hand a connection to worker %d: %s", worker.index, e)
+        finally:
+            sock.close()
+
+    def place(self, room_id):
+        """Returns the worker that owns the room, placing a new room on the least loaded worker."""
+        self.last_handoff[room_id] = time.monotonic()
+        index = self.placement.get(room_id)
+        if index is not None and self.workers[index].alive:
+            return self.workers[index]
+        alive = [worker for worker in self.workers if worker.alive]
+        if not alive:
+            return None
+        # Reports lag behind, so count the rooms placed here so far rather than the reported ones
+        placed = collections.Counter(self.placement.values())
+        worker = min(alive, key=lambda w: (placed[w.index], w.connections()))
+        self.placement[room_id] = worker.index
+        logger.info("Room '%s' placed on worker %d", room_id, worker.index)
+        return worker
+
+    def next_static(self):
+        for _ in range(len(self.workers)):
+            worker = self.workers[self.next_static_worker]
+            self.next_static_worker = (self.next_static_worker + 1) % len(self.workers)
+            if worker.alive:
+                return worker
+        return None
+
+    async def read_reports(self, worker):
+        reader, _ = await asyncio.open_unix_connection(sock=worker.report_sock)
+        while True:
+            line = await reader.readline()
+            if not line:
+                logger.warning("Worker %d stopped reporting", worker.index)
+                worker.rooms = {}
+                self.forget_rooms(worker)
+                return
+            report = json.loads(line)
+            worker.rooms = report['rooms']
+            worker.metrics = report.get('metrics', [])
+            worker.reported_at = time.time()
+            for room_id in worker.rooms:
+                self.placement[room_id] = worker.index
+            self.forget_rooms(worker)
+
+    def forget_rooms(self, worker):
+        # A room that just disappeared may still have a connection on its way to the worker
+        now = time.monotonic()
+        for room_id, index in list(self.placement.items()):
+            if index != worker.index or room_id in worker.rooms:
+                continue
+            if not worker.alive or now - self.last_handoff.get(room_id, 0) > ROOM_LINGER:
+                del self.placement[room_id]
+                self.last_handoff.pop(room_id, None)
+
+    def stats(self):
+        return {
+            "workers": [worker.stats() for worker in self.workers],
+            "placement": self.placement,
+        }
+
+
+async def admin_rooms_handler(request):
+    return web.json_response(request.app['dispatcher'].stats())
+
+async def metrics_handler(request):
+    """The metrics of all workers as of their last report, told apart by a `worker` label."""
+    workers = request.app['dispatcher'].workers
+    families = merge_families(({"worker": worker.index}, worker.metrics) for worker in workers)
+    return web.Response(text=render(families), content_type='text/plain', charset='utf-8')
+
+
+async def _peek_request_line(loop, sock):
+    """Reads the HTTP request line without consuming it, so the worker can parse the request itself."""
+    deadline = loop.time() + PEEK_TIMEOUT
+    sock.setblocking(False)
+    while loop.time() < deadline:
+        try:
+            data = sock.recv(MAX_REQUEST_LINE, socket.MSG_PEEK)
+        except BlockingIOError:
+            try:
+                await asyncio.wait_for(_wait_readable(loop, sock), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return None
+            continue
+        except OSError:
+            return None
+        if not data:
+            return None
+        end = data.find(b'\r\n')
+        if end >= 0:
+            return data[:end].decode('latin-1')
+        if len(data) >= MAX_REQUEST_LINE:
+            return None
+        await asyncio.sleep(0.01) # Only part of the line has arrived so far
+    return None
+
+
+def run_sharded(app_factory, port, worker_count, default_room):
+    """
+    Runs the dispatcher in this process and `worker_count` workers, each serving its rooms
+    with the app built by `app_factory(on_rooms_change)`.
+    """
+    context = multiprocessing.get_context('fork')
+    workers = []
+    for index in range(worker_count):
+        handoff_parent, handoff_child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        report_parent, report_child = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        inherited = [sock for worker in workers for sock in (worker.handoff_sock, worker.report_sock)]
+        inherited += [handoff_parent, report_parent]
+        process = context.Process(
+            target=_worker_main, args=(index, app_factory, handoff_child, report_child, inherited), daemon=True
+        )
+        process.start()
+        handoff_child.close()
+        report_child.close()
+        workers.append(WorkerHandle(index, process, handoff_parent, report_parent))
+
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_sock.bind(('0.0.0.0', port))
+    listen_sock.listen(1024)
+
+    dispatcher = Dispatcher(workers, default_room)
+    try:
+        asyncio.run(dispatcher.serve(listen_sock))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listen_sock.close()
+        for worker in workers:
+            worker.process.terminate()
+        for worker in workers:
+            worker.process.join(timeout=5)
@@ -0,0 +1,202 @@
+"""
+Headless batch simulation: plays many games between bots across a process pool, with no
+server and no sockets, and reports how they went:
+
+    python backend/simulate.py --games 10000
+    python backend/simulate.py --games 2000 --bots greedy greedy random random --trap-density 0.05 --json
+
+Each game is a fresh Game in unlimited mode, driven directly the way replay.py drives one.
+The bots take turns in join order, one move each, and every move moves all players. A game
+ends when someone reaches the goal, or as a draw after --max-moves moves. Game i uses seed
+--seed + i for its maze, traps and bots, so a run can be repeated exactly.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from game import TRAP_TYPES, Game, GameSink
+from maze import maze_layout
+from replay import LoggedMazes
+
+DIRECTIONS = ('up', 'down', 'left', 'right')
+
+
+def random_bot(game, player, rng):
+    return rng.choice(DIRECTIONS)
+
+def greedy_bot(game, player, rng):
+    """Follows the goal distance field, which is only ever blocked by other players."""
+    return game.next_direction(player.id) or rng.choice(DIRECTIONS)
+
+BOTS = {"random": random_bot, "greedy": greedy_bot}
+
+
+class TrapCounter(GameSink):
+    """Counts the traps triggered in a game, by kind and by player."""
+    def __init__(self):
+        self.kinds = collections.Counter()
+        self.players = set()
+
+    def trap_triggered(self, player, kind):
+        self.kinds[kind] += 1
+        self.players.add(player.id)
+
+
+async def play_game(options, seed):
+    """Plays one game to the end and returns its winner (None for a draw) and statistics."""
+    rng = random.Random(seed)
+    # The maze comes from the game's seed too, so a game plays the same in any worker
+    mazes = LoggedMazes(options['width'], options['height'], [seed])
+    game = Game(options['width'], options['height'], options['trap_density'], mazes, seed=seed, realtime=False)
+    traps = game.sink = TrapCounter()
+    bots = []
+    for i, bot in enumerate(options['bots']):
+        player = await game.register(f"{bot}{i}")
+        bots.append((player, BOTS[bot]))
+
+    winner_id = None
+    moves = 0
+    while winner_id is None and moves < options['max_moves']:
+        player, bot = bots[moves % len(bots)]
+        for event in await game.handle_move(player.id, bot(game, player, rng)):
+            if event.get('type') == 'game_over':
+                winner_id = event['winner_id']
+        moves += 1
+
+    result = {"moves": moves, "traps": traps.kinds, "winner": None}
+    if winner_id is not None:
+        index = next(i for i, (player, _) in enumerate(bots) if player.id == winner_id)
+        winner = bots[index][0]
+        result['winner'] = {
+            "bot": options['bots'][index],
+            "spawn": game.spawn_points.index((winner.start_x, winner.start_y)),
+            "triggered_trap": winner_id in traps.players,
+        }
+    result['players_triggering_traps'] = len(traps.players)
+    game.close()
+    return result
+
+
+def play_games(options, seeds):
+    """Runs in a pool worker: plays the games of `seeds` and returns their combined tally."""
+    async def play_all():
+        tally = new_tally()
+        for seed in seeds:
+            add_result(tally, await play_game(options, seed))
+        return tally
+    return asyncio.run(play_all())
+
+
+def new_tally():
+    return {
+        "games": 0, "draws": 0, "moves": 0,
+        "wins_by_spawn": collections.Counter(), "wins_by_bot": collections.Counter(),
+        "traps": collections.Counter(),
+        "games_with_traps": 0, "moves_with_traps": 0,
+        "players_triggering_traps": 0, "wins_after_trap": 0,
+    }
+
+def add_result(tally, result):
+    tally['games'] += 1
+    tally['moves'] += result['moves']
+    tally['traps'].update(result['traps'])
+    tally['players_triggering_traps'] += result['players_triggering_traps']
+    if result['traps']:
+        tally['games_with_traps'] += 1
+        tally['moves_with_traps'] += result['moves']
+    winner = result['winner']
+    if winner is None:
+        tally['draws'] += 1
+        return
+    tally['wins_by_spawn'][winner['spawn']] += 1
+    tally['wins_by_bot'][winner['bot']] += 1
+    tally['wins_after_trap'] += winner['triggered_trap']
+
+def merge_tallies(tallies):
+    total = new_tally()
+    for tally in tallies:
+        for key, value in tally.items():
+            total[key] += value # Counters add up like the integers do
+    return total
+
+
+def report(tally, options, elapsed):
+    games, wins = tally['games'], tally['games'] - tally['draws']
+    plain_games = games - tally['games_with_traps']
+    spawn_points, _ = maze_layout(options['width'], options['height'])
+    return {
+        "games": games,
+        "seconds": elapsed,
+        "games_per_second": games / elapsed,
+        "draws": tally['draws'],
+        "average_moves": tally['moves'] / games,
+        "win_rate_by_spawn": {str(spawn_points[i]): tally['wins_by_spawn'][i] / games for i in range(len(spawn_points))},
+        "win_rate_by_bot": {bot: tally['wins_by_bot'][bot] / games for bot in sorted(set(options['bots']))},
+        "traps_per_game": {kind: tally['traps'][kind] / games for kind in TRAP_TYPES},
+        "average_moves_with_traps": tally['moves_with_traps'] / tally['games_with_traps'] if tally['games_with_traps'] else None,
+        "average_moves_without_traps": (tally['moves'] - tally['moves_with_traps']) / plain_games if plain_games else None,
+        # Compare the two: a trap helps its victims if they win more often than they trigger traps
+        "share_of_players_triggering_traps": tally['players_triggering_traps'] / (games * len(options['bots'])),
+        "share_of_wins_after_trap": tally['wins_after_trap'] / wins if wins else None,
+    }
+
+
+def print_report(result):
+    def number(value, fmt):
+        return "n/a" if value is None else format(value, fmt)
+    print(f"{result['games']} games in {result['seconds']:.1f} s ({result['games_per_second']:,.0f} games/s), "
+          f"{result['draws']} draws, {result['average_moves']:.1f} moves on average")
+    print("win rate by spawn point: " + ", ".join(f"{spawn} {rate:.1%}" for spawn, rate in result['win_rate_by_spawn'].items()))
+    print("win rate by bot: " + ", ".join(f"{bot} {rate:.1%}" for bot, rate in result['win_rate_by_bot'].items()))
+    print("traps per game: " + ", ".join(f"{kind} {rate:.2f}" for kind, rate in result['traps_per_game'].items()))
+    print(f"moves per game: {number(result['average_moves_without_traps'], '.1f')} without a trap triggered, "
+          f"{number(result['average_moves_with_traps'], '.1f')} with")
+    print(f"players triggering a trap: {result['share_of_players_triggering_traps']:.1%}, "
+          f"winners who had triggered one: {number(result['share_of_wins_after_trap'], '.1%')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate Random Maze games between bots")
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--bots', nargs='+', choices=sorted(BOTS), default=['greedy', 'random', 'random', 'random'],
+                        help="One bot per player, in join order (and so spawn point order)")
+    parser.add_argument('--width', type=int, default=25)
+    parser.add_argument('--height', type=int, default=25)
+    parser.add_argument('--trap-density', type=float, default=None)
+    parser.add_argument('--max-moves', type=int, default=2000, help="Moves after which a game is a draw")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the first game; game i uses seed + i")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Processes to play the games in")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args()
+    if args.games < 1 or args.workers < 1:
+        parser.error("--games and --workers must be at least 1")
+
+    options = {"width": args.width, "height": args.height, "trap_density": args.trap_density,
+               "bots": args.bots, "max_moves": args.max_moves}
+    seeds = range(args.seed, args.seed + args.games)
+    # A few chunks per worker keeps them all busy to the end without much pickling
+    chunk = max(1, args.games // (args.workers * 4))
+    chunks = [seeds[i:i + chunk] for i in range(0, args.games, chunk)]
+
+    started = time.perf_counter()
+    if args.workers == 1:
+        tallies = [play_games(options, seeds)]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            tallies = list(executor.map(play_games, [options] * len(chunks), chunks))
+    result = report(merge_tallies(tallies), options, time.perf_counter() - started)
+
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(result)
+
+if __name__ == "__main__":
+    main()
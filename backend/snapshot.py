@@ -0,0 +1,402 @@
+"""
+Crash-safe snapshots of games, so a restarted server picks its rooms up where they were.
+
+Each room has these files in the snapshot directory:
+
+* `<room>.snap` - the game as of its last snapshot: SNAPSHOT_HEADER, trap records, player
+  records (in position slot order), then a JSON trailer with everything that has no fixed
+  size: names, colours, the RNG state, the turn info.
+* `<room>.<maze seed>.maze` - the maze of that snapshot: MAZE_HEADER, the walls as a bitset
+  (1 bit per cell, row-major, least significant bit first) and, 8-byte aligned, the goal
+  distance field (int32 per cell). It is by far the largest part and never changes, so it
+  is written once per maze.
+* `<room>.<generation>.journal` - a session log (see session_log.py) of everything the game
+  did since snapshot `generation` was captured.
+
+A snapshot is captured on the event loop, which only packs a few arrays, and written by a
+single writer thread: every file under a temporary name first, then renamed into place. The
+game's journal switches to the new generation as the snapshot is captured, so the last
+complete snapshot plus the journals from its generation on always add up to the game, even
+if the process dies halfway through a write. Journal lines reach the OS as they are written.
+
+Restoring maps the files into memory: the maze is unpacked from its bitset, the distance
+field is used where it lies, and the journals are replayed on top (see replay.py).
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from game import TRAP_TYPES, Game, Player, PlayerPositions, is_game_over
+from maze import GOAL, PATH, WALL, Maze, maze_layout
+from protocol import COMMANDS, MAX_COMMANDS
+from replay import LoggedMazes, apply_entry
+from session_log import SessionLog, load
+
+SNAPSHOT_INTERVAL = 5.0  # Seconds between snapshots of a changed room
+RESUME_GRACE = 30.0  # Seconds restored players wait for their clients to come back
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_MAGIC = b'RMZS'
+MAZE_MAGIC = b'RMZM'
+RESUME_KEY_FILE = 'resume.key'
+ROOM_FILES = ('snap', 'maze', 'journal', 'tmp')  # Last part of the name of every file of a room
+
+# magic, format, generation, maze seed, width, height, game clock (ms), players, traps, trailer bytes
+SNAPSHOT_HEADER = struct.Struct('<4sHIqHHqIII')
+MAZE_HEADER = struct.Struct('<4sHqHH')  # magic, format, seed, width, height
+TRAP_RECORD = np.dtype([('cell', '<u4'), ('kind', 'u1')])  # Kind is an index into TRAP_TYPES
+PLAYER_RECORD = np.dtype([
+    ('id', 'u1', 16), ('x', '<u2'), ('y', '<u2'), ('start_x', '<u2'), ('start_y', '<u2'),
+    ('slots', 'u1'), ('slots_refilled_at', '<i8'), ('is_ready', 'u1'),
+    ('command_count', 'u1'), ('commands', 'u1', MAX_COMMANDS),  # Commands are indexes into COMMANDS
+])
+
+logger = logging.getLogger('snapshot')
+
+
+# --- File Format ---
+def capture(game, generation):
+    """Packs a game into the contents of its snapshot file. Cheap enough for the event loop."""
+    players = game.positions.players # Slot order, which swap traps depend on
+    records = np.zeros(len(players), PLAYER_RECORD)
+    records['id'] = np.frombuffer(b''.join(uuid.UUID(p.id).bytes for p in players), np.uint8).reshape(-1, 16)
+    records['x'], records['y'] = game.positions.xs, game.positions.ys
+    records['start_x'] = [p.start_x for p in players]
+    records['start_y'] = [p.start_y for p in players]
+    records['slots'] = [p.slots for p in players]
+    records['slots_refilled_at'] = [p.slots_refilled_at for p in players]
+    records['is_ready'] = [p.is_ready for p in players]
+    records['command_count'] = [len(p.commands) for p in players]
+    records['commands'] = np.frombuffer(b''.join(
+        bytes(COMMANDS.index(command) for command in p.commands).ljust(MAX_COMMANDS, b'\0') for p in players
+    ), np.uint8).reshape(-1, MAX_COMMANDS)
+
+    traps = np.zeros(len(game.traps), TRAP_RECORD)
+    traps['cell'] = list(game.traps)
+    traps['kind'] = [TRAP_TYPES.index(kind) for kind in game.traps.values()]
+
+    slots = {player.id: slot for slot, player in enumerate(players)}
+    trailer = json.dumps({
+        "seed": game.seed,
+        "trap_density": game.trap_density,
+        "rng": game.rng.getstate(),
+        "mode": game.game_mode,
+        "command_limit": game.command_limit,
+        "turn_info": game.turn_info,
+        # A round in progress, and whether its marked command still has to run
+        "round": None if game.round_steps is None else {"pending": game.round_step is not None},
+        "names": [p.name for p in players],
+        "colors": [p.color for p in players],
+        "join_order": [slots[player_id] for player_id in game.players],
+    }, ensure_ascii=False).encode('utf-8')
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, generation, game.maze.seed, game.width,
+                                  game.height, game.now, len(records), len(traps), len(trailer))
+    return b''.join([header, traps.tobytes(), records.tobytes(), trailer])
+
+
+def maze_parts(maze):
+    """The contents of a maze file, as buffers to write one after the other."""
+    bits = maze.wall_bits()
+    padding = bytes(-(MAZE_HEADER.size + len(bits)) % 8)
+    return [MAZE_HEADER.pack(MAZE_MAGIC, SNAPSHOT_FORMAT, maze.seed, maze.width, maze.height),
+            bits, padding, maze.distance_field()]
+
+
+def _map(path):
+    with open(path, 'rb') as f:
+        # Copy-on-write: arrays over the mapping are writable without touching the file
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+
+def read_maze(path):
+    data = _map(path)
+    magic, version, seed, width, height = MAZE_HEADER.unpack_from(data)
+    if magic != MAZE_MAGIC or version != SNAPSHOT_FORMAT:
+        raise ValueError(f"{path} is not a maze file of format {SNAPSHOT_FORMAT}")
+    cells = width * height
+    bits_size = (cells + 7) // 8
+    bits = np.frombuffer(data, np.uint8, bits_size, MAZE_HEADER.size)
+    # 0 or 1 per cell, turned into PATH or WALL in place
+    grid = np.unpackbits(bits, count=cells, bitorder='little')
+    grid *= WALL - PATH
+    grid += PATH
+    grid = grid.reshape(height, width)
+    _, (goal_x, goal_y) = maze_layout(width, height)
+    grid[goal_y, goal_x] = GOAL
+    maze = Maze.from_grid(grid, seed)
+    # The distance field stays in the mapping; its pages are read in as they are used
+    offset = MAZE_HEADER.size + bits_size
+    maze._distances = np.frombuffer(data, np.int32, cells, offset + -offset % 8)
+    return maze
+
+
+def read_snapshot(path):
+    """The header fields, trap and player records and trailer of a snapshot file, as a dict."""
+    data = _map(path)
+    (magic, version, generation, maze_seed, width, height, now, player_count, trap_count,
+     trailer_size) = SNAPSHOT_HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT:
+        raise ValueError(f"{path} is not a snapshot of format {SNAPSHOT_FORMAT}")
+    offset = SNAPSHOT_HEADER.size
+    traps = np.frombuffer(data, TRAP_RECORD, trap_count, offset)
+    offset += traps.nbytes
+    players = np.frombuffer(data, PLAYER_RECORD, player_count, offset)
+    offset += players.nbytes
+    return {
+        "generation": generation, "maze_seed": maze_seed, "width": width, "height": height, "now": now,
+        "traps": traps, "players": players, **json.loads(data[offset:offset + trailer_size]),
+    }
+
+
+# --- Restoring ---
+class RestoredClock:
+    """
+    Game clock of a restored game: the recorded times while its journal is replayed, then
+    running on from the last of them once `start` is called. Downtime does not count.
+    """
+    def __init__(self, now):
+        self.now = now
+        self.started = None
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def __call__(self):
+        if self.started is None:
+            return self.now
+        return self.now + int((time.monotonic() - self.started) * 1000)
+
+
+async def restore_game(snapshot, maze, journal, maze_pool=None, **options):
+    """
+    Rebuilds a game from a snapshot (see read_snapshot), its maze and the journal entries
+    recorded since. Returns None if the journal ends with the game closed. The game is
+    returned in real-time mode but stopped; start_game_loop(resume=True) carries on.
+    """
+    if any(entry['type'] == 'end' for entry in journal):
+        return None
+    width, height = snapshot['width'], snapshot['height']
+    clock = RestoredClock(snapshot['now'])
+    # The snapshot's maze first, then the mazes of any resets in the journal
+    mazes = LoggedMazes(width, height, [maze.seed] + [entry['seed'] for entry in journal if entry['type'] == 'maze'],
+                        {maze.seed: maze})
+    # Created with no traps to place, since the snapshot's replace them
+    game = Game(width, height, 0, mazes, seed=snapshot['seed'], realtime=False, clock=clock, **options)
+    game.trap_density = snapshot['trap_density']
+
+    version, state, gauss = snapshot['rng']
+    game.rng.setstate((version, tuple(state), gauss))
+    game.game_mode = snapshot['mode']
+    game.command_limit = snapshot['command_limit']
+    game.turn_info = snapshot['turn_info']
+    game.now = snapshot['now']
+    traps = snapshot['traps']
+    game.set_traps({int(cell): TRAP_TYPES[kind] for cell, kind in zip(traps['cell'].tolist(), traps['kind'].tolist())})
+
+    game.positions = PlayerPositions(max(len(snapshot['players']), 1))
+    players = []
+    for record, name, color in zip(snapshot['players'], snapshot['names'], snapshot['colors']):
+        player = Player(str(uuid.UUID(bytes=record['id'].tobytes())), int(record['x']), int(record['y']), color, name,
+                        game.positions)
+        player.start_x, player.start_y = int(record['start_x']), int(record['start_y'])
+        player.slots = int(record['slots'])
+        player.slots_refilled_at = int(record['slots_refilled_at'])
+        player.is_ready = bool(record['is_ready'])
+        player.commands = [COMMANDS[code] for code in record['commands'][:record['command_count']]]
+        players.append(player)
+    game.players = {players[slot].id: players[slot] for slot in snapshot['join_order']}
+    game.used_colors = {player.color for player in players}
+    if snapshot['round']:
+        game.resume_round(snapshot['round']['pending'])
+    game.changed()
+
+    for entry in journal:
+        clock.now = round(entry['t'] * 1000)
+        await apply_entry(game, entry)
+
+    # Finish what the server was in the middle of: a command marked but not run, or a win
+    # shown before the next maze
+    if game.round_step is not None:
+        if is_game_over(await game.run_round_step()):
+            game.restart()
+    elif any((player.x, player.y) == game.goal_pos for player in game.players.values()):
+        game.restart()
+
+    if maze_pool is not None and (maze_pool.width, maze_pool.height) == (width, height):
+        game.maze_pool = maze_pool
+    else:
+        game.maze_pool = None # The server now runs another maze size: generate inline
+    clock.start()
+    game.realtime = True
+    return game
+
+
+# --- Snapshot Directory ---
+class SnapshotStore:
+    """
+    The snapshots of one server's rooms in `directory`. A room is attached once it exists;
+    from then on `save` snapshots it, and `delete` drops its files when the room goes away.
+    Resume tokens let reconnecting clients reclaim their players after a restart.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.key = self._resume_key()
+        self.generations = {} # Room id -> generation of its newest snapshot
+        self.saved_versions = {} # Room id -> Game.version of its newest written snapshot
+        self.saved_mazes = {} # Room id -> seed of its maze file on disk
+        # One writer thread, so the writes and deletions of a room happen in order
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='snapshot')
+
+    def _path(self, room_id, *parts):
+        # Room ids never contain dots (see ROOM_ID_PATTERN), so names split unambiguously
+        return os.path.join(self.directory, '.'.join([room_id, *map(str, parts)]))
+
+    def _resume_key(self):
+        path = os.path.join(self.directory, RESUME_KEY_FILE)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            with open(path, 'rb') as f:
+                return f.read()
+        key = os.urandom(32)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+        return key
+
+    def resume_token(self, room_id, player_id):
+        return hmac.new(self.key, f"{room_id}/{player_id}".encode(), hashlib.sha256).hexdigest()
+
+    def check_resume_token(self, room_id, player_id, token):
+        return isinstance(token, str) and hmac.compare_digest(token.encode(), self.resume_token(room_id, player_id).encode())
+
+    def room_ids(self):
+        return sorted(name[:-len('.snap')] for name in os.listdir(self.directory) if name.endswith('.snap'))
+
+    async def restore(self, room_id, maze_pool=None, **options):
+        """Restores a room's game, see restore_game. Returns None if the room had closed."""
+        snapshot = read_snapshot(self._path(room_id, 'snap'))
+        maze = read_maze(self._path(room_id, snapshot['maze_seed'], 'maze'))
+        journal = []
+        generation = snapshot['generation']
+        # Newer journals exist if the process died while a newer snapshot was being written
+        while os.path.exists(self._path(room_id, generation, 'journal')):
+            journal.extend(load(self._path(room_id, generation, 'journal')))
+            generation += 1
+        game = await restore_game(snapshot, maze, journal, maze_pool, **options)
+        if game is not None:
+            self.generations[room_id] = max(generation - 1, snapshot['generation'])
+            self.saved_mazes[room_id] = maze.seed
+        return game
+
+    def attach(self, room_id, game):
+        """Takes the first snapshot of a new or restored room. From then on its changes are journaled."""
+        self._snapshot(room_id, game)
+
+    async def save(self, room_id, game):
+        """Snapshots a room if it changed since its last snapshot."""
+        if self.saved_versions.get(room_id) != game.version:
+            await asyncio.wait([self._snapshot(room_id, game)])
+
+    def _snapshot(self, room_id, game):
+        """Captures a room and writes it in the background. What is on disk is noted only once it is."""
+        version, maze_seed = game.version, game.maze.seed
+        written = self._submit(self._capture(room_id, game))
+
+        def saved(future):
+            # A failed write is logged already. The journals still cover the game, and until a
+            # write succeeds the next snapshot tries again, maze file included
+            if not future.cancelled() and future.exception() is None and room_id in self.generations:
+                self.saved_versions[room_id] = version
+                self.saved_mazes[room_id] = maze_seed
+        written.add_done_callback(saved)
+        return written
+
+    def _capture(self, room_id, game):
+        generation = self.generations.get(room_id, 0) + 1
+        self.generations[room_id] = generation
+        snapshot = capture(game, generation)
+        maze_seed = game.maze.seed
+        maze = game.maze if self.saved_mazes.get(room_id) != maze_seed else None
+        # Everything from here on goes to the journal of the new generation
+        if game.journal is not None:
+            game.journal.close()
+        game.journal = SessionLog(self._path(room_id, generation, 'journal'))
+        return lambda: self._write(room_id, generation, snapshot, maze_seed, maze)
+
+    def _write(self, room_id, generation, snapshot, maze_seed, maze):
+        if maze is not None:
+            _write_file(self._path(room_id, maze_seed, 'maze'), maze_parts(maze))
+        _write_file(self._path(room_id, 'snap'), [snapshot])
+        # The new snapshot covers the older journals, and needs no other maze
+        for name in os.listdir(self.directory):
+            parts = name.split('.')
+            if parts[0] != room_id or len(parts) != 3:
+                continue
+            if (parts[2] == 'journal' and int(parts[1]) < generation) or (parts[2] == 'maze' and int(parts[1]) != maze_seed):
+                os.remove(os.path.join(self.directory, name))
+
+    def delete(self, room_id, game=None):
+        """Drops a room's files once it is gone for good."""
+        if game is not None and game.journal is not None:
+            game.journal.close()
+            game.journal = None
+        for known in (self.generations, self.saved_versions, self.saved_mazes):
+            known.pop(room_id, None)
+        self._submit(lambda: self._delete(room_id))
+
+    def _delete(self, room_id):
+        for name in os.listdir(self.directory):
+            parts = name.split('.')
+            if parts[0] == room_id and parts[-1] in ROOM_FILES:
+                os.remove(os.path.join(self.directory, name))
+
+    def _submit(self, job):
+        future = asyncio.get_running_loop().run_in_executor(self._writer, job)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def close(self, rooms):
+        """
+        Takes a last snapshot of every room in `rooms` (room id -> game), waits for all
+        writes and stops journaling, so whatever happens to the games afterwards, such as
+        their players disconnecting as the server shuts down, is not saved.
+        """
+        jobs = [self._capture(room_id, game) for room_id, game in rooms.items()]
+        for game in rooms.values():
+            game.journal.close()
+            game.journal = None
+        for job in jobs:
+            self._writer.submit(job).add_done_callback(_log_failure)
+        self._writer.shutdown(wait=True)
+
+
+def _write_file(path, parts):
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as f:
+        for part in parts:
+            f.write(part)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    if os.name == 'posix':
+        # The rename is only durable once the directory entry is on disk too
+        directory = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Snapshot write failed", exc_info=future.exception())
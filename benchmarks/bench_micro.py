@@ -0,0 +1,142 @@
+"""
+Microbenchmarks of the server's hot paths, compared against a saved baseline:
+
+    python benchmarks/bench_micro.py                  # compare with benchmarks/baseline.json
+    python benchmarks/bench_micro.py --save-baseline  # record this machine's numbers
+    python benchmarks/bench_micro.py --check          # exit 1 on a regression, for CI
+
+Timings are machine specific: save a baseline on the machine you compare on. A benchmark
+regresses when it is slower than its baseline by more than --tolerance, and by more than
+both its own jitter (the spread of its runs) and --noise-floor microseconds per call:
+calls that take well under a millisecond jitter by more than any sensible tolerance.
+"""
+import argparse
+import json
+import pathlib
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'backend'))
+
+from bench_protocol import make_game, next_patch  # noqa: E402
+from maze import generate_maze, maze_layout  # noqa: E402
+from protocol import encode_update  # noqa: E402
+
+BASELINE = pathlib.Path(__file__).resolve().parent / 'baseline.json'
+DIRECTIONS = ('up', 'right', 'down', 'left')
+
+
+def measure(fn, min_seconds=0.1, repeat=5):
+    """
+    The mean seconds per call of `repeat` runs, each lasting at least `min_seconds`. Their
+    median is the result; unlike the best run, it does not make a baseline out of one lucky
+    run that later runs rarely match. Their spread shows how much the timing jitters.
+    """
+    runs = []
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            fn()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_seconds:
+                break
+        runs.append(elapsed / calls)
+    return runs
+
+
+def bench_generate_maze(size):
+    spawn_points, goal_pos = maze_layout(size, size)
+    seeds = iter(range(10**9))
+    return lambda: generate_maze(size, size, spawn_points, goal_pos, next(seeds))
+
+def bench_global_move(size, players):
+    game = make_game(size, players)
+    directions = iter(DIRECTIONS * 10**6)
+    return lambda: game.execute_global_move(next(directions))
+
+def bench_get_state(size, players):
+    game = make_game(size, players)
+    def rebuild():
+        # Every player changed, so nothing of the previous state can be reused
+        for player in game.players.values():
+            player.dirty = True
+        game.changed()
+        return game.get_state()
+    return rebuild
+
+def bench_unchanged_update(size, players):
+    game = make_game(size, players)
+    game.next_state_update()
+    return game.next_state_update
+
+def bench_json_full(size, players):
+    update = make_game(size, players).next_state_update()
+    return lambda: encode_update(update, 'json')
+
+def bench_json_patch(size, players):
+    game = make_game(size, players)
+    game.next_state_update()
+    update = next_patch(game)
+    return lambda: encode_update(update, 'json')
+
+BENCHMARKS = {
+    "generate_maze 25x25": lambda: bench_generate_maze(25),
+    "generate_maze 201x201": lambda: bench_generate_maze(201),
+    "generate_maze 1001x1001": lambda: bench_generate_maze(1001),
+    "execute_global_move 201x201 16 players": lambda: bench_global_move(201, 16),
+    "execute_global_move 201x201 1000 players": lambda: bench_global_move(201, 1000),
+    "get_state 25x25 16 players": lambda: bench_get_state(25, 16),
+    "get_state 201x201 1000 players": lambda: bench_get_state(201, 1000),
+    "next_state_update unchanged 201x201 1000 players": lambda: bench_unchanged_update(201, 1000),
+    "json full state 201x201 16 players": lambda: bench_json_full(201, 16),
+    "json patch 201x201 1000 players": lambda: bench_json_patch(201, 1000),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--save-baseline', action='store_true', help="Write the results as the new baseline")
+    parser.add_argument('--baseline', default=str(BASELINE))
+    parser.add_argument('--tolerance', type=float, default=0.5, help="Allowed slowdown before flagging, 0.5 = 50%%")
+    parser.add_argument('--noise-floor', type=float, default=25,
+                        help="Slowdowns of fewer microseconds per call than this are never flagged")
+    parser.add_argument('--check', action='store_true', help="Exit with status 1 if anything regressed")
+    parser.add_argument('--filter', default='', help="Only run benchmarks whose name contains this")
+    args = parser.parse_args()
+
+    baseline_path = pathlib.Path(args.baseline)
+    baseline = {} if args.save_baseline or not baseline_path.exists() else json.loads(baseline_path.read_text())
+    random.seed(0) # The same games and mazes on every run
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<50} {'time':>12} {'jitter':>10} {'baseline':>12} {'ratio':>7}")
+    for name, setup in BENCHMARKS.items():
+        if args.filter not in name:
+            continue
+        runs = measure(setup())
+        seconds = results[name] = statistics.median(runs)
+        jitter = max(runs) - min(runs)
+        line = f"{name:<50} {seconds * 1e6:>10.1f}us {jitter * 1e6:>8.1f}us"
+        if name in baseline:
+            ratio = seconds / baseline[name]
+            line += f" {baseline[name] * 1e6:>10.1f}us {ratio:>6.2f}x"
+            slowdown = seconds - baseline[name]
+            if ratio > 1 + args.tolerance and slowdown > jitter and slowdown * 1e6 > args.noise_floor:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    if args.save_baseline:
+        baseline_path.write_text(json.dumps(results, indent=2) + '\n')
+        print(f"Baseline written to {baseline_path}")
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Compares the JSON and binary wire protocols: bytes per broadcast and encoding CPU time
+for a full state (sent on reset and to joiners) and a typical move patch, then for the same
+two messages of one player's view (see backend/interest.py), which should not grow with the maze.
+
+    python benchmarks/bench_protocol.py [--players 16] [--sizes 25 201 1001]
+"""
+import argparse
+import asyncio
+import pathlib
+import random
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'backend'))
+
+import numpy as np  # noqa: E402
+from game import Game  # noqa: E402
+from interest import View  # noqa: E402
+from maze import PATH  # noqa: E402
+from protocol import PROTOCOLS, encode_update  # noqa: E402
+
+DIRECTIONS = ('up', 'right', 'down', 'left')
+
+
+def time_encoding(update, protocol, min_seconds=0.2):
+    """Mean seconds per encoding, repeated for at least `min_seconds`."""
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        encode_update(update, protocol)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / runs
+
+
+def make_game(size, players):
+    game = Game(size, size)
+    for i in range(players):
+        asyncio.run(game.register(f"player{i}"))
+    # Spread players over the maze; stacked on the spawn points they would block each other
+    ys, xs = np.nonzero(game.maze.grid == PATH)
+    for player, i in zip(game.players.values(), random.sample(range(len(xs)), players)):
+        player.x, player.y = int(xs[i]), int(ys[i])
+    game.changed()
+    return game
+
+
+def next_patch(game):
+    """Moves everyone until the state actually changes and returns that patch."""
+    for direction in DIRECTIONS * 4:
+        game.execute_global_move(direction)
+        update = game.next_state_update()
+        if update is not None:
+            return update
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', type=int, default=16)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[25, 201, 1001])
+    args = parser.parse_args()
+
+    print(f"{'maze':>10} {'message':>8} {'protocol':>8} {'bytes':>12} {'encode':>12}")
+    for size in args.sizes:
+        game = make_game(size, args.players)
+        view = View(game, next(iter(game.players.values())))
+        full, view_full = game.next_state_update(), view.next_update()
+        patch = next_patch(game)
+        view_patch = view.next_update() # None if the move changed nothing around that player
+        for label, update in (('full', full), ('patch', patch), ('view', view_full), ('v-patch', view_patch)):
+            if update is None:
+                continue
+            for protocol in PROTOCOLS:
+                # The maze bitset is cached per maze, so time the steady state after one encoding
+                size_bytes = len(encode_update(update, protocol))
+                seconds = time_encoding(update, protocol)
+                print(f"{size}x{size:<6} {label:>8} {protocol:>8} {size_bytes:>12,} {seconds * 1e6:>10.1f}us")
+
+
+if __name__ == '__main__':
+    main()
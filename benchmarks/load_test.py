@@ -0,0 +1,432 @@
+"""
+Load test for the WebSocket server: starts the app in a child process, opens N simulated
+clients and reports, for every game mode, move-to-broadcast latency, traffic, event loop lag
+and server memory.
+
+    python benchmarks/load_test.py [--clients 200] [--rate 2] [--duration 10] [--modes unlimited slots]
+
+Clients are spread four to a room by default: the maze has four spawn points, and players
+stacked on one block each other, so a crowded room mostly broadcasts nothing. Every client
+joins, then sends moves at `--rate` per second without waiting for answers. In
+turn-based mode a client instead fills its command queue and toggles ready whenever a new
+collecting phase starts. Latency is measured with the optional `ref` field of `move`: the
+server answers it with an `ack` queued right behind that move's state update.
+
+The clients run in `--client-processes` processes of their own. If one of them is close to
+100% CPU, the numbers measure the clients rather than the server; a warning is printed.
+
+`--edges 0 1 2 4` repeats every mode with the server's clients on that many edge processes
+(see backend/fanout.py; 0 is the plain server), to show how a room scales with them:
+
+    python benchmarks/load_test.py --clients 2000 --rooms 1 --spectators 1996 --modes unlimited --edges 0 1 2 4
+
+Players stacked on the spawn points would block every move of a crowded room, so the
+audience joins as spectators (`--spectators`): they receive every broadcast and send nothing.
+CPU and memory are then those of the owner and its edges together, and loop lag is the owner's.
+
+`--chunks` joins every client with a view of its own (see backend/interest.py): the maze
+chunks around its player, or around the goal for a spectator. Compare the traffic per
+client over maze sizes:
+
+    python benchmarks/load_test.py --modes unlimited --chunks --width 2001 --height 2001
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import pathlib
+import random
+import resource
+import shlex
+import socket
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / 'backend'))
+
+import aiohttp  # noqa: E402
+import numpy as np  # noqa: E402
+from aiohttp import web  # noqa: E402
+from protocol import (FRAME_PATCH, FRAME_STATE, FRAME_VIEW, PATCH_COMMAND_LIMIT, PATCH_HEADER, PATCH_MODE,  # noqa: E402
+                      PATCH_TURN_INFO, PHASES, STATE_HEADER)
+from game import GAME_MODES  # noqa: E402
+
+DIRECTIONS = ('⬆️', '⬇️', '⬅️', '➡️')
+MODE_IDS = {mode: mode_id for mode_id, mode in GAME_MODES.items()}
+LAG_INTERVAL = 0.05  # Seconds between event loop lag probes
+CONNECT_CONCURRENCY = 50
+DRAIN_SECONDS = 2  # How long clients wait for outstanding acks after the run
+TURN_COMMANDS = 5  # Commands a turn-based client queues per round, the server's default limit
+
+
+# --- Server process ---
+def _raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+def _rss_bytes(pid='self'):
+    """Current resident set size, read from /proc (Linux); 0 where it is not available."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def _cpu_seconds(pids):
+    """CPU time of this process plus the processes `pids`, the latter read from /proc (Linux)."""
+    total = time.process_time()
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                # The fields after the parenthesised command name; utime and stime are 14 and 15
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        except OSError:
+            pass
+    return total
+
+def _run_server(server_argv, pipe):
+    import server
+    _raise_file_limit()
+    args = server.parse_args(server_argv)
+    edges = None
+    if args.edges:
+        import fanout
+        edges = fanout.spawn_edges(args, host='127.0.0.1') # Forked before the event loop starts
+    asyncio.run(_serve(server, args, pipe, edges))
+
+async def _serve(server, args, pipe, edges):
+    loop = asyncio.get_running_loop()
+    if edges:
+        import fanout
+        owner = fanout.Owner(server.make_app(args))
+        await owner.start(edges)
+        stop = owner.close
+    else:
+        runner = web.AppRunner(server.make_app(args))
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', args.port).start()
+        stop = runner.cleanup
+    edge_pids = [process.pid for process, _ in edges or ()]
+
+    lag = []
+    probe = asyncio.create_task(_probe_lag(lag))
+    cpu_started = _cpu_seconds(edge_pids)
+    pipe.send('ready')
+    while True:
+        command = await loop.run_in_executor(None, pipe.recv)
+        if command == 'reset':
+            lag.clear()
+            cpu_started = _cpu_seconds(edge_pids)
+        elif command == 'stats':
+            pipe.send({
+                "lag": list(lag),
+                "cpu_seconds": _cpu_seconds(edge_pids) - cpu_started,
+                "rss": _rss_bytes() + sum(_rss_bytes(pid) for pid in edge_pids),
+                "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            })
+        elif command == 'stop':
+            break
+    probe.cancel()
+    await stop()
+
+async def _probe_lag(samples):
+    """How late the event loop wakes up a sleeping task, sampled every LAG_INTERVAL."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        samples.append(loop.time() - started - LAG_INTERVAL)
+
+
+# --- Client processes ---
+def _turn_phase(message):
+    """The turn phase a state message sets, or None if it leaves the phase unchanged."""
+    if isinstance(message, bytes):
+        if message[0] in (FRAME_STATE, FRAME_VIEW):
+            return PHASES[message[STATE_HEADER.size]]
+        if message[0] == FRAME_PATCH:
+            flags = message[PATCH_HEADER.size - 1]
+            if not flags & PATCH_TURN_INFO:
+                return None
+            offset = PATCH_HEADER.size + bool(flags & PATCH_MODE) + bool(flags & PATCH_COMMAND_LIMIT)
+            return PHASES[message[offset]]
+        return None
+    data = json.loads(message)
+    if data['type'] == 'gameState':
+        return (data['data'].get('turn_info') or {}).get('phase')
+    if data['type'] == 'statePatch' and 'turn_info' in data['data']:
+        return (data['data']['turn_info'] or {}).get('phase')
+    return None
+
+
+class SimulatedClient:
+    def __init__(self, index, room, options, stats):
+        self.index = index
+        self.room = room
+        self.name = 'admin' if index < options['rooms'] else f"load{index}"
+        self.spectator = index >= options['clients'] - options['spectators']
+        self.options = options
+        self.stats = stats
+        self.ws = None
+        self.pending = {} # Move ref -> loop time it was sent
+        self.next_ref = 0
+        self.phase = None
+        self.collecting = asyncio.Event()
+
+    async def connect(self, session, port):
+        self.ws = await session.ws_connect(f"http://127.0.0.1:{port}/ws?room={self.room}", max_msg_size=0)
+        await self.ws.send_json({"type": "join", "name": self.name, "protocol": self.options['protocol'],
+                                 "spectate": self.spectator, "chunks": self.options['chunks']})
+
+    async def receive(self, window):
+        loop = asyncio.get_running_loop()
+        async for msg in self.ws:
+            now = loop.time()
+            measuring = window[0] <= now < window[1]
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                if msg.data.startswith('{"type": "ack"'):
+                    sent = self.pending.pop(json.loads(msg.data)['ref'], None)
+                    if sent is not None and measuring:
+                        self.stats['latencies'].append(now - sent)
+                    continue
+                size = len(msg.data.encode('utf-8'))
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                size = len(msg.data)
+            else:
+                break
+            if measuring:
+                self.stats['messages'] += 1
+                self.stats['bytes'] += size
+            if self.options['mode'] == 'turn_based':
+                phase = _turn_phase(msg.data)
+                if phase is not None:
+                    if phase == 'collecting' and self.phase != 'collecting':
+                        self.collecting.set()
+                    self.phase = phase
+
+    async def move(self, window):
+        loop = asyncio.get_running_loop()
+        ref = self.next_ref
+        self.next_ref += 1
+        now = loop.time()
+        self.pending[ref] = now
+        await self.ws.send_str(json.dumps({"type": "move", "direction": random.choice(DIRECTIONS), "ref": ref}))
+        if window[0] <= now < window[1]:
+            self.stats['moves'] += 1
+
+    async def play(self, window):
+        if self.spectator:
+            return
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.options['rate']
+        await asyncio.sleep(random.uniform(0, interval)) # Spread the clients over the interval
+        if self.options['mode'] == 'turn_based':
+            while loop.time() < window[1]:
+                try:
+                    await asyncio.wait_for(self.collecting.wait(), window[1] - loop.time())
+                except asyncio.TimeoutError:
+                    return
+                self.collecting.clear()
+                for _ in range(TURN_COMMANDS):
+                    await self.move(window)
+                    await asyncio.sleep(interval)
+                await self.ws.send_json({"type": "toggle_ready"})
+            return
+        next_at = loop.time()
+        while loop.time() < window[1]:
+            await self.move(window)
+            next_at += interval
+            await asyncio.sleep(max(0, next_at - loop.time()))
+
+
+def _run_clients(port, indices, options, results, go, start_at, end_at):
+    _raise_file_limit()
+    results.put(asyncio.run(_run_client_group(port, indices, options, results, go, start_at, end_at)))
+
+async def _run_client_group(port, indices, options, results, go, start_at, end_at):
+    loop = asyncio.get_running_loop()
+    stats = {"latencies": [], "messages": 0, "bytes": 0, "moves": 0, "errors": 0, "cpu_seconds": 0.0}
+    clients = [SimulatedClient(i, f"load{i % options['rooms']}", options, stats) for i in indices]
+    limiter = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(client):
+        async with limiter:
+            await client.connect(session, port)
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(connect(client) for client in clients))
+        results.put('connected')
+        await loop.run_in_executor(None, go.wait)
+
+        # Turn the parent's wall clock window into this loop's clock
+        offset = loop.time() - time.time()
+        window = (start_at.value + offset, end_at.value + offset)
+        receivers = [asyncio.create_task(client.receive(window)) for client in clients]
+        for client in clients:
+            if client.name == 'admin' and options['mode'] != 'unlimited':
+                await client.ws.send_json({"type": "set_mode", "mode_id": MODE_IDS[options['mode']]})
+
+        await asyncio.sleep(max(0, window[0] - loop.time()))
+        cpu_started = time.process_time()
+        players = await asyncio.gather(*(client.play(window) for client in clients), return_exceptions=True)
+        stats['cpu_seconds'] = time.process_time() - cpu_started
+        stats['errors'] += sum(isinstance(result, Exception) for result in players)
+
+        await asyncio.sleep(DRAIN_SECONDS)
+        stats['unanswered'] = sum(len(client.pending) for client in clients)
+        for client in clients:
+            await client.ws.close()
+        await asyncio.gather(*receivers, return_exceptions=True)
+    return stats
+
+
+# --- Orchestration ---
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def run_mode(mode, args, edges=0):
+    context = multiprocessing.get_context('spawn')
+    port = _free_port()
+    server_argv = ['--port', str(port), '--width', str(args.width), '--height', str(args.height)]
+    # Clients may send faster than the per-client rate limit; --server-args can turn it back on
+    server_argv += ['--rate-limit', '0', '--edges', str(edges)] + shlex.split(args.server_args)
+    server_pipe, child_pipe = context.Pipe()
+    # A daemon process may not start processes of its own, such as the edges
+    server = context.Process(target=_run_server, args=(server_argv, child_pipe), daemon=not edges)
+    server.start()
+    if not server_pipe.poll(60) or server_pipe.recv() != 'ready':
+        raise RuntimeError("The server did not start")
+
+    options = {"mode": mode, "rate": args.rate, "rooms": args.rooms, "protocol": args.protocol,
+               "clients": args.clients, "spectators": args.spectators, "chunks": args.chunks}
+    results = context.Queue()
+    go = context.Event()
+    start_at, end_at = context.Value('d', 0.0), context.Value('d', 0.0)
+    groups = [range(i, args.clients, args.client_processes) for i in range(args.client_processes)]
+    clients = [
+        context.Process(target=_run_clients, args=(port, group, options, results, go, start_at, end_at), daemon=True)
+        for group in groups if len(group)
+    ]
+    for process in clients:
+        process.start()
+    for _ in clients:
+        if results.get(timeout=120) != 'connected':
+            raise RuntimeError("A client process failed to connect")
+
+    start_at.value = time.time() + args.warmup
+    end_at.value = start_at.value + args.duration
+    go.set()
+    time.sleep(max(0, start_at.value - time.time()))
+    server_pipe.send('reset')
+    time.sleep(max(0, end_at.value - time.time()))
+    server_pipe.send('stats')
+    server_stats = server_pipe.recv()
+
+    groups_stats = [results.get(timeout=args.duration + 120) for _ in clients]
+    for process in clients:
+        process.join(timeout=10)
+    server_pipe.send('stop')
+    server.join(timeout=10)
+    if server.is_alive():
+        server.terminate()
+    return summarize(mode, args, edges, server_stats, groups_stats)
+
+def summarize(mode, args, edges, server_stats, groups_stats):
+    latencies = np.array([value for stats in groups_stats for value in stats['latencies']]) * 1000
+    lag = np.array(server_stats['lag']) * 1000
+    percentiles = np.percentile(latencies, [50, 95, 99]) if len(latencies) else [float('nan')] * 3
+    return {
+        "mode": mode,
+        "edges": edges,
+        "clients": args.clients,
+        "moves_per_second": sum(stats['moves'] for stats in groups_stats) / args.duration,
+        "latency_ms": dict(zip(('p50', 'p95', 'p99'), map(float, percentiles))),
+        "unanswered_moves": sum(stats['unanswered'] for stats in groups_stats),
+        "messages_per_second": sum(stats['messages'] for stats in groups_stats) / args.duration,
+        "bytes_per_second": sum(stats['bytes'] for stats in groups_stats) / args.duration,
+        "bytes_per_client_per_second": sum(stats['bytes'] for stats in groups_stats) / args.duration / args.clients,
+        "loop_lag_ms": {
+            "p99": float(np.percentile(lag, 99)) if len(lag) else float('nan'),
+            "max": float(lag.max()) if len(lag) else float('nan'),
+        },
+        "server_cpu": server_stats['cpu_seconds'] / args.duration,
+        "rss_mb": server_stats['rss'] / 2**20,
+        "peak_rss_mb": server_stats['peak_rss'] / 2**20,
+        "client_cpu": max(stats['cpu_seconds'] for stats in groups_stats) / args.duration,
+        "client_errors": sum(stats['errors'] for stats in groups_stats),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--rate', type=float, default=2, help="Moves per second per client")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds measured per mode")
+    parser.add_argument('--warmup', type=float, default=2, help="Seconds between connecting and measuring")
+    parser.add_argument('--modes', nargs='+', choices=list(MODE_IDS), default=list(MODE_IDS))
+    parser.add_argument('--rooms', type=int, default=None,
+                        help="Spread the clients over this many rooms (default: 4 clients per room)")
+    parser.add_argument('--spectators', type=int, default=0,
+                        help="Clients (out of --clients) that only watch their room: they join as spectators "
+                             "and receive its broadcasts, but send nothing")
+    parser.add_argument('--protocol', choices=('json', 'binary'), default='json')
+    parser.add_argument('--chunks', action='store_true',
+                        help="Clients see only the maze chunks around them instead of the whole room")
+    parser.add_argument('--width', type=int, default=25)
+    parser.add_argument('--height', type=int, default=25)
+    parser.add_argument('--edges', type=int, nargs='+', default=[0],
+                        help="Run every mode with each of these numbers of edge processes (0: the plain server)")
+    parser.add_argument('--server-args', default='', help="Extra arguments for the server, e.g. \"--outbox-limit 16\"")
+    parser.add_argument('--client-processes', type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)))
+    parser.add_argument('--json', help="Also write the results to this file")
+    args = parser.parse_args()
+    if args.rooms is None:
+        # Players sharing a spawn point block each other's moves, so more than 4 per room mostly stand still
+        args.rooms = max(1, args.clients // 4)
+    if args.rooms > args.clients:
+        parser.error("--rooms must not exceed --clients")
+    if not 0 <= args.spectators <= args.clients - args.rooms:
+        parser.error("--spectators must leave at least one player per room")
+    if min(args.edges) < 0:
+        parser.error("--edges must not be negative")
+
+    results = []
+    print(f"{'mode':>11} {'edges':>5} {'moves/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'msgs/s':>9} "
+          f"{'MB/s':>7} {'KB/s/cl':>8} {'lag p99':>8} {'lag max':>8} {'cpu':>5} {'rss MB':>7}")
+    for mode in args.modes:
+        for edges in args.edges:
+            result = run_mode(mode, args, edges)
+            results.append(result)
+            latency, lag = result['latency_ms'], result['loop_lag_ms']
+            print(f"{mode:>11} {edges:>5} {result['moves_per_second']:>8.0f} {latency['p50']:>8.1f} "
+                  f"{latency['p95']:>8.1f} {latency['p99']:>8.1f} {result['messages_per_second']:>9.0f} "
+                  f"{result['bytes_per_second'] / 2**20:>7.2f} {result['bytes_per_client_per_second'] / 2**10:>8.2f} "
+                  f"{lag['p99']:>8.1f} {lag['max']:>8.1f} "
+                  f"{result['server_cpu']:>5.0%} {result['rss_mb']:>7.1f}")
+            if result['client_cpu'] > 0.9:
+                print(f"{'':>17} warning: a client process used {result['client_cpu']:.0%} CPU, "
+                      f"add --client-processes")
+            if result['client_errors'] or result['unanswered_moves']:
+                print(f"{'':>17} {result['client_errors']} client errors, "
+                      f"{result['unanswered_moves']} moves without an ack")
+        base, *runs = results[-len(args.edges):]
+        if runs and base['messages_per_second']:
+            print(f"{'':>17} messages delivered per second relative to {base['edges']} edges: " + ", ".join(
+                f"{run['edges']} edges x{run['messages_per_second'] / base['messages_per_second']:.2f}" for run in runs))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -15,15 +15,36 @@ document.addEventListener('DOMContentLoaded', () => {
     const gameContainer = document.querySelector('.container');
 
     const TILE_SIZE = 25;
+    // Tiles the camera shows across and down. The server sends the maze chunks around the
+    // player (see backend/interest.py), which reach at least 16 tiles past it on every side.
+    const CAMERA_COLUMNS = 31;
+    const CAMERA_ROWS = 23;
+    const SCROLL_STEP = 8; // Tiles a spectator's arrow key scrolls the camera by
+    const CHUNK_SIZE = 16; // Chunks a whole maze is cut into, like those of a view (maze.CHUNK_SIZE)
     const DIRS = {
         UP: '⬆️',
         DOWN: '⬇️',
         LEFT: '⬅️',
         RIGHT: '➡️'
     };
+    const HINT_ARROWS = { up: DIRS.UP, down: DIRS.DOWN, left: DIRS.LEFT, right: DIRS.RIGHT };
+    // ?room=<id> joins that room instead of the default one, ?protocol=binary switches state
+    // updates to the binary protocol and ?spectate watches the room without a player
+    const params = new URLSearchParams(window.location.search);
+    const spectating = params.has('spectate');
     let myId = null;
     let gameState = {};
+    let maze = null; // Chunk cache: { width, height, chunkSize, chunks: Map of "cx,cy" -> Uint8Array, 1 for walls, layers }
+    let camera = null; // { x, y, columns, rows } in tiles
+    let drawPending = false; // A frame is already requested; see requestDraw()
+    let predictedPaths = null; // calculatePredictedPaths() until commands, positions or walls change
+    let stateSeq = null;
     let ws = null;
+    let timeline = null; // Turn-based round being animated from a turnTimeline message
+    let deferredMessages = []; // Messages that arrived during the animation, handled once it ends
+    let resumeKey = null; // sessionStorage key of this room's {id, token}, to get our player back after a restart
+    let reconnectAttempts = 0;
+    const RECONNECT_DELAYS = [500, 1000, 2000, 4000, 8000]; // ms, the last one repeats
 
     // --- Login Logic ---
     function initLogin() {
@@ -54,15 +75,36 @@ document.addEventListener('DOMContentLoaded', () => {
 
 
     function setupWebSocket(name) {
-        ws = new WebSocket(`ws://${window.location.host}/ws`);
+        const room = params.get('room');
+        const protocol = params.get('protocol') === 'binary' ? 'binary' : 'json';
+        const query = room ? `?room=${encodeURIComponent(room)}` : '';
+        resumeKey = `resume:${room || 'default'}`;
+        ws = new WebSocket(`ws://${window.location.host}/ws${query}`);
+        ws.binaryType = 'arraybuffer';
         console.log("Setting up WebSocket...");
         ws.onopen = () => {
             console.log('✅ WebSocket connection established.');
-            ws.send(JSON.stringify({ type: 'join', name: name }));
+            reconnectAttempts = 0;
+            // We can take just the chunks of the maze around us. The server only sends a view
+            // like that if the maze is bigger than one, and the whole room otherwise.
+            const join = { type: 'join', name: name, protocol: protocol, chunks: true };
+            if (spectating) {
+                join.spectate = true;
+                if (camera) join.viewport = [camera.x, camera.y, camera.columns, camera.rows];
+            }
+            // If the server restarted, it may still hold our player and hand it back
+            const resume = sessionStorage.getItem(resumeKey);
+            if (resume && !spectating) join.resume = JSON.parse(resume);
+            ws.send(JSON.stringify(join));
         };
         ws.onclose = () => {
             console.error('❌ WebSocket connection closed.');
-            gameStatusEl.textContent = 'Отключено от сервера.';
+            gameStatusEl.textContent = 'Отключено от сервера. Переподключение...';
+            // Whatever arrives after reconnecting starts from a full state
+            stateSeq = null;
+            const delay = RECONNECT_DELAYS[Math.min(reconnectAttempts, RECONNECT_DELAYS.length - 1)];
+            reconnectAttempts++;
+            setTimeout(() => setupWebSocket(name), delay);
         };
         ws.onerror = (err) => console.error('❌ WebSocket error:', err);
         ws.onmessage = handleServerMessage;
@@ -70,41 +112,445 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function handleServerMessage(event) {
         console.log("⬇️ Received message from server:", event.data);
-        const message = JSON.parse(event.data);
+        const message = typeof event.data === 'string' ? JSON.parse(event.data) : decodeBinaryFrame(event.data);
+        if (timeline) {
+            // The state after the round is already here; show it once the animation reaches it
+            deferredMessages.push(message);
+            return;
+        }
+        handleMessage(message);
+    }
+
+    function handleMessage(message) {
         switch (message.type) {
             case 'welcome':
                 myId = message.id;
+                if (message.resume_token) {
+                    sessionStorage.setItem(resumeKey, JSON.stringify({ id: message.id, token: message.resume_token }));
+                }
+                break;
+            case 'gameState': {
+                const previous = gameState;
+                gameState = message.data;
+                stateSeq = message.seq;
+                predictedPaths = null;
+                loadMaze(gameState);
+                onStateUpdated(previous.mode, previous.turn_info?.phase);
                 break;
-            case 'gameState':
+            }
+            case 'statePatch': {
+                if (stateSeq === null || message.seq !== stateSeq + 1) {
+                    // Missed a patch: drop it and ask the server for the full state
+                    console.warn(`State patch ${message.seq} does not follow ${stateSeq}, requesting resync.`);
+                    stateSeq = null;
+                    ws.send(JSON.stringify({ type: 'resync' }));
+                    break;
+                }
                 const oldMode = gameState.mode;
                 const oldTurnPhase = gameState.turn_info?.phase;
-                gameState = message.data;
+                applyStatePatch(message.data);
+                stateSeq = message.seq;
+                onStateUpdated(oldMode, oldTurnPhase);
+                break;
+            }
+            case 'gameEvent':
+                handleGameEvent(message.data);
+                break;
+            case 'turnTimeline':
+                playTimeline(message.data);
+                break;
+            case 'hint':
+                gameStatusEl.textContent = message.direction
+                    ? `Подсказка: ${HINT_ARROWS[message.direction]}`
+                    : 'Подсказка недоступна.';
+                break;
+        }
+    }
 
-                if (gameState.mode === 'turn_based' && oldTurnPhase === 'executing' && gameState.turn_info.phase === 'collecting') {
-                    // Game is resetting for a new turn
-                } else if (oldMode && oldMode !== gameState.mode) {
-                    gameStatusEl.textContent = 'Админ сменил режим игры! Новая игра началась.';
+    // --- Turn Timeline ---
+    // In timeline execution the server runs a whole turn-based round at once and sends every
+    // step of it in one message. Each step highlights its command for half of step_seconds,
+    // then moves the players it lists and shows its events.
+    function playTimeline(data) {
+        timeline = {
+            steps: data.steps,
+            startMs: data.start_seconds * 1000,
+            stepMs: data.step_seconds * 1000,
+            startedAt: performance.now(),
+            applied: 0
+        };
+        gameState.turn_info = { phase: 'executing', executing_command: null };
+        requestDraw();
+        window.requestAnimationFrame(animateTimeline);
+    }
+
+    function animateTimeline(now) {
+        const { steps, startMs, stepMs } = timeline;
+        const elapsed = now - timeline.startedAt - startMs;
+        let changed = false;
+        while (timeline.applied < steps.length && elapsed >= (timeline.applied + 0.5) * stepMs) {
+            const step = steps[timeline.applied++];
+            for (const [id, [x, y]] of Object.entries(step.positions)) {
+                const player = gameState.players[id];
+                if (player) {
+                    player.x = x;
+                    player.y = y;
                 }
-                // When game state arrives, ensure UI components are in the correct state
-                gameModeSelect.value = Object.entries(GAME_MODES).find(([id, name]) => name === gameState.mode)?.[0] || '1';
-                commandLimitInput.value = gameState.command_limit;
+            }
+            step.events.forEach(handleGameEvent);
+            predictedPaths = null;
+            changed = true;
+        }
 
-                updateAdminControls();
-                window.requestAnimationFrame(draw);
-                break;
+        const index = Math.floor(elapsed / stepMs);
+        if (elapsed >= 0 && index >= steps.length) {
+            finishTimeline();
+            return;
+        }
+        const step = steps[index];
+        const executing = gameState.turn_info.executing_command;
+        if (step ? !executing || executing.player_id !== step.player_id || executing.command_index !== step.command_index : executing) {
+            gameState.turn_info.executing_command = step ? { player_id: step.player_id, command_index: step.command_index } : null;
+            changed = true;
+        }
+        // Most frames only check the clock; the canvas is redrawn when a step starts or moves players
+        if (changed) draw();
+        window.requestAnimationFrame(animateTimeline);
+    }
+
+    function finishTimeline() {
+        timeline = null;
+        gameState.turn_info.executing_command = null;
+        const messages = deferredMessages;
+        deferredMessages = [];
+        messages.forEach(handleMessage);
+        requestDraw();
+    }
+
+    function handleGameEvent(event) {
+        switch (event.type) {
             case 'game_over':
-                const winner = gameState.players[message.winner_id];
+                const winner = gameState.players[event.winner_id];
                 const winnerName = winner ? winner.name : 'Неизвестный игрок';
-                const winnerColor = message.winner_color;
-                const winnerText = message.winner_id === myId ? "Вы победили!" : `Победил ${winnerName}!`;
+                const winnerColor = event.winner_color;
+                const winnerText = event.winner_id === myId ? "Вы победили!" : `Победил ${winnerName}!`;
                 gameStatusEl.innerHTML = `<span style="color:${winnerColor}; font-weight:bold;">${winnerText}</span>`;
                 break;
             case 'notification':
-                gameStatusEl.textContent = message.message;
+                gameStatusEl.textContent = event.message;
                 break;
         }
     }
 
+    // --- Binary Protocol ---
+    // Decodes the frames described in backend/protocol.py into the same messages the JSON protocol sends.
+    const FRAME_STATE = 1;
+    const FRAME_PATCH = 2;
+    const FRAME_EVENT = 3;
+    const FRAME_VIEW = 4;
+    const EVENT_GAME_OVER = 1;
+    const PATCH_MODE = 1;
+    const PATCH_COMMAND_LIMIT = 2;
+    const PATCH_TURN_INFO = 4;
+    const PATCH_AREA = 8;
+    const PATCH_CHUNKS = 16;
+    const BINARY_MODES = ['unlimited', 'slots', 'turn_based'];
+    const BINARY_PHASES = [null, 'collecting', 'executing'];
+    const BINARY_TRAP_KINDS = ['return_to_start', 'swap_positions'];
+    const BINARY_COMMANDS = [DIRS.UP, DIRS.DOWN, DIRS.LEFT, DIRS.RIGHT];
+    const MAX_COMMANDS = 10;
+    const NAME_BYTES = 32;
+    const textDecoder = new TextDecoder();
+
+    function decodeBinaryFrame(buffer) {
+        const view = new DataView(buffer);
+        const bytes = new Uint8Array(buffer);
+        let offset = 0;
+
+        const u8 = () => view.getUint8(offset++);
+        const u16 = () => { const value = view.getUint16(offset, true); offset += 2; return value; };
+        const u32 = () => { const value = view.getUint32(offset, true); offset += 4; return value; };
+        const i32 = () => { const value = view.getInt32(offset, true); offset += 4; return value; };
+        const hex = (length) => {
+            let out = '';
+            for (let i = 0; i < length; i++) out += bytes[offset + i].toString(16).padStart(2, '0');
+            offset += length;
+            return out;
+        };
+        const uuid = () => {
+            const h = hex(16);
+            return `${h.slice(0, 8)}-${h.slice(8, 12)}-${h.slice(12, 16)}-${h.slice(16, 20)}-${h.slice(20)}`;
+        };
+        const turnInfo = () => {
+            const phase = BINARY_PHASES[u8()];
+            const isExecuting = bytes.subarray(offset, offset + 16).some(b => b !== 0);
+            const playerId = uuid();
+            const commandIndex = u8();
+            if (!phase) return null;
+            return {
+                phase,
+                executing_command: isExecuting ? { player_id: playerId, command_index: commandIndex } : null
+            };
+        };
+        const trap = () => [`${u16()},${u16()}`, BINARY_TRAP_KINDS[u8()]];
+        const area = () => [u16(), u16(), u16(), u16()];
+        const chunks = (count, size) => {
+            const decoded = {};
+            const length = size * size / 8;
+            for (let i = 0; i < count; i++) {
+                const key = `${u16()},${u16()}`;
+                decoded[key] = decodeWallBits(bytes.subarray(offset, offset + length), size * size);
+                offset += length;
+            }
+            return decoded;
+        };
+        const player = () => {
+            const id = uuid();
+            const x = u16();
+            const y = u16();
+            const distance = i32();
+            const color = '#' + hex(3).toUpperCase();
+            const slots = u8();
+            const isReady = u8() === 1;
+            const commandCount = u8();
+            const commands = Array.from(bytes.subarray(offset, offset + commandCount), code => BINARY_COMMANDS[code]);
+            offset += MAX_COMMANDS;
+            const nameBytes = bytes.subarray(offset, offset + NAME_BYTES);
+            const nameEnd = nameBytes.indexOf(0);
+            const name = textDecoder.decode(nameEnd === -1 ? nameBytes : nameBytes.subarray(0, nameEnd));
+            offset += NAME_BYTES;
+            return { name, id, x, y, distance, color, slots, commands, is_ready: isReady };
+        };
+
+        const tag = u8();
+        if (tag === FRAME_EVENT) {
+            if (u8() === EVENT_GAME_OVER) {
+                const winnerId = uuid();
+                return { type: 'gameEvent', data: { type: 'game_over', winner_id: winnerId, winner_color: '#' + hex(3).toUpperCase() } };
+            }
+            const length = u16();
+            const text = textDecoder.decode(bytes.subarray(offset, offset + length));
+            return { type: 'gameEvent', data: { type: 'notification', message: text } };
+        }
+
+        const seq = u32();
+        if (tag === FRAME_STATE) {
+            const width = u16();
+            const height = u16();
+            const data = { maze_size: [width, height], goal: [u16(), u16()], mode: BINARY_MODES[u8()], command_limit: u8(), players: {}, traps: {} };
+            const info = turnInfo();
+            if (info) data.turn_info = info;
+            const playerCount = u16();
+            u16();
+            u16();
+            const trapCount = u32();
+            u32();
+            data.maze = decodeWallBits(bytes.subarray(offset, offset + Math.ceil(width * height / 8)), width * height);
+            offset += Math.ceil(width * height / 8);
+            for (let i = 0; i < trapCount; i++) {
+                const [pos, kind] = trap();
+                data.traps[pos] = kind;
+            }
+            for (let i = 0; i < playerCount; i++) {
+                const p = player();
+                data.players[p.id] = p;
+            }
+            return { type: 'gameState', seq, data };
+        }
+        if (tag === FRAME_VIEW) {
+            const data = { maze_size: [u16(), u16()], goal: [u16(), u16()], mode: BINARY_MODES[u8()], command_limit: u8(), players: {}, traps: {} };
+            const info = turnInfo();
+            if (info) data.turn_info = info;
+            const playerCount = u16();
+            u16();
+            u16();
+            const trapCount = u32();
+            u32();
+            data.area = area();
+            data.chunk_size = u8();
+            data.chunks = chunks(u16(), data.chunk_size);
+            for (let i = 0; i < trapCount; i++) {
+                const [pos, kind] = trap();
+                data.traps[pos] = kind;
+            }
+            for (let i = 0; i < playerCount; i++) {
+                const p = player();
+                data.players[p.id] = p;
+            }
+            return { type: 'gameState', seq, data };
+        }
+
+        const flags = u8();
+        const patch = {};
+        if (flags & PATCH_MODE) patch.mode = BINARY_MODES[u8()];
+        if (flags & PATCH_COMMAND_LIMIT) patch.command_limit = u8();
+        if (flags & PATCH_TURN_INFO) patch.turn_info = turnInfo();
+        if (flags & PATCH_AREA) patch.area = area();
+        const changedCount = u16();
+        const movedCount = u16();
+        const removedCount = u16();
+        const trapCount = u32();
+        const removedTrapCount = u32();
+        if (changedCount || movedCount) {
+            patch.players = {};
+            for (let i = 0; i < changedCount; i++) {
+                const p = player();
+                patch.players[p.id] = p;
+            }
+            for (let i = 0; i < movedCount; i++) {
+                const id = uuid();
+                patch.players[id] = { x: u16(), y: u16(), distance: i32() };
+            }
+        }
+        if (removedCount) patch.removed_players = Array.from({ length: removedCount }, uuid);
+        if (trapCount) patch.traps = Object.fromEntries(Array.from({ length: trapCount }, trap));
+        if (removedTrapCount) patch.removed_traps = Array.from({ length: removedTrapCount }, () => `${u16()},${u16()}`);
+        if (flags & PATCH_CHUNKS) patch.chunks = chunks(u16(), maze.chunkSize);
+        return { type: 'statePatch', seq, data: patch };
+    }
+
+    function decodeWallBits(bits, count) {
+        const cells = new Uint8Array(count);
+        for (let i = 0; i < cells.length; i++) {
+            cells[i] = (bits[i >> 3] >> (i & 7)) & 1;
+        }
+        return cells;
+    }
+
+    // --- Maze Chunks ---
+    // A view's maze arrives in square chunks: all of the client's area in a gameState, then
+    // the chunks that come into it with the patches that move it. A whole maze, sent to
+    // rooms small enough to fit in a view, is cut into the same chunks here. Both protocols
+    // end up as one Uint8Array per chunk. Each chunk's walls are drawn once, into a canvas of
+    // its own (maze.layers), which frames then copy; see chunkLayer().
+    function loadMaze(data) {
+        if (data.maze) {
+            // JSON sends rows of '#', ' ' and 'G', binary a Uint8Array of cells with its size
+            const rows = Array.isArray(data.maze) ? data.maze : null;
+            const [width, height] = rows ? [rows[0].length, rows.length] : data.maze_size;
+            const isWallCell = rows ? (x, y) => rows[y][x] === '#' : (x, y) => data.maze[y * width + x] === 1;
+            maze = { width, height, chunkSize: CHUNK_SIZE, chunks: new Map(), layers: new Map() };
+            storeChunks(cutIntoChunks(width, height, isWallCell));
+            delete data.maze;
+            return;
+        }
+        maze = { width: data.maze_size[0], height: data.maze_size[1], chunkSize: data.chunk_size, chunks: new Map(), layers: new Map() };
+        storeChunks(data.chunks);
+        delete data.chunks;
+    }
+
+    function cutIntoChunks(width, height, isWallCell) {
+        const chunks = {};
+        for (let cy = 0; cy * CHUNK_SIZE < height; cy++) {
+            for (let cx = 0; cx * CHUNK_SIZE < width; cx++) {
+                // Cells past the edges of the maze are walls, as in the chunks of a view
+                const cells = new Uint8Array(CHUNK_SIZE * CHUNK_SIZE).fill(1);
+                for (let y = cy * CHUNK_SIZE; y < Math.min(height, (cy + 1) * CHUNK_SIZE); y++) {
+                    for (let x = cx * CHUNK_SIZE; x < Math.min(width, (cx + 1) * CHUNK_SIZE); x++) {
+                        cells[(y % CHUNK_SIZE) * CHUNK_SIZE + x % CHUNK_SIZE] = isWallCell(x, y) ? 1 : 0;
+                    }
+                }
+                chunks[`${cx},${cy}`] = cells;
+            }
+        }
+        return chunks;
+    }
+
+    function storeChunks(chunks) {
+        for (const [key, cells] of Object.entries(chunks || {})) {
+            maze.chunks.set(key, Array.isArray(cells) ? rowsToCells(cells, maze.chunkSize) : cells);
+            maze.layers.delete(key);
+        }
+    }
+
+    function rowsToCells(rows, size) {
+        // JSON chunks are rows of '#', ' ' and 'G', cut short at the edges of the maze
+        const cells = new Uint8Array(size * size).fill(1);
+        rows.forEach((row, y) => {
+            for (let x = 0; x < row.length; x++) cells[y * size + x] = row[x] === '#' ? 1 : 0;
+        });
+        return cells;
+    }
+
+    function dropChunksOutside([cx0, cy0, cx1, cy1]) {
+        for (const key of maze.chunks.keys()) {
+            const [cx, cy] = key.split(',').map(Number);
+            if (cx < cx0 || cx >= cx1 || cy < cy0 || cy >= cy1) {
+                maze.chunks.delete(key);
+                maze.layers.delete(key);
+            }
+        }
+    }
+
+    // The walls of a held chunk, drawn into an offscreen canvas the first time the camera shows it
+    function chunkLayer(key) {
+        let layer = maze.layers.get(key);
+        if (layer) return layer;
+        const cells = maze.chunks.get(key);
+        if (!cells) return null;
+        const size = maze.chunkSize;
+        layer = document.createElement('canvas');
+        layer.width = layer.height = size * TILE_SIZE;
+        const layerCtx = layer.getContext('2d');
+        layerCtx.fillStyle = '#607d8b';
+        for (let i = 0; i < cells.length; i++) {
+            if (cells[i]) layerCtx.fillRect((i % size) * TILE_SIZE, Math.floor(i / size) * TILE_SIZE, TILE_SIZE, TILE_SIZE);
+        }
+        maze.layers.set(key, layer);
+        return layer;
+    }
+
+    // 1 for a wall, 0 for a path, undefined for a cell whose chunk the client does not hold
+    function cellAt(x, y) {
+        if (x < 0 || y < 0 || x >= maze.width || y >= maze.height) return 1;
+        const size = maze.chunkSize;
+        const chunk = maze.chunks.get(`${Math.floor(x / size)},${Math.floor(y / size)}`);
+        return chunk && chunk[(y % size) * size + x % size];
+    }
+
+    function isWall(x, y) {
+        return cellAt(x, y) !== 0;
+    }
+
+    function applyStatePatch(patch) {
+        // Ready flags, slots and distances leave the predicted paths as they are
+        if (Object.values(patch.players || {}).some(p => 'commands' in p || 'x' in p || 'y' in p)
+            || patch.removed_players || patch.chunks || 'mode' in patch || 'command_limit' in patch) {
+            predictedPaths = null;
+        }
+        for (const [id, fields] of Object.entries(patch.players || {})) {
+            gameState.players[id] = Object.assign(gameState.players[id] || {}, fields);
+        }
+        for (const id of patch.removed_players || []) {
+            delete gameState.players[id];
+        }
+        Object.assign(gameState.traps, patch.traps || {});
+        for (const pos of patch.removed_traps || []) {
+            delete gameState.traps[pos];
+        }
+        for (const key of ['mode', 'command_limit', 'turn_info', 'area']) {
+            if (key in patch) {
+                gameState[key] = patch[key];
+            }
+        }
+        if (patch.area) dropChunksOutside(patch.area);
+        storeChunks(patch.chunks);
+    }
+
+    function onStateUpdated(oldMode, oldTurnPhase) {
+        if (gameState.mode === 'turn_based' && oldTurnPhase === 'executing' && gameState.turn_info?.phase === 'collecting') {
+            // Game is resetting for a new turn
+        } else if (oldMode && oldMode !== gameState.mode) {
+            gameStatusEl.textContent = 'Админ сменил режим игры! Новая игра началась.';
+        }
+        // When game state arrives, ensure UI components are in the correct state
+        gameModeSelect.value = Object.entries(GAME_MODES).find(([id, name]) => name === gameState.mode)?.[0] || '1';
+        commandLimitInput.value = gameState.command_limit;
+
+        updateAdminControls();
+        requestDraw();
+    }
+
     function updateAdminControls() {
         const me = gameState.players?.[myId];
         const isAdmin = me && me.name.toLowerCase() === 'admin';
@@ -122,33 +568,96 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // Frames are drawn on demand: whatever changes the state or the camera calls requestDraw(),
+    // and any number of calls before the next frame draw it once.
+    function requestDraw() {
+        if (drawPending) return;
+        drawPending = true;
+        window.requestAnimationFrame(() => {
+            drawPending = false;
+            draw();
+        });
+    }
+
     function draw() {
-        if (!gameState.maze) return;
-        
-        canvas.width = gameState.maze[0].length * TILE_SIZE;
-        canvas.height = gameState.maze.length * TILE_SIZE;
+        if (!maze) return;
+
+        updateCamera();
+        const width = camera.columns * TILE_SIZE;
+        const height = camera.rows * TILE_SIZE;
+        if (canvas.width !== width || canvas.height !== height) {
+            // Setting the size reallocates the canvas, so only when the camera changes it
+            canvas.width = width;
+            canvas.height = height;
+        }
 
         ctx.clearRect(0, 0, canvas.width, canvas.height);
-        
+
+        // The layers are drawn in maze coordinates, shifted by the camera
+        ctx.save();
+        ctx.translate(-camera.x * TILE_SIZE, -camera.y * TILE_SIZE);
         drawMaze();
         drawTraps();
         drawPlayers();
         drawPredictedPaths(); // Updated call
+        ctx.restore();
         drawPlayerList();
         drawUI();
     }
 
+    // --- Camera ---
+    // A player's camera follows its player; a spectator's is scrolled with the arrow keys,
+    // starting at the goal. It never shows more than the maze.
+    function updateCamera() {
+        const columns = Math.min(maze.width, CAMERA_COLUMNS);
+        const rows = Math.min(maze.height, CAMERA_ROWS);
+        const me = gameState.players?.[myId];
+        let center = null;
+        if (me) center = [me.x, me.y];
+        else if (!camera) center = gameState.goal;
+        const x = center ? center[0] - Math.floor(columns / 2) : camera.x;
+        const y = center ? center[1] - Math.floor(rows / 2) : camera.y;
+        camera = {
+            x: Math.max(0, Math.min(x, maze.width - columns)),
+            y: Math.max(0, Math.min(y, maze.height - rows)),
+            columns,
+            rows
+        };
+    }
+
+    function onCamera(x, y) {
+        return x >= camera.x && x < camera.x + camera.columns && y >= camera.y && y < camera.y + camera.rows;
+    }
+
+    function scrollCamera(dx, dy) {
+        if (!maze) return;
+        camera.x += dx;
+        camera.y += dy;
+        updateCamera();
+        if (gameState.area) {
+            // The server moves the spectator's area along, sending the chunks that come into it
+            ws.send(JSON.stringify({ type: 'viewport', viewport: [camera.x, camera.y, camera.columns, camera.rows] }));
+        }
+        requestDraw();
+    }
+
     function drawMaze() {
-        const { maze, goal } = gameState;
-        for (let y = 0; y < maze.length; y++) {
-            for (let x = 0; x < maze[y].length; x++) {
-                if (maze[y][x] === '#') {
-                    ctx.fillStyle = '#607d8b';
-                    ctx.fillRect(x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE);
+        // Only the chunks under the camera; those the client does not hold are shaded
+        const size = maze.chunkSize;
+        const chunkPixels = size * TILE_SIZE;
+        for (let cy = Math.floor(camera.y / size); cy <= Math.floor((camera.y + camera.rows - 1) / size); cy++) {
+            for (let cx = Math.floor(camera.x / size); cx <= Math.floor((camera.x + camera.columns - 1) / size); cx++) {
+                const layer = chunkLayer(`${cx},${cy}`);
+                if (layer) {
+                    ctx.drawImage(layer, cx * chunkPixels, cy * chunkPixels);
+                } else {
+                    ctx.fillStyle = '#37474f';
+                    ctx.fillRect(cx * chunkPixels, cy * chunkPixels, chunkPixels, chunkPixels);
                 }
             }
         }
         // Draw Goal
+        const { goal } = gameState;
         ctx.fillStyle = '#ffc107';
         ctx.fillRect(goal[0] * TILE_SIZE, goal[1] * TILE_SIZE, TILE_SIZE, TILE_SIZE);
     }
@@ -157,6 +666,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const { traps } = gameState;
         for (const [pos, type] of Object.entries(traps)) {
             const [x, y] = pos.split(',').map(Number);
+            if (!onCamera(x, y)) continue;
             ctx.fillStyle = type === 'return_to_start' ? '#f44336' : '#9c27b0';
             ctx.beginPath();
             ctx.arc(x * TILE_SIZE + TILE_SIZE / 2, y * TILE_SIZE + TILE_SIZE / 2, TILE_SIZE / 3, 0, Math.PI * 2);
@@ -164,32 +674,43 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // The order a turn-based round runs commands in: by lowercased name, like the server's
+    // sorted(..., key=lambda p: p.name.lower()). Python compares code points, so the names are
+    // compared that way too rather than by UTF-16 units; ties keep join order, as both sorts are stable.
+    function roundOrder(players) {
+        const keys = new Map(players.map(p => [p, Array.from(p.name.toLowerCase(), c => c.codePointAt(0))]));
+        return players.slice().sort((a, b) => {
+            const keyA = keys.get(a);
+            const keyB = keys.get(b);
+            for (let i = 0; i < Math.min(keyA.length, keyB.length); i++) {
+                if (keyA[i] !== keyB[i]) return keyA[i] - keyB[i];
+            }
+            return keyA.length - keyB.length;
+        });
+    }
+
+    function getPredictedPaths() {
+        if (!predictedPaths) predictedPaths = calculatePredictedPaths();
+        return predictedPaths;
+    }
+
     function calculatePredictedPaths() {
         if (gameState.mode !== 'turn_based' || !gameState.players) {
             return {};
         }
 
-        let simulatedPlayers = JSON.parse(JSON.stringify(gameState.players));
+        // Positions are simulated on their own, in the players' order, as the server does on its arrays.
+        // Outside the chunks the client holds the walls are unknown: a player who walks there, or who
+        // may run into someone who did, is lost. Its path ends, and from then on it is only known to
+        // be within one cell per move of where it was lost.
+        const players = Object.values(gameState.players);
+        const positions = players.map(p => ({ x: p.x, y: p.y })); // null once lost
+        const lost = []; // { x, y, step }: where a lost player was last known, and at which move
         const paths = {};
-        for (const p of Object.values(simulatedPlayers)) {
-            paths[p.id] = [{x: p.x, y: p.y}];
-        }
-        
-        const sortedPlayers = Object.values(simulatedPlayers).sort((a, b) => {
-            const nameA = a.name.toLowerCase();
-            const nameB = b.name.toLowerCase();
-            if (nameA < nameB) return -1;
-            if (nameA > nameB) return 1;
-            return 0;
-        });
-        
-        const isWall = (x, y) => {
-            if (y < 0 || y >= gameState.maze.length || x < 0 || x >= gameState.maze[0].length) {
-                return true; 
-            }
-            return gameState.maze[y][x] === '#';
-        };
+        players.forEach((p, i) => paths[p.id] = [{ ...positions[i] }]);
 
+        const sortedPlayers = roundOrder(players);
+        let step = 0;
         for (let i = 0; i < gameState.command_limit; i++) {
             for (const player of sortedPlayers) {
                 if (i < player.commands.length) {
@@ -201,43 +722,49 @@ document.addEventListener('DOMContentLoaded', () => {
                     else if (direction === DIRS.RIGHT) dx = 1;
 
                     // --- Simulate Global Move ---
-                    const proposedMoves = {};
-                    for (const p of Object.values(simulatedPlayers)) {
-                        const newX = p.x + dx;
-                        const newY = p.y + dy;
-                        if (!isWall(newX, newY)) {
-                            proposedMoves[p.id] = { x: newX, y: newY };
-                        } else {
-                            proposedMoves[p.id] = { x: p.x, y: p.y };
+                    // 1. A player facing a wall intends to stay in place; one facing an unknown cell is lost
+                    const proposedMoves = positions.map(position => {
+                        if (!position) return null;
+                        const cell = cellAt(position.x + dx, position.y + dy);
+                        if (cell === undefined) return undefined;
+                        return cell ? position : { x: position.x + dx, y: position.y + dy };
+                    });
+                    proposedMoves.forEach((target, j) => {
+                        if (target === undefined) {
+                            lost.push({ ...positions[j], step });
+                            positions[j] = null;
                         }
-                    }
+                    });
 
-                    const targetCounts = {};
-                    for (const pos of Object.values(proposedMoves)) {
-                        const key = `${pos.x},${pos.y}`;
-                        targetCounts[key] = (targetCounts[key] || 0) + 1;
-                    }
-                    
-                    const collidingTargets = new Set();
-                    for (const [key, count] of Object.entries(targetCounts)) {
-                        if (count > 1) {
-                            collidingTargets.add(key);
-                        }
+                    // 2. Players aiming for the same tile all stay where they are
+                    const targetCounts = new Map();
+                    for (const target of proposedMoves) {
+                        if (!target) continue;
+                        const key = target.y * maze.width + target.x;
+                        targetCounts.set(key, (targetCounts.get(key) || 0) + 1);
                     }
-                    
-                    for (const p of Object.values(simulatedPlayers)) {
-                        const targetPos = proposedMoves[p.id];
-                        const key = `${targetPos.x},${targetPos.y}`;
-                        if (!collidingTargets.has(key)) {
-                            p.x = targetPos.x;
-                            p.y = targetPos.y;
+
+                    // 3. Everyone else moves, unless a lost player might be aiming for the same tile
+                    const mightCollide = target => lost.some(
+                        l => Math.abs(target.x - l.x) + Math.abs(target.y - l.y) <= step - l.step + 1);
+                    const newlyLost = [];
+                    proposedMoves.forEach((target, j) => {
+                        if (!target || target === positions[j]) return;
+                        if (targetCounts.get(target.y * maze.width + target.x) !== 1) return;
+                        if (mightCollide(target)) {
+                            newlyLost.push({ ...positions[j], step });
+                            positions[j] = null;
+                        } else {
+                            positions[j] = target;
                         }
-                    }
+                    });
+                    lost.push(...newlyLost);
+                    step++;
                     // --- End Simulation ---
-                    
-                    for (const p of Object.values(simulatedPlayers)) {
-                        paths[p.id].push({x: p.x, y: p.y});
-                    }
+
+                    players.forEach((p, j) => {
+                        if (positions[j]) paths[p.id].push(positions[j]);
+                    });
                 }
             }
         }
@@ -249,9 +776,7 @@ document.addEventListener('DOMContentLoaded', () => {
             return;
         }
 
-        const predictedPaths = calculatePredictedPaths();
-        
-        for (const [playerId, path] of Object.entries(predictedPaths)) {
+        for (const [playerId, path] of Object.entries(getPredictedPaths())) {
             if (path.length <= 1) continue;
 
             const player = gameState.players[playerId];
@@ -300,6 +825,7 @@ document.addEventListener('DOMContentLoaded', () => {
     function drawPlayers() {
         const { players } = gameState;
         for (const [id, player] of Object.entries(players)) {
+            if (!onCamera(player.x, player.y)) continue;
             ctx.fillStyle = player.color;
             ctx.beginPath();
             ctx.arc(player.x * TILE_SIZE + TILE_SIZE / 2, player.y * TILE_SIZE + TILE_SIZE / 2, TILE_SIZE / 2 - 2, 0, Math.PI * 2);
@@ -318,21 +844,17 @@ document.addEventListener('DOMContentLoaded', () => {
             return;
         }
         let listHtml = '';
-        const sortedPlayers = Object.values(gameState.players).sort((a, b) => {
-            const nameA = a.name.toLowerCase();
-            const nameB = b.name.toLowerCase();
-            if (nameA < nameB) return -1;
-            if (nameA > nameB) return 1;
-            return 0;
-        });
+        // A live leaderboard: whoever is closest to the goal comes first
+        const leaderboard = Object.values(gameState.players).sort((a, b) => a.distance - b.distance);
 
-        for (const player of sortedPlayers) {
+        for (const player of leaderboard) {
             const isMe = player.id === myId;
             const readyClass = player.is_ready ? 'ready' : '';
             listHtml += `
                 <li class="${readyClass}">
                     <span class="player-color-dot" style="background-color: ${player.color};"></span>
                     <span class="player-name">${player.name} ${isMe ? '(Вы)' : ''}</span>
+                    <span class="player-distance">${player.distance}</span>
                 </li>
             `;
         }
@@ -372,14 +894,7 @@ document.addEventListener('DOMContentLoaded', () => {
             }
 
             // Display all player command queues
-            const sortedPlayers = Object.values(gameState.players).sort((a, b) => {
-                const nameA = a.name.toLowerCase();
-                const nameB = b.name.toLowerCase();
-                if (nameA < nameB) return -1;
-                if (nameA > nameB) return 1;
-                return 0;
-            });
-            for (const player of sortedPlayers) {
+            for (const player of roundOrder(Object.values(gameState.players))) {
                 const isMe = player.id === myId;
                 html += `<div class="player-commands">
                     <div class="player-name">${player.name}${isMe ? ' (Вы)' : ''}</div>
@@ -420,6 +935,33 @@ document.addEventListener('DOMContentLoaded', () => {
         // Allow typing in name input
         if (document.activeElement === nameInput) return;
 
+        if (spectating) {
+            switch (e.key) {
+                case 'ArrowUp':
+                case 'w':
+                    scrollCamera(0, -SCROLL_STEP);
+                    break;
+                case 'ArrowDown':
+                case 's':
+                    scrollCamera(0, SCROLL_STEP);
+                    break;
+                case 'ArrowLeft':
+                case 'a':
+                    scrollCamera(-SCROLL_STEP, 0);
+                    break;
+                case 'ArrowRight':
+                case 'd':
+                    scrollCamera(SCROLL_STEP, 0);
+                    break;
+            }
+            return;
+        }
+
+        if (e.key === 'h') {
+            ws.send(JSON.stringify({ type: 'hint' }));
+            return;
+        }
+
         // Turn-based mode specific controls
         if (gameState.mode === 'turn_based') {
             const phase = gameState.turn_info?.phase;
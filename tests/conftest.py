@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# The backend modules import each other by plain name, as when server.py runs from backend/
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent / 'backend'))
@@ -0,0 +1,81 @@
+"""
+execute_global_move resolves every move on the players' position arrays. These tests
+check it against the original per-player loop on random mazes and crowds, through both
+collision counts: the Counter for up to SMALL_COLLISION_CHECK players and np.unique above.
+"""
+import asyncio
+import random
+
+import pytest
+
+from game import DIRECTION_MAP, SMALL_COLLISION_CHECK, Game
+
+DIRECTIONS = ['up', 'down', 'left', 'right', *DIRECTION_MAP]
+
+
+def reference_move(game, positions, direction):
+    """The loop execute_global_move replaced: players facing a wall stay, all players aiming for one tile stay."""
+    mapped_direction = DIRECTION_MAP.get(direction, direction)
+    dx, dy = {'up': (0, -1), 'down': (0, 1), 'left': (-1, 0), 'right': (1, 0)}[mapped_direction]
+    proposed_moves = {}
+    for player_id, (x, y) in positions.items():
+        new_x, new_y = x + dx, y + dy
+        proposed_moves[player_id] = (x, y) if game.is_wall(new_x, new_y) else (new_x, new_y)
+    target_counts = {}
+    for pos in proposed_moves.values():
+        target_counts[pos] = target_counts.get(pos, 0) + 1
+    return {player_id: pos if target_counts[pos] == 1 else positions[player_id]
+            for player_id, pos in proposed_moves.items()}
+
+
+async def crowded_game(rng, players):
+    """A random maze with `players` players packed around one cell, some of them sharing cells, a few gone again."""
+    size = rng.choice([9, 15, 25, 41])
+    game = Game(size, size, seed=rng.getrandbits(32), realtime=False)
+    free = [(x, y) for y in range(size) for x in range(size) if not game.is_wall(x, y)]
+    center_x, center_y = rng.choice(free)
+    radius = rng.choice([2, 4, size])
+    near = [(x, y) for x, y in free if abs(x - center_x) + abs(y - center_y) <= radius]
+    registered = []
+    for i in range(players + players // 5):
+        player = await game.register(f"p{i}")
+        player.x, player.y = rng.choice(near)
+        registered.append(player)
+    # Leaving players are swap-removed from the position arrays
+    for player in rng.sample(registered, players // 5):
+        await game.unregister(player.id)
+    return game
+
+
+@pytest.mark.parametrize('players_range', [(1, SMALL_COLLISION_CHECK), (SMALL_COLLISION_CHECK + 1, 150)],
+                         ids=['counter', 'unique'])
+def test_matches_reference_loop(players_range):
+    rng = random.Random(players_range[0])
+
+    async def play(seed):
+        game = await crowded_game(random.Random(seed), rng.randint(*players_range))
+        assert len(game.players) > 0
+        for _ in range(30):
+            positions = {player_id: (player.x, player.y) for player_id, player in game.players.items()}
+            direction = rng.choice(DIRECTIONS)
+            expected = reference_move(game, positions, direction)
+            game.execute_global_move(direction)
+            assert {player_id: (player.x, player.y) for player_id, player in game.players.items()} == expected
+        game.close()
+
+    for seed in range(100):
+        asyncio.run(play(rng.getrandbits(32) + seed))
+
+
+def test_marks_the_game_changed_only_when_someone_moves():
+    async def play():
+        game = await crowded_game(random.Random(7), 20)
+        for direction in DIRECTIONS * 5:
+            positions = {player_id: (player.x, player.y) for player_id, player in game.players.items()}
+            version = game.version
+            game.execute_global_move(direction)
+            moved = reference_move(game, positions, direction) != positions
+            assert (game.version != version) == moved
+        game.close()
+
+    asyncio.run(play())